@@ -12,6 +12,8 @@ import aiohttp
 import aiohttp.web
 
 
+import learning_observer.cache
+import learning_observer.communication_protocol.profiler
 import learning_observer.module_loader
 from learning_observer.log_event import debug_log
 from learning_observer.util import clean_json
@@ -43,6 +45,8 @@ async def system_status(request):
     - Loaded modules
     - Available URLs
     - System resource usage
+    - Query profiles, if we're profiling execution DAGs
+    - Memoization cache hits and misses
 
     This returns JSON, which renders very nicely in Firefox, but might
     be handled by a client-side app at some point. If that happens, we
@@ -80,7 +84,9 @@ async def system_status(request):
             "dash_pages": clean_json(learning_observer.module_loader.dash_pages()),
             "execution_dags": clean_json(learning_observer.module_loader.execution_dags())
         },
-        "routes": routes(request.app)
+        "routes": routes(request.app),
+        "query_profiles": learning_observer.communication_protocol.profiler.summary(),
+        "cache_stats": learning_observer.cache.cache_stats()
     }
 
     debug_log(status)
@@ -1,26 +1,198 @@
+'''
+Memoization for slow async calls (LanguageTool, Google API fetches,
+GPT, etc.)
+
+Results are kept in two tiers:
+
+* A small, in-process LRU cache, bounded by `max_size`
+* The `memoization` KVS, which is shared between processes and
+  survives restarts
+
+Both honor a per-function `ttl`. Keys are a hash of the function name
+and arguments, so they stay short, however big the arguments (e.g. a
+whole essay).
+
+If several callers ask for the same value at once (e.g. several
+dashboards open on the same class), we only compute it once, and
+everyone waits on that one computation.
+
+Many call sites define the memoized function inside another function,
+so it gets re-decorated on every call. The in-process state is
+therefore kept at the module level, by function name, rather than in
+the decorator.
+'''
+
+import asyncio
+import collections
+import copy
 import functools
+import hashlib
 import json
+import time
 
 import learning_observer.kvs
 
 
+# Defaults. `ttl` is in seconds; `None` means results never expire
+# (although the KVS may expire them). Call sites should pick a `ttl`
+# which suits what they memoize. `max_size` is how many results we
+# keep in-process, per function.
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_SIZE = 256
+
+# Returned by lookups which miss, since `None` is a perfectly good
+# result to memoize.
+MISS = object()
+
+# Hit / miss counters, by function name
+STATS = collections.defaultdict(collections.Counter)
+
+# In-process LRU caches, by function name
+_LOCAL_CACHES = {}
+
+# Calls currently being computed, by key
+_IN_FLIGHT = {}
+
+
 def create_key_from_args(*args, **kwargs):
     key_dict = {'args': args, 'kwargs': kwargs}
     key_str = json.dumps(key_dict, sort_keys=True)
     return key_str
 
 
-def async_memoization():
+def hashed_key(name, *args, **kwargs):
+    '''
+    A compact key for a call to the function `name`.
+
+    >>> hashed_key('foo', 1, b=2) == hashed_key('foo', 1, b=2)
+    True
+    >>> hashed_key('foo', 1, b=2) == hashed_key('bar', 1, b=2)
+    False
+    >>> hashed_key('foo', 1, b=2)[:16]
+    'memoize,foo,sha2'
+    '''
+    digest = hashlib.sha256(create_key_from_args(*args, **kwargs).encode('utf-8')).hexdigest()
+    return "memoize,{name},sha256:{digest}".format(name=name, digest=digest)
+
+
+class _LRUCache:
+    '''
+    A small in-process cache of `(expiry, value)`, evicting the least
+    recently used item once we have more than `max_size`.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return MISS
+        expires, value = self.items[key]
+        if expires is not None and expires < time.time():
+            del self.items[key]
+            return MISS
+        self.items.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def set(self, key, value, expires):
+        self.items[key] = (expires, copy.deepcopy(value))
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+def cache_stats():
+    '''
+    Hit / miss counters for all memoized functions. `coalesced` counts
+    calls which waited on an identical call already in progress.
+    '''
+    return {name: dict(counter) for name, counter in STATS.items()}
+
+
+def async_memoization(ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+    '''
+    Decorator to memoize an async function. Arguments and results must
+    be JSON-serializable. Callers get their own copy of the result, so
+    it's safe to modify.
+
+    >>> saved_kvs = learning_observer.kvs.KVS
+    >>> learning_observer.kvs.KVS = learning_observer.kvs.KVSRouter(default=learning_observer.kvs.InMemoryKVS)
+    >>> learning_observer.kvs.KVS.add_item('memoization', learning_observer.kvs.InMemoryKVS)
+    >>> calls = []
+    >>> @async_memoization(ttl=0.05)
+    ... async def slow_square(x):
+    ...     calls.append(x)
+    ...     await asyncio.sleep(0.01)
+    ...     return x * x
+
+    Three callers at once share one call, later callers get the cached
+    result, and once it expires, we call again:
+
+    >>> async def run():
+    ...     at_once = await asyncio.gather(*[slow_square(3) for i in range(3)])
+    ...     cached = await slow_square(3)
+    ...     await asyncio.sleep(0.06)
+    ...     expired = await slow_square(3)
+    ...     return at_once, cached, expired
+    >>> asyncio.run(run())
+    ([9, 9, 9], 9, 9)
+    >>> calls, sorted(slow_square.stats.items())
+    ([3, 3], [('coalesced', 2), ('hits', 1), ('misses', 2)])
+    >>> learning_observer.kvs.KVS = saved_kvs
+    '''
     cache_backend = learning_observer.kvs.KVS.memoization()
 
     def decorator(func):
+        name = "{module}.{qualname}".format(module=func.__module__, qualname=func.__qualname__)
+        if name not in _LOCAL_CACHES:
+            _LOCAL_CACHES[name] = _LRUCache(max_size)
+        local_cache = _LOCAL_CACHES[name]
+        stats = STATS[name]
+
+        async def lookup(key):
+            '''
+            Check the in-process cache, and then the KVS.
+            '''
+            value = local_cache.get(key)
+            if value is not MISS:
+                return value
+            entry = await cache_backend[key]
+            if entry is None:
+                return MISS
+            if entry['expires'] is not None and entry['expires'] < time.time():
+                return MISS
+            local_cache.set(key, entry['value'], entry['expires'])
+            return entry['value']
+
+        async def compute(key, args, kwargs):
+            value = await lookup(key)
+            if value is not MISS:
+                stats['hits'] += 1
+                return value
+            stats['misses'] += 1
+            value = await func(*args, **kwargs)
+            expires = time.time() + ttl if ttl is not None else None
+            local_cache.set(key, value, expires)
+            await cache_backend.set(key, {'value': value, 'expires': expires})
+            return value
+
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            key = create_key_from_args(args, kwargs)
-            if key in await cache_backend.keys():
-                return await cache_backend[key]
-            result = await func(*args, **kwargs)
-            await cache_backend.set(key, result)
-            return result
+            key = hashed_key(name, args, kwargs)
+            if key in _IN_FLIGHT:
+                stats['coalesced'] += 1
+                return copy.deepcopy(await asyncio.shield(_IN_FLIGHT[key]))
+            task = asyncio.ensure_future(compute(key, args, kwargs))
+            _IN_FLIGHT[key] = task
+
+            def done(task):
+                _IN_FLIGHT.pop(key, None)
+                # If every caller was cancelled, nobody sees an exception.
+                # We don't want asyncio complaining about that.
+                if not task.cancelled():
+                    task.exception()
+            task.add_done_callback(done)
+            return copy.deepcopy(await asyncio.shield(task))
+        setattr(wrapper, 'stats', stats)
         return wrapper
     return decorator
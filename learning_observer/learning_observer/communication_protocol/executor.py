@@ -7,9 +7,14 @@ The executor processes the `execution_dag` portion of our request.
 import asyncio
 import collections
 import concurrent.futures
+import contextvars
 import functools
 import inspect
+import itertools
+import os
 
+import learning_observer.communication_protocol.plan
+import learning_observer.communication_protocol.profiler
 import learning_observer.communication_protocol.query
 import learning_observer.communication_protocol.util
 import learning_observer.kvs
@@ -24,6 +29,40 @@ from learning_observer.communication_protocol.exception import DAGExecutionExcep
 dispatch = learning_observer.communication_protocol.query.dispatch
 
 
+# The KVS keys read by the node we're running (if anyone's tracking
+# them). Each node runs in its own task, and so its own context.
+KEYS_READ = contextvars.ContextVar('keys_read', default=None)
+
+
+def record_keys_read(keys):
+    '''
+    Note that the current node read `keys`, so dashboards can re-run it
+    when they change (see `plan.ExecutionState`).
+    '''
+    keys_read = KEYS_READ.get()
+    if keys_read is not None:
+        keys_read.update(keys)
+
+
+# Where, in the result of the node we're running, the first error is
+# (as a list of keys and indices), once we know of one. Handlers which
+# return errors alongside good results (e.g. a map where one item
+# failed) note them here as they go, so the executor never has to
+# search through results (which may hold a whole class's essays) for
+# errors.
+NODE_ERROR = contextvars.ContextVar('node_error', default=None)
+
+
+def record_error(path):
+    '''
+    Note that the current node's result has an error at `path`. Only the
+    first error counts.
+    '''
+    error_path = NODE_ERROR.get()
+    if error_path is not None and not error_path:
+        error_path.append(list(path))
+
+
 def unimplemented_handler(*args, **kwargs):
     """
     We use a handler for mapping different types of nodes to their appropriate
@@ -205,6 +244,7 @@ def handle_join(left, right, left_on, right_on):
                 merged_dict = left_dict
             result.append(merged_dict)
         except KeyError as e:
+            record_error([len(result)])
             result.append(DAGExecutionException(
                 f'KeyError: key not found',
                 inspect.currentframe().f_code.co_name,
@@ -214,6 +254,13 @@ def handle_join(left, right, left_on, right_on):
     return result
 
 
+def _catch_exceptions(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        return e
+
+
 def exception_wrapper(func):
     """
     When we map values across a function, we want to catch any errors that may occur.
@@ -222,13 +269,23 @@ def exception_wrapper(func):
     and returns any exceptions as normal results. These exceptions are later caught by the
     DAG executor and handled appropriately. This allows the system to keep executing the DAG even
     if some values raise exceptions.
+
+    This is a `functools.partial` of a module-level function, rather
+    than a closure, so it can be pickled and sent to worker processes.
     """
-    def exception_catcher(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            return e
-    return exception_catcher
+    return functools.partial(_catch_exceptions, func)
+
+
+# How many calls a parallel map of a coroutine runs at once, by
+# default. This can be overridden with `map_concurrency` in the
+# `communication_protocol` section of the settings.
+DEFAULT_MAP_CONCURRENCY = 10
+
+
+def map_concurrency():
+    return learning_observer.settings.settings.get(
+        'communication_protocol', {}
+    ).get('map_concurrency', DEFAULT_MAP_CONCURRENCY)
 
 
 async def map_coroutine_serial(func, values, value_path):
@@ -243,24 +300,146 @@ async def map_coroutine_parallel(func, values, value_path):
     """
     We call map for coroutine functions operating in parallel.
     See the `handle_map` function for more details regarding parameters.
+
+    Unlike `map_coroutine_serial`, which starts every call at once, we
+    run at most `map_concurrency()` calls at a time, so mapping over a
+    large class doesn't open hundreds of connections to some service.
     """
-    raise DAGExecutionException(
-        'Asynchronous parallelization has not yet been implemented.',
-        inspect.currentframe().f_code.co_name,
-        {'function': func, 'values': values, 'value_path': value_path}
-    )
+    semaphore = asyncio.Semaphore(map_concurrency())
+
+    async def bounded(value):
+        async with semaphore:
+            return await func(get_nested_dict_value(value, value_path))
+    return await asyncio.gather(*[bounded(v) for v in values], return_exceptions=True)
+
+
+# The worker processes for `map_parallel`. We start these the first
+# time we need them, and keep them for the life of the server: starting
+# processes takes much longer than most of the functions we map. The
+# number of workers can be set with `process_pool_size` in the
+# `communication_protocol` section of the settings (by default, one per
+# CPU).
+_PROCESS_POOL = None
+
+# We send values to workers in chunks, since sending each value on its
+# own costs a round trip per value. By default, we split the values
+# into a few chunks per worker, so a slow chunk doesn't hold everything
+# up. The chunk size can be fixed with `map_chunk_size` in the
+# `communication_protocol` section of the settings.
+CHUNKS_PER_WORKER = 4
+
+
+def process_pool_size():
+    '''
+    How many worker processes the pool has.
+    '''
+    size = learning_observer.settings.settings.get(
+        'communication_protocol', {}
+    ).get('process_pool_size', None)
+    return size if size is not None else (os.cpu_count() or 1)
+
 
+def process_pool():
+    '''
+    The shared process pool, starting it if need be.
+    '''
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        _PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=process_pool_size())
+    return _PROCESS_POOL
+
+
+async def shutdown_process_pool(app):
+    '''
+    Stop the worker processes. This is an aiohttp cleanup handler: add
+    it to `app.on_cleanup`.
+    '''
+    global _PROCESS_POOL
+    if _PROCESS_POOL is not None:
+        _PROCESS_POOL.shutdown(wait=False)
+        _PROCESS_POOL = None
+
+
+def map_chunks(values, workers, chunk_size=None):
+    '''
+    Split `values` into chunks to send to `workers` worker processes.
+
+    >>> [len(chunk) for chunk in map_chunks(list(range(10)), 2)]
+    [2, 2, 2, 2, 2]
+    >>> [len(chunk) for chunk in map_chunks(list(range(10)), 2, chunk_size=4)]
+    [4, 4, 2]
+    >>> map_chunks([], 2)
+    []
+    '''
+    if not chunk_size:
+        chunk_size = max(1, -(-len(values) // (workers * CHUNKS_PER_WORKER)))
+    return [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+
+def _run_chunk(func, chunk):
+    """
+    Run `func` over a chunk of values, in a worker process. Exceptions
+    come back as results. `DAGExecutionException`s can't be unpickled,
+    so, as in `map_serial`, we send back their dictionary instead.
+    """
+    results = []
+    for value in chunk:
+        try:
+            results.append(func(value))
+        except DAGExecutionException as e:
+            results.append(e.to_dict())
+        except Exception as e:
+            results.append(e)
+    return results
 
-def map_parallel(func, values, value_path):
+
+async def map_parallel(func, values, value_path):
     """
     We call map for synchronous functions operating in parallel.
     See the `handle_map` function for more details regarding parameters.
+
+    Values are sent to the shared process pool in chunks. `func` and
+    the values must be picklable, so published functions mapped this
+    way should be defined at the top level of a module.
     """
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        # TODO catch any errors from get_nested_dict_value()
-        futures = [executor.submit(func, get_nested_dict_value(v, value_path)) for v in values]
-    results = [future.result() for future in futures]
-    return results
+    global _PROCESS_POOL
+    inputs = []
+    for v in values:
+        try:
+            inputs.append(get_nested_dict_value(v, value_path))
+        except Exception as e:
+            inputs.append(e)
+    # Values we couldn't find stay as errors; we only send the rest
+    positions = [i for i, value in enumerate(inputs) if not isinstance(value, Exception)]
+    pool = process_pool()
+    chunks = map_chunks(
+        [inputs[i] for i in positions],
+        process_pool_size(),
+        learning_observer.settings.settings.get('communication_protocol', {}).get('map_chunk_size', None)
+    )
+    loop = asyncio.get_running_loop()
+    try:
+        chunk_results = await asyncio.gather(*[
+            loop.run_in_executor(pool, _run_chunk, func, chunk) for chunk in chunks
+        ])
+    except concurrent.futures.process.BrokenProcessPool:
+        # A worker died (e.g. it ran out of memory). Start a fresh pool
+        # next time, rather than failing every map from now on. (Another
+        # map may have started one already.)
+        pool.shutdown(wait=False)
+        if _PROCESS_POOL is pool:
+            _PROCESS_POOL = None
+        raise
+    except Exception as e:
+        # Most likely, `func` or a value couldn't be pickled
+        raise DAGExecutionException(
+            f'Could not run {func} in a worker process.',
+            inspect.currentframe().f_code.co_name,
+            {'value_path': value_path, 'error': str(e)}
+        )
+    for i, result in zip(positions, itertools.chain.from_iterable(chunk_results)):
+        inputs[i] = result
+    return inputs
 
 
 def map_serial(func, values, value_path):
@@ -295,7 +474,10 @@ def annotate_map_metadata(function, results, values, value_path, func_kwargs):
         }
         if isinstance(res, dict):
             out = res
+            if 'error' in res:
+                record_error([len(output)])
         elif isinstance(res, Exception):
+            record_error([len(output)])
             error_provenance = provenance.copy()
             error_provenance['error'] = str(res)
             out = DAGExecutionException(
@@ -364,8 +546,9 @@ async def handle_map(functions, function_name, values, value_path, func_kwargs=N
     func_with_kwargs = functools.partial(func, **func_kwargs)
     is_coroutine = inspect.iscoroutinefunction(func)
     map_function = MAPS[f'map{"_coroutine" if is_coroutine else ""}_{"parallel" if parallel else "serial"}']
-    if not is_coroutine:
+    if not is_coroutine and not parallel:
         # wrap sync functions to return errors similar to asyncio.gather
+        # (`map_parallel` does this itself, in the worker processes)
         func_with_kwargs = exception_wrapper(func_with_kwargs)
 
     results = map_function(func_with_kwargs, values, value_path)
@@ -376,43 +559,95 @@ async def handle_map(functions, function_name, values, value_path, func_kwargs=N
     return output
 
 
+# How many keys we fetch from the KVS in one `multiget`, by default. A
+# select over a whole class is usually one round trip; this just keeps
+# single requests from getting huge. This can be overridden with
+# `select_chunk_size` in the `communication_protocol` section of the
+# settings.
+DEFAULT_SELECT_CHUNK_SIZE = 1000
+
+
+def select_chunk_size():
+    '''
+    How many keys we fetch at once when selecting from the KVS.
+    '''
+    return learning_observer.settings.settings.get(
+        'communication_protocol', {}
+    ).get('select_chunk_size', DEFAULT_SELECT_CHUNK_SIZE)
+
+
+def select_kvs(name):
+    '''
+    Find the KVS called `name` (as configured in the `kvs` section of
+    the settings). `None` is the default KVS.
+    '''
+    if name is None:
+        return learning_observer.kvs.KVS()
+    try:
+        return getattr(learning_observer.kvs.KVS, name)()
+    except AttributeError:
+        raise DAGExecutionException(
+            f'KVS `{name}` not found for select',
+            inspect.currentframe().f_code.co_name,
+            {'kvs': name}
+        )
+
+
 @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.SELECT)
-async def handle_select(keys, fields):
+async def handle_select(keys, fields, kvs=None):
     """
     We dispatch this function whenever we process a DISPATCH_MODES.SELECT node.
     This function is used to select data from a kvs. The data being selected
     is usually the output or the default from a reducer.
 
-    Currently, we only select data from the default learning_observer kvs.
-    TODO pass kvs as a parameter
+    By default, we select from the default learning_observer kvs. `kvs`
+    may name any other KVS in the settings.
 
     This function expects a list of dicts that contain a 'key' attribute as well
     as which fields to include. The fields should be specified as a dictionary
     where the keys are the dot notation you are looking for and the values are
     the key they are returned under.
 
+    We fetch all the keys with one `multiget` (or a few, for very long
+    lists of keys; see `select_chunk_size`).
+
     TODO add in test cases once we pass kvs as a parameter
     """
     if fields is None:
         fields = {}
 
-    response = []
     for k in keys:
-        if isinstance(k, dict) and 'key' in k:
-            # output from query added to response later
-            query_response_element = {
-                'provenance': {
-                    'key': k['key'],
-                    'provenance': k['provenance']
-                }
-            }
-        else:
+        if not (isinstance(k, dict) and 'key' in k):
             raise DAGExecutionException(
                 f'Key not formatted correctly for select: {k}',
                 inspect.currentframe().f_code.co_name,
                 {'keys': keys, 'fields': fields}
             )
-        resulting_value = await learning_observer.kvs.KVS()[k['key']]
+
+    # Reducer state may be stored in parts (see `split_state`); we only
+    # need to fetch the parts we're selecting.
+    selected_fields = set(f.split('.')[0] for f in fields)
+
+    store = select_kvs(kvs)
+    record_keys_read(k['key'] for k in keys)
+    chunk_size = select_chunk_size()
+    values = []
+    for start in range(0, len(keys), chunk_size):
+        chunk_keys = [k['key'] for k in keys[start:start + chunk_size]]
+        learning_observer.communication_protocol.profiler.record_kvs_call(chunk_keys)
+        chunk = await store.multiget(chunk_keys)
+        await learning_observer.stream_analytics.helpers.assemble_states(store, chunk, fields=selected_fields)
+        values.extend(chunk)
+
+    response = []
+    for k, resulting_value in zip(keys, values):
+        # output from query added to response later
+        query_response_element = {
+            'provenance': {
+                'key': k['key'],
+                'provenance': k['provenance']
+            }
+        }
         if resulting_value is None:
             # the reducer has not run yet, so we return the default value from the module
             resulting_value = k['default']
@@ -420,6 +655,7 @@ async def handle_select(keys, fields):
             try:
                 value = get_nested_dict_value(resulting_value, f)
             except KeyError as e:
+                record_error([len(response), fields[f]])
                 value = DAGExecutionException(
                     f'KeyError: key not found',
                     inspect.currentframe().f_code.co_name,
@@ -505,28 +741,85 @@ def hack_handle_keys(function, STUDENTS=None, STUDENTS_path=None, RESOURCES=None
     return keys
 
 
-def _has_error(node):
+# Handlers which note errors in their results themselves (see
+# `record_error`). We search the results of other nodes (e.g. calls to
+# published functions, which might return a list with an error in it).
+RECORDS_ERRORS = {
+    learning_observer.communication_protocol.query.DISPATCH_MODES.JOIN,
+    learning_observer.communication_protocol.query.DISPATCH_MODES.MAP,
+    learning_observer.communication_protocol.query.DISPATCH_MODES.SELECT
+}
+
+
+# Call and map nodes run published functions, which may read the KVS
+# without us knowing (so we can't record which keys they read), or
+# depend on the time (e.g. `writing_observer.activity_map`). When we
+# reuse an `ExecutionState`, we re-run these every time, and only re-run
+# the nodes downstream of them if their results changed.
+ALWAYS_RERUN = {
+    learning_observer.communication_protocol.query.DISPATCH_MODES.CALL,
+    learning_observer.communication_protocol.query.DISPATCH_MODES.MAP
+}
+
+
+def _find_error(value):
+    '''
+    Search `value` for an error, breadth first. Returns where the first
+    one is, as a list of keys and indices, or `None` if there isn't one.
+
+    >>> _find_error([{'user_id': 'bob'}, {'nested': {'error': 'Oops'}}])
+    [1, 'nested']
+    >>> _find_error({'error': 'Oops'})
+    []
+    >>> _find_error({'docs': [{'text': 'Hi'}, {'text': [{'error': 'Oops'}]}], 'user_id': 'bob'})
+    ['docs', 1, 'text', 0]
+    >>> _find_error([{'user_id': 'bob'}]) is None
+    True
+    '''
+    # Results can be big, and usually have no errors, so we don't build
+    # paths as we go. We keep, for each container we visit, its parent
+    # and its key (in `parents`), and only walk back up once we find an
+    # error.
+    parents = [(None, None)]
+    queue = collections.deque([(value, 0)])
+    while queue:
+        current, index = queue.popleft()
+        if isinstance(current, dict):
+            if 'error' in current:
+                path = []
+                while index:
+                    index, step = parents[index]
+                    path.append(step)
+                path.reverse()
+                return path
+            children = current.items()
+        elif isinstance(current, list):
+            children = enumerate(current)
+        else:
+            continue
+        for step, child in children:
+            if isinstance(child, (dict, list)):
+                parents.append((index, step))
+                queue.append((child, len(parents) - 1))
+    return None
+
+
+def _input_error(plan, node_name, inputs, errors):
     '''
     When executing a DAG, we may return an error. This function returns the first
-    error found, so that it can be further bubbled up the execution tree.
+    error among the inputs to `node_name`, and where it is in the node, so that
+    it can be further bubbled up the execution tree.
 
-    FIXME Possible bottleneck in this code. The following uses DFS when checking
-    for errors. Since a DAG can split off and rejoin, we may get iterate over the
-    same nodes multiple times. We have simple DAGs, so for now it should not be a
-    problem. However, we ought to change this to a BFS or add a visited node tracker.
+    We don't search the inputs for errors. `errors` has, for each node which
+    returned an error (or a result containing one), where in its result the
+    error is. See `record_error` and `RECORDS_ERRORS`.
     '''
-    queue = [(node, [])]  # start with the node and an empty path
-    while queue:
-        current, path = queue.pop(0)
-        if 'error' in current:
-            return current, path
-        for c in current:
-            if isinstance(current[c], dict):
-                queue.append((current[c], path + [c]))
-            elif isinstance(current[c], list):
-                for idx, i in enumerate(current[c]):
-                    if isinstance(i, dict):
-                        queue.append((i, path + [c, idx]))
+    for dependency, path in plan.dependency_paths[node_name].items():
+        if dependency in errors:
+            error = inputs[dependency]
+            for step in errors[dependency]:
+                error = error[step]
+            return error, list(path) + errors[dependency]
     return None, []
 
 
@@ -563,19 +856,81 @@ def strip_provenance(variable):
         return variable
 
 
-async def execute_dag(endpoint, parameters, functions, target_exports):
-    """
-    This is the primary way to execute a DAG.
-    Users should pass the overall execution dag dict, a dictionary parameters,
-    a dictionary of available functions, and a list of exports they wish to
-    receive data back for.
+# How many nodes of a DAG we run at once, by default. Independent nodes
+# (e.g. fetching a roster, and selecting from the KVS) run concurrently,
+# up to this limit. This can be overridden with `concurrency_limit` in
+# the `communication_protocol` section of the settings.
+DEFAULT_CONCURRENCY_LIMIT = 10
 
-    See `learning_observer/communication_protocol/test_cases.py` for usage examples.
-    """
-    target_nodes = [endpoint['exports'][key]['returns'] for key in target_exports]
 
-    visited = set()
-    nodes = endpoint['execution_dag']
+def concurrency_limit():
+    '''
+    How many nodes we may run at once.
+    '''
+    return learning_observer.settings.settings.get(
+        'communication_protocol', {}
+    ).get('concurrency_limit', DEFAULT_CONCURRENCY_LIMIT)
+
+
+async def execute_plan(plan, parameters, functions, target_exports, max_concurrency=None, state=None, profile=None):
+    """
+    Execute a compiled `ExecutionPlan` (see `plan.py`), with a dictionary
+    of parameters, a dictionary of available functions, and a list of
+    exports we wish to receive data back for.
+
+    The plan is shared, and not modified. All the state for this
+    execution (the value of each node) lives here. We fill in the
+    parameter nodes up front, and then start a task for each node we
+    need, in topological order, so every node can wait on the nodes it
+    depends on. Nodes which don't depend on each other run concurrently,
+    with at most `max_concurrency` (see `concurrency_limit`) running at
+    once.
+
+    If we're given an `ExecutionState` (see `plan.py`), we reuse the
+    values of any nodes it has, and record the values of the nodes we
+    run, and the KVS keys each one read, back into it. We re-run nodes
+    in `ALWAYS_RERUN` regardless, and any node which depends on a node
+    whose value changed:
+
+    >>> import learning_observer.communication_protocol.query as q
+    >>> import learning_observer.communication_protocol.plan as p
+    >>> plan = p.ExecutionPlan({
+    ...     'execution_dag': {
+    ...         'roster': q.call('roster')(),
+    ...         'joined': q.join(LEFT=q.variable('roster'), RIGHT=q.variable('roster'), LEFT_ON='id', RIGHT_ON='id')
+    ...     },
+    ...     'exports': {'joined': {'returns': 'joined'}}
+    ... })
+    >>> roster = [{'id': 'bob'}]
+    >>> state = p.ExecutionState()
+    >>> async def run():
+    ...     return await execute_plan(plan, {}, {'roster': lambda: roster}, ['joined'], max_concurrency=1, state=state, profile=False)
+    >>> asyncio.run(run())
+    {'joined': [{'id': 'bob'}]}
+    >>> joined = state.values['joined']
+    >>> asyncio.run(run()) and state.values['joined'] is joined
+    True
+    >>> roster = [{'id': 'alice'}]
+    >>> asyncio.run(run())
+    {'joined': [{'id': 'alice'}]}
+
+    If `profile` is set (by default, it's the `profile` setting), we
+    measure each node we run (see `profiler.py`).
+    """
+    target_nodes = [plan.exports[key]['returns'] for key in target_exports]
+    needed = plan.needed(target_nodes)
+    semaphore = asyncio.Semaphore(max_concurrency if max_concurrency is not None else concurrency_limit())
+
+    # The values of nodes we've run, tasks for nodes we're running, and
+    # where the first error is in the value of any node which had one
+    values = {}
+    tasks = {}
+    errors = {}
+    # Nodes we ran whose values may differ from those in `state`
+    changed = set()
+    if profile is None:
+        profile = learning_observer.communication_protocol.profiler.profiling_enabled()
+    profiles = {} if profile else None
 
     async def dispatch_node(node):
         """
@@ -586,9 +941,8 @@ async def execute_dag(endpoint, parameters, functions, target_exports):
                 return node
             if dispatch not in node:
                 return node
-            node_dispatch = node[dispatch]
+            node_dispatch = node.pop(dispatch)
             function = DISPATCH[node_dispatch]
-            del node[dispatch]
             # make dispatch specific function call
             if node_dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.PARAMETER:
                 result = function(parameters=parameters, **node)
@@ -604,55 +958,154 @@ async def execute_dag(endpoint, parameters, functions, target_exports):
         except DAGExecutionException as e:
             return e.to_dict()
 
-    async def walk_dict(node_dict):
+    async def value_of(node_name):
+        if node_name in tasks:
+            return await tasks[node_name]
+        if node_name in values:
+            return values[node_name]
+        errors[node_name] = []
+        return DAGExecutionException(
+            f'Variable {node_name} not found in execution DAG',
+            inspect.currentframe().f_code.co_name,
+            {'variable_name': node_name}
+        ).to_dict()
+
+    async def run_node(node_name):
         """
-        We walk through the execution DAG backwards. We visit any variable nodes
-        we find and cache their stored value.
+        Run a single node, once the nodes it depends on have run, and
+        note any error in its result.
         """
-        for child_key, child_value in list(node_dict.items()):
-            if isinstance(child_value, dict) and dispatch in child_value and child_value[dispatch] == learning_observer.communication_protocol.query.DISPATCH_MODES.VARIABLE:
-                node_dict[child_key] = await visit(child_value['variable_name'])
-            elif isinstance(child_value, dict):
-                await walk_dict(child_value)
-
-    async def visit(node_name):
+        error_path = []
+        NODE_ERROR.set(error_path)
+        result = await evaluate_node(node_name)
+        if isinstance(result, dict) and 'error' in result:
+            errors[node_name] = []
+        elif error_path:
+            errors[node_name] = error_path[0]
+        elif plan.nodes[node_name].get(dispatch) not in RECORDS_ERRORS:
+            nested_error = _find_error(result)
+            if nested_error is not None:
+                errors[node_name] = nested_error
+        return result
+
+    async def reuse_node(node_name):
+        """
+        Return the value `state` has for a node, unless the node is in
+        `ALWAYS_RERUN`, or a node it depends on changed, in which case
+        we run it again.
+        """
+        previous = state.values[node_name]
+        dependencies = plan.dependencies[node_name]
+        if plan.nodes[node_name].get(dispatch) not in ALWAYS_RERUN:
+            await asyncio.gather(*[value_of(d) for d in dependencies])
+            if changed.isdisjoint(dependencies):
+                return previous
+        result = await run_node(node_name)
+        if result != previous:
+            changed.add(node_name)
+        return result
+
+    async def evaluate_node(node_name):
         """
-        When executing the DAG, we `visit()` nodes that we want output from.
-        These will either be specified as target_nodes or be any descendents
-        of the target_nodes.
-
-        If we've already visited a node, we return the result.
         If any of the child nodes return errors, we return them.
         """
-        # We've already done this one.
-        if node_name in visited:
-            return nodes[node_name]
-
-        # Execute all the child nodes
-        await walk_dict(nodes[node_name])
+        if node_name in plan.cycles:
+            # The nodes it depends on are waiting for this one
+            return DAGExecutionException(
+                f'Cycle found in execution DAG at {node_name}',
+                inspect.currentframe().f_code.co_name,
+                {'node': node_name, 'dependencies': plan.dependencies[node_name]}
+            ).to_dict()
+        dependencies = plan.dependencies[node_name]
+        inputs = dict(zip(dependencies, await asyncio.gather(*[value_of(d) for d in dependencies])))
 
         # Check for any errors, then dispatch the node
         # if errors are present, we bubble them up the DAG
-        error, error_path = _has_error(nodes[node_name])
+        error, error_path = _input_error(plan, node_name, inputs, errors)
         if error is not None:
-            nodes[node_name] = {
+            node = {
                 'error': error,
-                'dispatch': nodes[node_name]['dispatch'],
+                'dispatch': plan.nodes[node_name][dispatch],
                 'error_path': error_path
             }
-            debug_log(f'Error occured within execution dag at {node_name}\n{nodes[node_name]}')
-        else:
-            nodes[node_name] = await dispatch_node(nodes[node_name])
+            debug_log(f'Error occured within execution dag at {node_name}\n{node}')
+            return node
+        node = learning_observer.communication_protocol.plan.fill(plan.nodes[node_name], inputs)
+        async with semaphore:
+            if state is not None:
+                keys_read = set()
+                KEYS_READ.set(keys_read)
+            if profiles is not None:
+                node_profile = profiles[node_name] = learning_observer.communication_protocol.profiler.NodeProfile()
+                learning_observer.communication_protocol.profiler.CURRENT.set(node_profile)
+                node_profile.start()
+            result = await dispatch_node(node)
+            if profiles is not None:
+                node_profile.stop(result)
+            if state is not None:
+                state.keys_read[node_name] = keys_read
+            return result
 
-        visited.add(node_name)
-        return nodes[node_name]
+    for node_name in needed:
+        if node_name in plan.parameters:
+            # Parameters are just looked up, so we don't need a task.
+            # They always come from this call, never from `state`.
+            values[node_name] = await dispatch_node(
+                learning_observer.communication_protocol.plan.fill(plan.parameters[node_name], {})
+            )
+            if isinstance(values[node_name], dict) and 'error' in values[node_name]:
+                errors[node_name] = []
+        elif state is not None and node_name in state.values:
+            tasks[node_name] = asyncio.ensure_future(reuse_node(node_name))
+        else:
+            changed.add(node_name)
+            tasks[node_name] = asyncio.ensure_future(run_node(node_name))
+
+    results = await asyncio.gather(*[value_of(e) for e in target_nodes])
+    if state is not None:
+        for node_name, value in itertools.chain(values.items(), ((n, t.result()) for n, t in tasks.items())):
+            # Errors may be transient (e.g. a failed API call), so we
+            # don't hold on to them. Nor do we keep parameters: states
+            # may be shared between connections (see `dashboard.py`),
+            # and parameters such as the `runtime` belong to one of them.
+            if node_name in errors or node_name in plan.parameters:
+                state.values.pop(node_name, None)
+            else:
+                state.values[node_name] = value
 
     # Include execution history in output if operating in development settings
     if learning_observer.settings.RUN_MODE == learning_observer.settings.RUN_MODES.DEV:
-        return {e: clean_json(await visit(e)) for e in target_nodes}
+        output = {e: clean_json(result) for e, result in zip(target_nodes, results)}
+        if profiles is not None:
+            output[learning_observer.communication_protocol.profiler.PROFILE_KEY] = {
+                node_name: node_profile.to_dict() for node_name, node_profile in profiles.items()
+            }
+        return output
+
+    if profiles is not None:
+        learning_observer.communication_protocol.profiler.record(plan.name, profiles)
 
     # Remove execution history if in deployed settings, with data flowing back to teacher dashboards
-    return {e: clean_json(strip_provenance(await visit(e))) for e in target_nodes}
+    return {e: clean_json(strip_provenance(result)) for e, result in zip(target_nodes, results)}
+
+
+async def execute_dag(endpoint, parameters, functions, target_exports, max_concurrency=None, profile=None):
+    """
+    This is the primary way to execute a DAG.
+    Users should pass the overall execution dag dict, a dictionary parameters,
+    a dictionary of available functions, and a list of exports they wish to
+    receive data back for.
+
+    This compiles the DAG on every call. Code which runs the same DAG
+    repeatedly should compile it once, with `plan.ExecutionPlan`, and
+    call `execute_plan`.
+
+    See `learning_observer/communication_protocol/test_cases.py` for usage examples.
+    """
+    return await execute_plan(
+        learning_observer.communication_protocol.plan.ExecutionPlan(endpoint),
+        parameters, functions, target_exports, max_concurrency=max_concurrency, profile=profile
+    )
 
 
 if __name__ == "__main__":
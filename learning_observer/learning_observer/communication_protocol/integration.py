@@ -4,10 +4,8 @@ Learning Observer platform and publishing functions from
 the Learning Observer platform into the communications
 protocol.
 '''
-import copy
-
 import learning_observer.communication_protocol.executor
-import learning_observer.communication_protocol.util
+import learning_observer.communication_protocol.plan
 
 FUNCTIONS = {}
 DUPLICATE_FUNCTION_FOUND = """Duplicate function name found: {name}.
@@ -44,6 +42,9 @@ def add_exports_to_module(execution_dag, module):
     The `set_query_with_name` inner closure is necessary to appropriately
     set the `name` parameter within the `query_func` inner-most function.
 
+    `execution_dag` may be a DAG, or a compiled `ExecutionPlan`. Either
+    way, we compile it once, here, rather than on each call.
+
     Example Usage:
         dag = {
             "exports": {
@@ -57,11 +58,11 @@ def add_exports_to_module(execution_dag, module):
     Raises:
         AttributeError: If the attribute name already exists in the module.
     '''
-    for query_name in execution_dag['exports']:
+    plan = learning_observer.communication_protocol.plan.as_plan(execution_dag)
+    for query_name in plan.exports:
         def set_query_with_name(name):
             async def query_func(**kwargs):  # create new function
-                flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(execution_dag))
-                output = await learning_observer.communication_protocol.executor.execute_dag(flat, parameters=kwargs, functions=FUNCTIONS, target_exports=[query_name])
+                output = await learning_observer.communication_protocol.executor.execute_plan(plan, parameters=kwargs, functions=FUNCTIONS, target_exports=[name])
                 return output
             if hasattr(module, name):
                 raise AttributeError(f'Attibute, {name}, already exists under {module}')
@@ -70,18 +71,24 @@ def add_exports_to_module(execution_dag, module):
         set_query_with_name(query_name)
 
 
-def prepare_dag_execution(query, targets):
+def prepare_dag_execution(query, targets, state=None):
     '''
     This functions wraps an execution DAG in the necessary steps to
     execute specific `targets`.
 
+    `query` may be a DAG, or a compiled `ExecutionPlan`. Callers which
+    run the same DAG repeatedly should pass a plan, so we don't have to
+    compile the DAG each time. They may also pass an `ExecutionState`,
+    so we only re-run nodes which aren't in it (see `execute_plan`).
+
     Example Usage:
         query_obj = ...  # create the query object
         query_function = prepare_dag_execution(query_obj)
         result = await query_function(param1=value1, param2=value2)
     '''
+    plan = learning_observer.communication_protocol.plan.as_plan(query)
+
     async def query_func(**kwargs):
-        flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(query))
-        output = await learning_observer.communication_protocol.executor.execute_dag(flat, parameters=kwargs, functions=FUNCTIONS, target_exports=targets)
+        output = await learning_observer.communication_protocol.executor.execute_plan(plan, parameters=kwargs, functions=FUNCTIONS, target_exports=targets, state=state)
         return output
     return query_func
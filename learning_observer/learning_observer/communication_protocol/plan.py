@@ -0,0 +1,258 @@
+'''
+Dashboards run the same execution DAGs over and over (every few
+seconds, for every open dashboard). Rather than copying, flattening,
+and walking the DAG's JSON on every run, we compile each DAG once into
+an `ExecutionPlan`:
+
+* The DAG, flattened, so every node is at the top level
+* For each node, which nodes it depends on, and where in the node
+  their values go
+* A topological order of the nodes, so we can run them without
+  recursing through the DAG
+* The parameter nodes, which are filled in directly from the
+  parameters the caller passes in
+
+A plan is shared between executions, and must not be modified. Each
+execution keeps its own state (see `executor.execute_plan`), and
+builds each node's arguments from the plan with `fill`. A dashboard
+which runs the same plan repeatedly can keep an `ExecutionState`
+between runs, and only re-run the nodes affected by a change.
+
+>>> import learning_observer.communication_protocol.query as q
+>>> plan = ExecutionPlan({
+...     'execution_dag': {
+...         'roster': q.call('roster')(course=q.parameter('course_id', required=True)),
+...         'docs': q.join(LEFT=q.variable('roster'), RIGHT=q.variable('roster'))
+...     },
+...     'exports': {'docs': {'returns': 'docs'}}
+... })
+>>> plan.order
+('impl.roster.kwargs.course', 'roster', 'docs')
+>>> plan.needed(['roster'])
+('impl.roster.kwargs.course', 'roster')
+>>> sorted(plan.parameters)
+['impl.roster.kwargs.course']
+'''
+import copy
+import types
+
+import learning_observer.communication_protocol.query
+import learning_observer.communication_protocol.util
+
+dispatch = learning_observer.communication_protocol.query.dispatch
+DISPATCH_MODES = learning_observer.communication_protocol.query.DISPATCH_MODES
+
+
+def is_variable(node):
+    return isinstance(node, dict) and node.get(dispatch) == DISPATCH_MODES.VARIABLE
+
+
+def find_dependencies(node, found, path=()):
+    '''
+    The names of all the variables `node` references, in order, and
+    where (as a tuple of keys and list indices) each one first appears
+    in `node`. We look everywhere `fill` does, including inside lists.
+
+    >>> find_dependencies({'a': {'dispatch': 'variable', 'variable_name': 'x'}, 'b': {'c': {'dispatch': 'variable', 'variable_name': 'y'}}}, {})
+    {'x': ('a',), 'y': ('b', 'c')}
+    >>> find_dependencies({'a': [1, {'dispatch': 'variable', 'variable_name': 'x'}, [{'b': {'dispatch': 'variable', 'variable_name': 'y'}}]]}, {})
+    {'x': ('a', 1), 'y': ('a', 2, 0, 'b')}
+    '''
+    if isinstance(node, dict):
+        items = node.items()
+    elif isinstance(node, list):
+        items = enumerate(node)
+    else:
+        return found
+    for key, value in items:
+        if is_variable(value):
+            found.setdefault(value['variable_name'], path + (key,))
+        else:
+            find_dependencies(value, found, path + (key,))
+    return found
+
+
+def _fill_value(template, values):
+    if is_variable(template):
+        return values[template['variable_name']]
+    if isinstance(template, dict):
+        return {key: _fill_value(value, values) for key, value in template.items()}
+    if isinstance(template, list):
+        return [_fill_value(item, values) for item in template]
+    return template
+
+
+def fill(template, values):
+    '''
+    Build a node, ready to dispatch, from its template in the plan:
+    variables inside it are replaced with their values from `values`.
+    We copy the containers, so handlers may modify their arguments
+    without changing the plan.
+
+    >>> fill({'a': {'dispatch': 'variable', 'variable_name': 'x'}, 'b': [1, {'c': 2}]}, {'x': 5})
+    {'a': 5, 'b': [1, {'c': 2}]}
+    '''
+    if not isinstance(template, dict):
+        return template
+    return {key: _fill_value(value, values) for key, value in template.items()}
+
+
+class ExecutionPlan(object):
+    '''
+    A compiled execution DAG. See the module docstring.
+
+    `endpoint` is a DAG in the usual format, with `execution_dag` and
+    `exports`. It may or may not have already been flattened; we don't
+    modify it. `name` is just for reporting (e.g. in profiles).
+    '''
+    __slots__ = ('name', 'nodes', 'exports', 'dependencies', 'dependency_paths', 'dependents', 'order', 'parameters', 'cycles', '_needed')
+
+    def __init__(self, endpoint, name=None):
+        self.name = name
+        flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(dict(endpoint)))
+        nodes = flat['execution_dag']
+        self.nodes = types.MappingProxyType(nodes)
+        self.exports = types.MappingProxyType(flat.get('exports', {}))
+        # Where, in each node, each of its dependencies goes (so we can
+        # say where an error came from)
+        self.dependency_paths = types.MappingProxyType({
+            name: types.MappingProxyType(find_dependencies(node, {}) if isinstance(node, dict) else {})
+            for name, node in nodes.items()
+        })
+        self.dependencies = types.MappingProxyType({
+            name: tuple(paths) for name, paths in self.dependency_paths.items()
+        })
+        dependents = {name: [] for name in nodes}
+        for name, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                if dependency in dependents:
+                    dependents[dependency].append(name)
+        self.dependents = types.MappingProxyType({name: tuple(names) for name, names in dependents.items()})
+        self.parameters = types.MappingProxyType({
+            name: node for name, node in nodes.items()
+            if isinstance(node, dict) and node.get(dispatch) == DISPATCH_MODES.PARAMETER
+        })
+        # Nodes which depend on themselves, through some chain of
+        # variables. These become errors when we run them.
+        self.cycles = set()
+        self.order = self._sort(nodes)
+        self.cycles = frozenset(self.cycles)
+        # Which nodes we need to run for a given set of targets. There
+        # are only a few combinations of targets for each DAG, so we
+        # keep them all.
+        self._needed = {}
+
+    def _sort(self, nodes):
+        '''
+        Put the nodes in topological order: each node comes after all
+        the nodes it depends on (except where there's a cycle, which we
+        note in `cycles`).
+        '''
+        order = []
+        done = set()
+        for start in nodes:
+            if start in done:
+                continue
+            # Depth-first, with an explicit stack, since DAGs may be deep
+            in_progress = {start}
+            stack = [(start, iter(self.dependencies[start]))]
+            while stack:
+                name, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    in_progress.discard(name)
+                    done.add(name)
+                    order.append(name)
+                elif child in in_progress:
+                    self.cycles.add(name)
+                elif child not in done and child in nodes:
+                    in_progress.add(child)
+                    stack.append((child, iter(self.dependencies[child])))
+        return tuple(order)
+
+    def needed(self, target_nodes):
+        '''
+        The nodes needed to compute `target_nodes`, in topological order.
+        '''
+        targets = tuple(target_nodes)
+        if targets not in self._needed:
+            needed = set()
+            pending = list(targets)
+            while pending:
+                name = pending.pop()
+                if name in needed or name not in self.nodes:
+                    continue
+                needed.add(name)
+                pending.extend(self.dependencies[name])
+            self._needed[targets] = tuple(name for name in self.order if name in needed)
+        return self._needed[targets]
+
+
+class ExecutionState(object):
+    '''
+    What we learned from running a plan: the value of each node, and
+    which KVS keys each node read. If we run the plan again with the
+    same state (and the same parameters), nodes which still have a
+    value aren't re-run (other than calls and maps; see
+    `executor.ALWAYS_RERUN`). `invalidate` clears the nodes which depend on
+    keys which changed. We don't keep the values of parameter nodes;
+    those come from each run.
+
+    >>> import learning_observer.communication_protocol.query as q
+    >>> plan = ExecutionPlan({
+    ...     'execution_dag': {
+    ...         'roster': q.call('roster')(),
+    ...         'docs': q.select(q.variable('roster')),
+    ...         'joined': q.join(LEFT=q.variable('roster'), RIGHT=q.variable('docs'))
+    ...     },
+    ...     'exports': {}
+    ... })
+    >>> state = ExecutionState()
+    >>> state.values = {'roster': [], 'docs': [], 'joined': []}
+    >>> state.keys_read = {'docs': {'key-1', 'key-2'}}
+    >>> sorted(state.invalidate(plan, ['key-2']))
+    ['docs', 'joined']
+    >>> sorted(state.values)
+    ['roster']
+    '''
+    def __init__(self):
+        self.values = {}
+        self.keys_read = {}
+
+    def keys(self):
+        '''
+        All the KVS keys the plan read.
+        '''
+        keys = set()
+        for node_keys in self.keys_read.values():
+            keys.update(node_keys)
+        return keys
+
+    def invalidate(self, plan, changed_keys):
+        '''
+        Forget the values of nodes which read any of `changed_keys`, and
+        of every node downstream of them. Returns the nodes we forgot.
+        '''
+        changed_keys = set(changed_keys)
+        pending = [name for name, keys in self.keys_read.items() if not changed_keys.isdisjoint(keys)]
+        invalid = set()
+        while pending:
+            name = pending.pop()
+            if name in invalid:
+                continue
+            invalid.add(name)
+            pending.extend(plan.dependents.get(name, ()))
+        for name in invalid:
+            self.values.pop(name, None)
+            self.keys_read.pop(name, None)
+        return invalid
+
+
+def as_plan(query):
+    '''
+    Compile `query`, unless it's already a plan.
+    '''
+    if isinstance(query, ExecutionPlan):
+        return query
+    return ExecutionPlan(query)
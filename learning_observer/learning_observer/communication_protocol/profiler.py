@@ -0,0 +1,146 @@
+'''
+Profiling for execution DAGs: which node of a dashboard's DAG is slow?
+
+This is opt-in, since measuring the size of each node's result costs
+about as much as sending it. Turn it on with `profile: true` in the
+`communication_protocol` section of the settings (or pass
+`profile=True` to `executor.execute_plan`). For each node we run, we
+record:
+
+* `wall_time`: how long the node took to run, in milliseconds (not
+  counting waiting on the nodes it depends on)
+* `kvs_calls` and `kvs_keys`: how many KVS fetches it made, and how many
+  keys it fetched
+* `items`: how many items it returned (e.g. students)
+* `bytes`: how big its result is, as JSON
+
+In development, the profile is returned with the results, under
+`_profile`. In deployment, it's added to histograms (one per DAG, node,
+and measurement), which show up in `/admin/status`.
+
+>>> histogram = Histogram()
+>>> for value in [0.5, 3, 3, 100]:
+...     histogram.add(value)
+>>> histogram.to_dict()
+{'count': 4, 'mean': 26.625, 'buckets': {'<=1': 1, '<=4': 2, '<=128': 1}}
+'''
+import collections
+import contextvars
+import json
+import time
+
+import learning_observer.settings
+
+
+# Where we return the profile, alongside the results, in development
+PROFILE_KEY = '_profile'
+
+# The profile of the node we're running (if we're profiling). Each node
+# runs in its own task, and so its own context.
+CURRENT = contextvars.ContextVar('node_profile', default=None)
+
+
+def profiling_enabled():
+    return learning_observer.settings.settings.get(
+        'communication_protocol', {}
+    ).get('profile', False)
+
+
+class NodeProfile(object):
+    '''
+    What we measured about running one node.
+    '''
+    __slots__ = ('wall_time', 'kvs_calls', 'kvs_keys', 'items', 'bytes', '_start')
+
+    def __init__(self):
+        self.wall_time = 0
+        self.kvs_calls = 0
+        self.kvs_keys = 0
+        self.items = 0
+        self.bytes = 0
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def stop(self, result):
+        '''
+        Note that the node finished, returning `result`.
+        '''
+        self.wall_time = (time.perf_counter() - self._start) * 1000
+        if isinstance(result, (list, dict)):
+            self.items = len(result)
+        else:
+            self.items = 0 if result is None else 1
+        self.bytes = len(json.dumps(result, default=str))
+
+    def to_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'kvs_calls': self.kvs_calls,
+            'kvs_keys': self.kvs_keys,
+            'items': self.items,
+            'bytes': self.bytes
+        }
+
+
+def record_kvs_call(keys):
+    '''
+    Note that the current node fetched `keys` from the KVS.
+    '''
+    profile = CURRENT.get()
+    if profile is not None:
+        profile.kvs_calls += 1
+        profile.kvs_keys += len(keys)
+
+
+class Histogram(object):
+    '''
+    Counts of values, in power-of-two buckets. This is cheap enough to
+    keep for every node of every DAG, and enough to tell a node which
+    usually takes 10ms from one which takes a second.
+    '''
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.buckets = collections.Counter()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        bucket = 1
+        while bucket < value:
+            bucket *= 2
+        self.buckets[bucket] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'buckets': {f'<={bucket}': self.buckets[bucket] for bucket in sorted(self.buckets)}
+        }
+
+
+# Histograms, by DAG, node, and measurement
+HISTOGRAMS = collections.defaultdict(Histogram)
+
+
+def record(dag_name, profiles):
+    '''
+    Add the profiles from one execution of a DAG (as `node: NodeProfile`)
+    to our histograms.
+    '''
+    for node_name, profile in profiles.items():
+        for measurement, value in profile.to_dict().items():
+            HISTOGRAMS[(dag_name, node_name, measurement)].add(value)
+
+
+def summary():
+    '''
+    Our histograms, as nested dictionaries: DAG, node, measurement.
+    '''
+    output = {}
+    for (dag_name, node_name, measurement), histogram in sorted(HISTOGRAMS.items(), key=lambda item: str(item[0])):
+        output.setdefault(str(dag_name), {}).setdefault(node_name, {})[measurement] = histogram.to_dict()
+    return output
@@ -34,11 +34,12 @@ function call (functionName) {
   return caller
 }
 
-function select (keys, fields = null) {
+function select (keys, fields = null, kvs = null) {
   return {
     dispatch: DISPATCH_MODES.SELECT,
     keys,
-    fields
+    fields,
+    kvs
   }
 }
 
@@ -71,7 +72,71 @@ function keys (func, { ...kwargs } = {}) {
   }
 }
 
+/*
+ * Delta-encoded updates (see `learning_observer/delta.py`). Open the
+ * websocket with `?delta=true`, and pass each message through a
+ * `DeltaDecoder`, which returns the full, current payload.
+ */
+function unescapePointer (token) {
+  return token.replace(/~1/g, '/').replace(/~0/g, '~')
+}
+
+function applyPatch (document, patch) {
+  for (const operation of patch) {
+    if (operation.path === '') {
+      document = operation.value
+      continue
+    }
+    const tokens = operation.path.split('/').slice(1).map(unescapePointer)
+    let parent = document
+    for (const token of tokens.slice(0, -1)) {
+      parent = Array.isArray(parent) ? parent[parseInt(token)] : parent[token]
+    }
+    const last = Array.isArray(parent) ? parseInt(tokens[tokens.length - 1]) : tokens[tokens.length - 1]
+    if (operation.op === 'remove') {
+      if (Array.isArray(parent)) {
+        parent.splice(last, 1)
+      } else {
+        delete parent[last]
+      }
+    } else {
+      parent[last] = operation.value
+    }
+  }
+  return document
+}
+
+class DeltaDecoder {
+  constructor () {
+    this.data = null
+    this.seq = null
+  }
+
+  /*
+   * Apply a message from the server. Returns the current payload, or
+   * `null` if we missed a message (in which case, the caller should
+   * reconnect to get a full update).
+   */
+  decode (message) {
+    if (message.type === 'full') {
+      this.data = message.data
+      this.seq = message.seq
+      return this.data
+    }
+    if (this.seq === null || message.seq !== this.seq + 1) {
+      this.data = null
+      this.seq = null
+      return null
+    }
+    this.data = applyPatch(this.data, message.patch)
+    this.seq = message.seq
+    return this.data
+  }
+}
+
 export {
+  applyPatch,
+  DeltaDecoder,
   parameter,
   call,
   variable,
@@ -66,14 +66,16 @@ def call(function_name):
     return caller
 
 
-def select(keys, fields=None):
+def select(keys, fields=None, kvs=None):
     """
-    Select is used to collect data from the KVS
+    Select is used to collect data from the KVS. By default, this is the
+    default KVS; `kvs` may name another one from the settings.
     """
     return {
         dispatch: DISPATCH_MODES.SELECT,
         "keys": keys,
-        "fields": fields
+        "fields": fields,
+        "kvs": kvs
     }
 
 
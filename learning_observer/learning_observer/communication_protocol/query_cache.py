@@ -0,0 +1,147 @@
+'''
+A short-lived cache of query results, shared between dashboard
+connections.
+
+Each open dashboard re-runs its queries every few seconds. Several
+tabs (or teachers) watching the same course run the same queries, with
+the same parameters, at around the same time. We keep each result for
+a few seconds, and if an identical query is already running, we wait
+for it rather than starting another, so N connections cost about one
+execution per tick.
+
+Results are keyed on the DAG, the exports, the parameters, and an auth
+scope. By default, the scope is the user: results depend on the
+user's credentials (e.g. Google rosters), and a user should never get
+results they couldn't have fetched themselves. Deployments where every
+teacher may see every course can set `query_cache: {shared: true}` in
+the `communication_protocol` settings to share results between users.
+
+Each caller gets its own (deep) copy of a cached result, so it may
+modify it: e.g. a join returns its input dictionaries, so one node's
+value may be part of another's.
+'''
+import asyncio
+import copy
+import hashlib
+import json
+import time
+
+import learning_observer.settings
+
+
+# How long (in seconds) we keep results, by default. This should be a
+# bit less than how often dashboards poll, so each poll gets fresh
+# data, but polls from different connections share it.
+DEFAULT_TTL = 2
+
+# Results, as `key: (expires, result)`
+_RESULTS = {}
+
+# Queries currently running, by key
+_IN_FLIGHT = {}
+
+
+def cache_settings():
+    return learning_observer.settings.settings.get(
+        'communication_protocol', {}
+    ).get('query_cache', {})
+
+
+def auth_scope(request):
+    '''
+    Who may share results with the user making `request`.
+    '''
+    if cache_settings().get('shared', False):
+        return 'shared'
+    user = request.get('user') if request is not None else None
+    if not user:
+        return None
+    return user.get('user_id')
+
+
+def query_key(dag, target_exports, parameters, scope):
+    '''
+    A key for one query. `dag` is the DAG's name, or the DAG itself (if
+    the client sent one). Parameters which aren't JSON (such as the
+    `runtime`) are left out.
+
+    >>> query_key('wo', ['docs'], {'course_id': 1, 'a': 2}, 'u1') == query_key('wo', ['docs'], {'a': 2, 'course_id': 1}, 'u1')
+    True
+    >>> query_key('wo', ['docs'], {'course_id': 1}, 'u1') == query_key('wo', ['docs'], {'course_id': 1}, 'u2')
+    False
+    '''
+    normalized = json.dumps(
+        {
+            'dag': dag,
+            'targets': sorted(target_exports),
+            'parameters': {key: value for key, value in parameters.items() if key != 'runtime'},
+            'scope': scope
+        },
+        sort_keys=True,
+        default=lambda value: repr(type(value))
+    )
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _prune(now):
+    for key in [key for key, (expires, result) in _RESULTS.items() if expires < now]:
+        del _RESULTS[key]
+
+
+async def cached_query(key, run_query, ttl=None):
+    '''
+    Return the result of `run_query()` (a coroutine function) from the
+    cache if we have a recent one, or wait on an identical query if one
+    is running, or else run it.
+
+    Three connections asking at once run the query once:
+
+    >>> runs = []
+    >>> async def run_query():
+    ...     runs.append('run')
+    ...     await asyncio.sleep(0.01)
+    ...     return 'result'
+    >>> async def three_connections():
+    ...     return await asyncio.gather(*[cached_query('doctest', run_query, ttl=1) for i in range(3)])
+    >>> asyncio.run(three_connections()), len(runs)
+    (['result', 'result', 'result'], 1)
+
+    And until the result expires, so does anyone else. Each gets their
+    own copy:
+
+    >>> async def run_query():
+    ...     runs.append('run')
+    ...     return {'students': ['bob']}
+    >>> mine = asyncio.run(cached_query('copies', run_query, ttl=1))
+    >>> mine['students'].append('alice')
+    >>> asyncio.run(cached_query('copies', run_query, ttl=1)), len(runs)
+    ({'students': ['bob']}, 2)
+    '''
+    if ttl is None:
+        ttl = cache_settings().get('ttl', DEFAULT_TTL)
+    if not ttl:
+        return await run_query()
+
+    now = time.time()
+    if key in _RESULTS:
+        expires, result = _RESULTS[key]
+        if expires >= now:
+            return copy.deepcopy(result)
+    if key not in _IN_FLIGHT:
+        async def run_and_store():
+            result = await run_query()
+            finished = time.time()
+            _prune(finished)
+            _RESULTS[key] = (finished + ttl, result)
+            return result
+        task = asyncio.ensure_future(run_and_store())
+        _IN_FLIGHT[key] = task
+
+        def done(task):
+            _IN_FLIGHT.pop(key, None)
+            # If every caller went away, nobody sees an exception.
+            if not task.cancelled():
+                task.exception()
+        task.add_done_callback(done)
+    # One connection closing shouldn't cancel the query for the others
+    return copy.deepcopy(await asyncio.shield(_IN_FLIGHT[key]))
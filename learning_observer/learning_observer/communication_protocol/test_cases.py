@@ -16,6 +16,7 @@ Test Cases:
     field_error         Prints the missing fields test case.
     malformed_key       Prints the malformed key test case.
     call_exception      Prints the func_except test case.
+    call_nested_error   Prints the nested error in a call result test case.
     join_error_key      Prints the nonexistent key in join test case.
     circular_error      Prints the circular error test case
     all                 Prints all available test cases.
@@ -55,6 +56,10 @@ def dummy_exception():
     raise Exception('This is an exception that was raised in a published function.')
 
 
+def dummy_partial_roster(course):
+    return [{'user_id': 'student-0'}, {'error': 'Could not fetch student-1'}]
+
+
 async def dummy_map(value, example):
     if value.endswith('2'):
         raise ValueError('Item ends with a 2')
@@ -64,12 +69,14 @@ async def dummy_map(value, example):
 DUMMY_FUNCTIONS = {
     "learning_observer.dummyroster": dummy_roster,
     "learning_observer.dummycall": dummy_exception,
-    "learning_observer.dummymap": dummy_map
+    "learning_observer.dummymap": dummy_map,
+    "learning_observer.dummypartialroster": dummy_partial_roster
 }
 
 course_roster = q.call('learning_observer.dummyroster')
 exception_func = q.call('learning_observer.dummycall')
 map_func = q.call('learning_observer.dummymap')
+partial_roster_func = q.call('learning_observer.dummypartialroster')
 
 TEST_DAG = {
     'execution_dag': {
@@ -81,6 +88,8 @@ TEST_DAG = {
         "field_error": q.select(q.keys('writing_observer.last_document', STUDENTS=q.variable("roster"), STUDENTS_path='user_id'), fields={'nonexistent_key': 'doc_id'}),
         "malformed_key_error": q.select([{'item': 1}, {'item': 2}], fields={'nonexistent_key': 'doc_id'}),
         "call_exception": exception_func(),
+        "partial_roster": partial_roster_func(course=q.parameter("course_id", required=True)),
+        "partial_roster_docs": q.select(q.keys('writing_observer.last_document', STUDENTS=q.variable("partial_roster"), STUDENTS_path='user_id'), fields={'document_id': 'doc_id'}),
         "join_key_error": q.join(LEFT=q.variable('docs'), LEFT_ON='nonexistent.value.path', RIGHT=q.variable('roster'), RIGHT_ON='user_id'),
         "circular_2": q.keys('writing_observer.last_document', STUDENTS=q.variable("circular_1"), STUDENTS_PATH='user_id'),
         "circular_1": q.variable("circular_2")
@@ -128,6 +137,13 @@ TEST_DAG = {
             'description': "Throw an exception within a published function",
             'expected': lambda x: isinstance(x, dict) and 'error' in x
         },
+        'call_nested_error': {
+            'returns': 'partial_roster_docs',
+            'parameters': ['course_id'],
+            'test_parameters': {'course_id': 123},
+            'description': 'A published function returns a list with an error in it, which we bubble up.',
+            'expected': lambda x: isinstance(x, dict) and x['error']['error_path'] == ['STUDENTS', 1]
+        },
         'join_key_error': {
             'returns': 'join_key_error',
             'parameters': [],
@@ -4,6 +4,8 @@ This generates dashboards from student data.
 
 import asyncio
 import copy
+import functools
+import hashlib
 import inspect
 import json
 import jsonschema
@@ -20,6 +22,8 @@ import learning_observer.synthetic_student_data as synthetic_student_data
 import learning_observer.stream_analytics.helpers as sa_helpers
 import learning_observer.kvs as kvs
 import learning_observer.runtime
+import learning_observer.delta
+import learning_observer.pubsub.key_changes
 
 import learning_observer.paths as paths
 
@@ -30,7 +34,9 @@ from learning_observer.log_event import debug_log
 
 import learning_observer.module_loader
 import learning_observer.communication_protocol.integration
+import learning_observer.communication_protocol.plan
 import learning_observer.communication_protocol.query
+import learning_observer.communication_protocol.query_cache
 import learning_observer.communication_protocol.schema
 import learning_observer.settings
 
@@ -155,8 +161,11 @@ async def generic_dashboard(request):
         while timeout() is not None and timeout() < 0:
             response = {}
             t, s = subscriptions.get()
-            for key, json_key in zip(s['ids'], s['keys']):
-                response[key] = await teacherkvs[key]
+            values = await sa_helpers.assemble_states(
+                teacherkvs, await teacherkvs.multiget(s['ids'])
+            )
+            for key, json_key, value in zip(s['ids'], s['keys'], values):
+                response[key] = value
                 if isinstance(response[key], dict):
                     response[key]['key'] = json_key
             response['subscription_id'] = s['subscription_id']
@@ -182,14 +191,45 @@ def fetch_student_state(
     '''
     teacherkvs = kvs.KVS()
 
+    # The roster doesn't change, so we work out which KVS keys we need
+    # for each student up front.
+    student_keys = []
+    for student in roster:
+        # TODO/HACK: Only do this for Google data. Make this do the right thing
+        # for synthetic data.
+        google_id = student['user_id']
+        if google_id.isnumeric():
+            student_id = learning_observer.auth.google_id_to_user_id(google_id)
+        else:
+            student_id = google_id
+        student_keys.append([
+            (
+                sa_helpers.fully_qualified_function_name(sa_module),
+                sa_helpers.make_key(
+                    sa_module,
+                    {sa_helpers.KeyField.STUDENT: student_id},
+                    sa_helpers.KeyStateType.EXTERNAL)
+            )
+            for sa_module in agg_module['sources']
+        ])
+    all_keys = [key for keys in student_keys for (name, key) in keys]
+    # The keys we read, so the dashboard can watch them for changes
+    keys_read = set(all_keys)
+    cleaner = agg_module.get("cleaner", lambda x: x)
+
     async def student_state_fetcher():
         '''
         Poll redis for student state. This should be abstracted out into a
         generic aggregator API, much like we have a reducer on the
         incoming end.
+
+        We fetch every student's data with one `multiget`, rather than
+        one read per student per reducer.
         '''
+        values = await teacherkvs.multiget(all_keys) if all_keys else []
+        values = iter(await sa_helpers.assemble_states(teacherkvs, values))
         students = []
-        for student in roster:
+        for student, keys in zip(roster, student_keys):
             student_state = {
                 # We're copying Google's roster format here.
                 #
@@ -212,33 +252,14 @@ def fetch_student_state(
 
             student_state.update(default_data)
 
-            # TODO/HACK: Only do this for Google data. Make this do the right thing
-            # for synthetic data.
-            google_id = student['user_id']
-            if google_id.isnumeric():
-                student_id = learning_observer.auth.google_id_to_user_id(google_id)
-            else:
-                student_id = google_id
-            # TODO: Evaluate whether this is a bottleneck.
-            #
-            # mget is faster than ~50 gets. But some online benchmarks show both taking
-            # microseconds, to where it might not matter.
-            #
-            # For most services (e.g. a SQL database), this would be a huge bottleneck. redis might
-            # be fast enough that it doesn't matter? Dunno.
-            for sa_module in agg_module['sources']:
-                key = sa_helpers.make_key(
-                    sa_module,
-                    {sa_helpers.KeyField.STUDENT: student_id},
-                    sa_helpers.KeyStateType.EXTERNAL)
-                data = await teacherkvs[key]
+            for (name, key), data in zip(keys, values):
                 # debug_log(key, data)  # <-- Useful, but a lot of stuff is spit out.
                 if data is not None:
-                    student_state[sa_helpers.fully_qualified_function_name(sa_module)] = data
-            cleaner = agg_module.get("cleaner", lambda x: x)
+                    student_state[name] = data
             students.append(cleaner(student_state))
 
         return students
+    setattr(student_state_fetcher, 'keys_read', keys_read)
     return student_state_fetcher
 
 
@@ -262,6 +283,239 @@ def find_course_aggregator(module_id):
     return (course_aggregator_module, default_data)
 
 
+# Dashboards re-run their queries when the student state they read
+# changes, but at most every `min_interval` seconds, and at least
+# every `full_refresh_interval` seconds, to pick up changes which
+# don't go through the KVS (such as rosters). These can be overridden
+# in the `dashboard_updates` section of the settings.
+#
+# We only hear about changes made in other processes if they're
+# forwarded over a pub-sub backend (see `pubsub.key_changes`). Without
+# that, by default, we re-run everything as often as dashboards used
+# to poll, so nothing is staler than it used to be.
+DEFAULT_MIN_UPDATE_INTERVAL = 1
+DEFAULT_FULL_REFRESH_INTERVAL = 30
+DEFAULT_POLL_INTERVAL = 3
+
+
+class DashboardUpdates:
+    '''
+    Decides when a dashboard connection should re-run its queries,
+    based on changes to the KVS keys they read (see
+    `pubsub.key_changes`).
+
+    `poll_interval` is how often the dashboard used to re-run
+    everything; without changes from other processes, we still do.
+    '''
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        config = learning_observer.settings.settings.get('dashboard_updates', {})
+        self.min_interval = config.get('min_interval', DEFAULT_MIN_UPDATE_INTERVAL)
+        if learning_observer.pubsub.key_changes.forwarding():
+            full_refresh_interval = DEFAULT_FULL_REFRESH_INTERVAL
+        else:
+            full_refresh_interval = poll_interval
+        self.full_refresh_interval = config.get('full_refresh_interval', full_refresh_interval)
+        self.subscription = learning_observer.pubsub.key_changes.subscribe()
+        self.changed = set()
+        self.last_run = None
+        self.last_full = None
+
+    def reset(self):
+        '''
+        Run everything from scratch next time (e.g. the client asked
+        for something new).
+        '''
+        self.last_full = None
+
+    def full_refresh_due(self):
+        return self.last_full is None or time.time() - self.last_full >= self.full_refresh_interval
+
+    def pop_changes(self):
+        '''
+        The keys which changed since we last ran, if it's been long
+        enough since we last ran. Otherwise, an empty set; the changes
+        wait for next time.
+        '''
+        self.changed.update(self.subscription.pop_changes())
+        if not self.changed or time.time() - self.last_run < self.min_interval:
+            return set()
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def ran(self, keys, full=True):
+        '''
+        We just ran the queries, which read `keys`.
+        '''
+        now = time.time()
+        self.last_run = now
+        if full:
+            self.last_full = now
+            self.changed = set()
+        self.subscription.watch(keys)
+
+    def close(self):
+        self.subscription.close()
+
+
+# Course aggregator dashboards, by (course, module, student filter,
+# roster), which one or more connections are watching
+COURSE_POLLERS = {}
+
+
+def roster_digest(roster):
+    '''
+    A short fingerprint of a roster, so connections only share data if
+    they fetched exactly the same roster.
+
+    >>> roster_digest([{'user_id': '1'}]) == roster_digest([{'user_id': '1'}])
+    True
+    >>> roster_digest([{'user_id': '1'}]) == roster_digest([{'user_id': '2'}])
+    False
+    '''
+    return hashlib.sha256(json.dumps(roster, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CoursePoller:
+    '''
+    Builds the data for one course aggregator dashboard (a course, a
+    module, and optionally a single student), and shares it between
+    every connection watching it, so a room of teachers looking at the
+    same course costs about as much as one.
+
+    Connections only share a poller if each of them fetched the same
+    roster, with their own credentials (it's part of the key), so
+    nobody sees data for students they couldn't see anyway.
+
+    The first connection to `subscribe` starts a task which re-fetches
+    the student data when it changes (see `DashboardUpdates`). If the
+    aggregator doesn't depend on each client's options, we aggregate
+    here too, and encode the payload once for everyone. The last
+    connection to `unsubscribe` stops the task.
+
+    Connections check `version` to see whether there's something new.
+
+    >>> async def lifecycle():
+    ...     make = lambda: CoursePoller(('c', 'm', None, 'r'), None, lambda runtime, sd: {}, 0.5)
+    ...     first = course_poller(('c', 'm', None, 'r'), make, 'runtime 1')
+    ...     second = course_poller(('c', 'm', None, 'r'), make, 'runtime 2')
+    ...     print(first is second, first.subscribers, first.runtime, first.task is not None)
+    ...     first.unsubscribe('runtime 1')
+    ...     print(first.subscribers, first.runtime, list(COURSE_POLLERS))
+    ...     first.unsubscribe('runtime 2')
+    ...     print(first.subscribers, first.task, COURSE_POLLERS)
+    >>> asyncio.run(lifecycle())
+    True 2 runtime 1 True
+    1 runtime 2 [('c', 'm', None, 'r')]
+    0 None {}
+    '''
+    def __init__(self, key, student_state_fetcher, aggregator, refresh):
+        self.key = key
+        self.student_state_fetcher = student_state_fetcher
+        self.aggregator = aggregator
+        self.refresh = refresh
+        self.per_connection = 'options' in inspect.getfullargspec(aggregator)[0]
+        # The runtime of each connection. Shared aggregation runs with
+        # the first one's, so when that connection goes away, we stop
+        # using its request (and its credentials).
+        self.runtimes = []
+        self.task = None
+        self.version = 0
+        self.student_data = None
+        self.data = None
+        self.payload = None
+
+    async def aggregate(self, runtime, student_data, client_data=None):
+        '''
+        Run the aggregator, and return the whole dashboard payload.
+        '''
+        # Prep the aggregator function to be called.
+        # Determine if we should pass the client_data in or not/async capability
+        # Currently options is a list of strings (what we want returned)
+        # In the futuer this should be some form of communication protocol
+        if self.per_connection:
+            agg = self.aggregator(runtime, student_data, client_data)
+        else:
+            agg = self.aggregator(runtime, student_data)
+        if inspect.iscoroutinefunction(self.aggregator):
+            agg = await agg
+        data = {
+            "student_data": student_data   # Per-student list
+        }
+        data.update(agg)
+        return data
+
+    async def poll(self):
+        updates = DashboardUpdates(poll_interval=self.refresh)
+        try:
+            while True:
+                if updates.full_refresh_due() or updates.pop_changes():
+                    try:
+                        student_data = await self.student_state_fetcher()
+                        if not self.per_connection:
+                            self.data = await self.aggregate(self.runtime, student_data)
+                            self.payload = json.dumps(self.data)
+                        self.student_data = student_data
+                        self.version += 1
+                    except Exception as e:
+                        # Try again next time, rather than leaving every
+                        # connection without updates
+                        debug_log("Could not update course dashboard", self.key, e)
+                    updates.ran(self.student_state_fetcher.keys_read)
+                await asyncio.sleep(self.refresh)
+        finally:
+            updates.close()
+
+    @property
+    def subscribers(self):
+        return len(self.runtimes)
+
+    @property
+    def runtime(self):
+        return self.runtimes[0] if self.runtimes else None
+
+    def subscribe(self, runtime):
+        self.runtimes.append(runtime)
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.poll())
+
+    def unsubscribe(self, runtime):
+        self.runtimes.remove(runtime)
+        if not self.runtimes:
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+            if COURSE_POLLERS.get(self.key) is self:
+                del COURSE_POLLERS[self.key]
+
+
+def course_poller(key, make_poller, runtime):
+    '''
+    Subscribe a connection (with its `runtime`) to the poller for
+    `key`, creating it with `make_poller()` if nobody else is watching.
+    Call `unsubscribe(runtime)` on it when done.
+    '''
+    if key not in COURSE_POLLERS:
+        COURSE_POLLERS[key] = make_poller()
+    poller = COURSE_POLLERS[key]
+    poller.subscribe(runtime)
+    return poller
+
+
+async def send_update(ws, encoder, data):
+    '''
+    Send `data` to a dashboard: whole, if `encoder` is `None`, or
+    otherwise as a patch against what we last sent (or nothing, if
+    nothing changed).
+    '''
+    if encoder is None:
+        await ws.send_json(data)
+        return
+    message = encoder.encode(data)
+    if message is not None:
+        await ws.send_json(message)
+
+
 @learning_observer.auth.teacher
 async def websocket_dashboard_view(request):
     '''
@@ -283,6 +537,8 @@ async def websocket_dashboard_view(request):
     resource_id = request.rel_url.query.get("resource", None)
     # How often do we refresh? Default is 0.5 seconds
     refresh = 0.5  # request.match_info.get('refresh', 0.5)
+    # Send patches rather than the whole payload? (see `delta.py`)
+    encoder = learning_observer.delta.DeltaEncoder() if learning_observer.delta.wants_delta(request) else None
 
     # Find the right module
     course_aggregator_module, default_data = find_course_aggregator(module_id)
@@ -293,11 +549,12 @@ async def websocket_dashboard_view(request):
         debug_log("Available modules: ", [available[key]['short_id'] for key in available])
         raise aiohttp.web.HTTPBadRequest(text="Invalid module: {}".format(module_id))
 
-    # We need to receive to detect web socket closures.
-    ws = aiohttp.web.WebSocketResponse(receive_timeout=0.1)
-    await ws.prepare(request)
-
+    # This is fetched with the teacher's own credentials, so it's also
+    # our check that they may see this course.
     roster = await rosters.courseroster(request, course_id)
+    if not isinstance(roster, list):
+        debug_log("Could not fetch roster: ", course_id, roster)
+        raise aiohttp.web.HTTPForbidden(text="Could not fetch the roster for course: {}".format(course_id))
 
     # If we're grabbing data for just one student, we filter the
     # roster down.  This pathway ensures we only serve data for
@@ -308,58 +565,71 @@ async def websocket_dashboard_view(request):
     # students.
     if student_id is not None:
         roster = [r for r in roster if r['user_id'] == student_id]
-    # Grab student list, and deliver to the client
-    student_state_fetcher = fetch_student_state(
-        course_id,
-        module_id,
-        course_aggregator_module,
-        roster,
-        default_data
-    )
-    aggregator = course_aggregator_module.get('aggregator', lambda x: {})
-    async_aggregator = inspect.iscoroutinefunction(aggregator)
-    args_aggregrator = inspect.getfullargspec(aggregator)[0]
-    client_data = None
+
+    # We need to receive to detect web socket closures.
+    ws = aiohttp.web.WebSocketResponse(receive_timeout=0.1)
+    await ws.prepare(request)
+
+    # Everyone watching this course (and module, and student), who got
+    # the same roster, shares one poller, which fetches the student data
+    key = (course_id, module_id, student_id, roster_digest(roster))
     runtime = learning_observer.runtime.Runtime(request)
 
-    while True:
-        sd = await student_state_fetcher()
-        data = {
-            "student_data": sd   # Per-student list
-        }
-        # Prep the aggregator function to be called.
-        # Determine if we should pass the client_data in or not/async capability
-        # Currently options is a list of strings (what we want returned)
-        # In the futuer this should be some form of communication protocol
-        if 'options' in args_aggregrator:
-            agg = aggregator(runtime, sd, client_data)
-        else:
-            agg = aggregator(runtime, sd)
-        if async_aggregator:
-            agg = await agg
-        data.update(agg)
-        await ws.send_json(data)
-        # First try to receive a json, if you receive something that can't be json'd
-        # check for closing, otherwise timeout will fire
-        # This is kind of an awkward block, but aiohttp doesn't detect
-        # when sockets close unless they receive data. We try to receive,
-        # and wait for an exception or a CLOSE message.
-        try:
-            client_data = await ws.receive_json()
-        except (TypeError, ValueError):
-            if (await ws.receive()).type == aiohttp.WSMsgType.CLOSE:
-                debug_log("Socket closed!")
-                # By this point, the client is long gone, but we want to
-                # return something to avoid confusing middlewares.
+    def make_poller():
+        return CoursePoller(
+            key,
+            fetch_student_state(
+                course_id,
+                module_id,
+                course_aggregator_module,
+                roster,
+                default_data
+            ),
+            course_aggregator_module.get('aggregator', lambda x: {}),
+            refresh
+        )
+    poller = course_poller(key, make_poller, runtime)
+    client_data = None
+    # The version of the poller's data we last sent
+    sent = 0
+
+    try:
+        while True:
+            if poller.version != sent:
+                sent = poller.version
+                if poller.per_connection:
+                    data = await poller.aggregate(runtime, poller.student_data, client_data)
+                    await send_update(ws, encoder, data)
+                elif encoder is None:
+                    # Encoded once, for every connection
+                    await ws.send_str(poller.payload)
+                else:
+                    await send_update(ws, encoder, poller.data)
+            # First try to receive a json, if you receive something that can't be json'd
+            # check for closing, otherwise timeout will fire
+            # This is kind of an awkward block, but aiohttp doesn't detect
+            # when sockets close unless they receive data. We try to receive,
+            # and wait for an exception or a CLOSE message.
+            try:
+                client_data = await ws.receive_json()
+                # New options, so we send everything again
+                sent = 0
+            except (TypeError, ValueError):
+                if (await ws.receive()).type == aiohttp.WSMsgType.CLOSE:
+                    debug_log("Socket closed!")
+                    # By this point, the client is long gone, but we want to
+                    # return something to avoid confusing middlewares.
+                    return aiohttp.web.Response(text="This never makes it back....")
+            except asyncio.exceptions.TimeoutError:
+                # This is the normal code path
+                pass
+            await asyncio.sleep(refresh)
+            # This never gets called, since we return above
+            if ws.closed:
+                debug_log("Socket closed. This should never appear, however.")
                 return aiohttp.web.Response(text="This never makes it back....")
-        except asyncio.exceptions.TimeoutError:
-            # This is the normal code path
-            pass
-        await asyncio.sleep(0.5)
-        # This never gets called, since we return above
-        if ws.closed:
-            debug_log("Socket closed. This should never appear, however.")
-            return aiohttp.web.Response(text="This never makes it back....")
+    finally:
+        poller.unsubscribe(runtime)
 
 
 # We use following functions to return an error message about the requested
@@ -456,7 +726,56 @@ async def dispatch_defined_execution_dag(dag, funcs):
 DAG_DISPATCH = {dict: dispatch_defined_execution_dag, str: dispatch_named_execution_dag}
 
 
-async def execute_queries(client_data, request):
+# Compiled plans for named execution DAGs, together with the DAGs they
+# depend on. Named DAGs don't change once modules are loaded, so we
+# only compile each one once.
+NAMED_EXECUTION_PLANS = {}
+
+
+def merge_dependent_dags(query, dependent_dags, execution_dags):
+    '''
+    Add the nodes from the DAGs `query` depends on, with fully qualified
+    names. We return a new query, leaving `query` (which may be one of
+    the module-level `execution_dags`) alone.
+    '''
+    merged = dict(query)
+    for dep in dependent_dags:
+        dep_dag = copy.deepcopy(execution_dags[dep]['execution_dag'])
+        prefixed_dag = fully_qualify_names_with_default_namespace(dep_dag, dep)
+        merged['execution_dag'] = {**merged['execution_dag'], **{f'{dep}.{k}': v for k, v in prefixed_dag.items()}}
+    return merged
+
+
+async def run_shared_query(key, query_func, parameters, states=None, query_name=None):
+    '''
+    Run a query through the shared query cache (see `query_cache`).
+    If we're given `states`, we keep the `ExecutionState` (our own
+    copy; see `query_cache`), so later runs can only re-run what
+    changed.
+
+    The state may come from another connection's run. That's safe: `key`
+    covers the DAG, exports, parameters, and auth scope, so the other
+    run had the same inputs, and states don't hold parameter values, so
+    we never pick up another connection's `runtime`.
+    '''
+    async def run_query():
+        state = learning_observer.communication_protocol.plan.ExecutionState()
+        return await query_func(state=state)(**parameters), state
+    output, state = await learning_observer.communication_protocol.query_cache.cached_query(key, run_query)
+    if states is not None:
+        states[query_name] = state
+    return output
+
+
+async def execute_queries(client_data, request, states=None, changed_keys=None):
+    '''
+    Run the queries in `client_data`.
+
+    Change-driven dashboards pass a dictionary, `states`, which we keep
+    each query's `ExecutionState` in. On later calls, they pass the KVS
+    keys which changed since, and we only re-run the parts of each
+    query which read them (or depend on ones which did).
+    '''
     execution_dags = learning_observer.module_loader.execution_dags()
     funcs = []
     # client_data = {
@@ -478,26 +797,46 @@ async def execute_queries(client_data, request):
         if query is None:
             continue
 
-        # NOTE dependent dags only work for on a single level dependency
-        # TODO allow multiple layers of dependency among dags
-        dependent_dags = extract_namespaced_dags(query['execution_dag'])
-        missing_dags = dependent_dags - execution_dags.keys()
-        if missing_dags:
-            debug_log(await dag_not_found(missing_dags))
-            funcs.append(dag_not_found(missing_dags))
-            continue
-        for dep in dependent_dags:
-            dep_dag = copy.deepcopy(execution_dags[dep]['execution_dag'])
-            prefixed_dag = fully_qualify_names_with_default_namespace(dep_dag, dep)
-            query['execution_dag'] = {**query['execution_dag'], **{f'{dep}.{k}': v for k, v in prefixed_dag.items()}}
+        plan = NAMED_EXECUTION_PLANS.get(dag) if isinstance(dag, str) else None
+        if plan is None:
+            # NOTE dependent dags only work for on a single level dependency
+            # TODO allow multiple layers of dependency among dags
+            dependent_dags = extract_namespaced_dags(query['execution_dag'])
+            missing_dags = dependent_dags - execution_dags.keys()
+            if missing_dags:
+                debug_log(await dag_not_found(missing_dags))
+                funcs.append(dag_not_found(missing_dags))
+                continue
+            if isinstance(dag, str) and not dependent_dags:
+                plan = learning_observer.module_loader.execution_plans()[dag]
+            else:
+                plan = learning_observer.communication_protocol.plan.ExecutionPlan(
+                    merge_dependent_dags(query, dependent_dags, execution_dags),
+                    name=dag if isinstance(dag, str) else None
+                )
+            if isinstance(dag, str):
+                NAMED_EXECUTION_PLANS[dag] = plan
 
         target_exports = client_query.get('target_exports', [])
-        query_func = learning_observer.communication_protocol.integration.prepare_dag_execution(query, target_exports)
-        client_parameters = client_query.get('kwargs', {})
+        query_func = functools.partial(
+            learning_observer.communication_protocol.integration.prepare_dag_execution,
+            plan, target_exports
+        )
+        client_parameters = dict(client_query.get('kwargs', {}))
+        # Other connections running the same query (e.g. other tabs
+        # open on the same course) share the result
+        key = learning_observer.communication_protocol.query_cache.query_key(
+            dag, target_exports, client_parameters,
+            learning_observer.communication_protocol.query_cache.auth_scope(request)
+        )
         runtime = learning_observer.runtime.Runtime(request)
         client_parameters['runtime'] = runtime
-        query_func = query_func(**client_parameters)
-        funcs.append(query_func)
+        state = states.get(query_name) if states is not None else None
+        if state is not None and changed_keys is not None:
+            state.invalidate(plan, changed_keys)
+            funcs.append(query_func(state=state)(**client_parameters))
+        else:
+            funcs.append(run_shared_query(key, query_func, client_parameters, states, query_name))
     return await asyncio.gather(*funcs, return_exceptions=False)
 
 
@@ -516,32 +855,53 @@ async def websocket_dashboard_handler(request):
     ws = aiohttp.web.WebSocketResponse(receive_timeout=0.3)
     await ws.prepare(request)
     client_data = None
+    # Send patches rather than the whole payload? (see `delta.py`)
+    encoder = learning_observer.delta.DeltaEncoder() if learning_observer.delta.wants_delta(request) else None
+    # We re-run queries when the KVS keys they read change
+    updates = DashboardUpdates()
+    states = {}
 
-    while True:
-        try:
-            client_data = await ws.receive_json()
-            # TODO we should validate the client_data structure
-        except (TypeError, ValueError):
-            # these Errors may signal a close
-            if (await ws.receive()).type == aiohttp.WSMsgType.CLOSE:
-                debug_log("Socket closed!")
+    try:
+        while True:
+            try:
+                client_data = await ws.receive_json()
+                # TODO we should validate the client_data structure
+                # New queries, so we start over
+                updates.reset()
+                if encoder is not None:
+                    encoder.reset()
+            except (TypeError, ValueError):
+                # these Errors may signal a close
+                if (await ws.receive()).type == aiohttp.WSMsgType.CLOSE:
+                    debug_log("Socket closed!")
+                    return aiohttp.web.Response()
+            except asyncio.exceptions.TimeoutError:
+                # this is the normal path of the code
+                # if the client_data hasn't been set, keep waiting for it
+                if client_data is None:
+                    continue
+
+            if ws.closed:
+                debug_log("Socket closed.")
                 return aiohttp.web.Response()
-        except asyncio.exceptions.TimeoutError:
-            # this is the normal path of the code
-            # if the client_data hasn't been set, keep waiting for it
-            if client_data is None:
-                continue
 
-        if ws.closed:
-            debug_log("Socket closed.")
-            return aiohttp.web.Response()
+            # The receive timeout paces this loop. Most of the time,
+            # nothing changed, and there's nothing to do.
+            if updates.full_refresh_due():
+                states = {}
+                changed_keys = None
+            else:
+                changed_keys = updates.pop_changes()
+                if not changed_keys:
+                    continue
 
-        outputs = await execute_queries(client_data, request)
+            outputs = await execute_queries(client_data, request, states=states, changed_keys=changed_keys)
+            updates.ran(set().union(*[state.keys() for state in states.values()]), full=changed_keys is None)
 
-        await ws.send_json({q: v for q, v in zip(client_data.keys(), outputs)})
-        # TODO allow the client to set the update timer.
-        # it would be cool if the client could set different sleep timers for each item
-        await asyncio.sleep(3)
+            data = {q: v for q, v in zip(client_data.keys(), outputs)}
+            await send_update(ws, encoder, data)
+    finally:
+        updates.close()
 
 
 # Obsolete code -- we should put this back in after our refactor. Allows us to use
@@ -0,0 +1,175 @@
+'''
+Delta-encoded dashboard updates.
+
+Dashboards poll the server every second or so, and, most of the time,
+most of the data (e.g. whole essays) hasn't changed since the last
+update. Rather than resending everything, we can keep what we last
+sent over each websocket, and send a JSON patch (RFC 6902, although we
+only use `add`, `remove`, and `replace`) with the changes. If nothing
+changed, we send nothing.
+
+Every message has a sequence number. Every so often, we send the whole
+payload again, so a client which got confused (or missed something)
+gets back in sync. Messages look like:
+
+    {"type": "full", "seq": 0, "data": {...}}
+    {"type": "patch", "seq": 1, "patch": [{"op": "replace", "path": "/a/0", "value": 2}, ...]}
+
+The matching client code is in `communication_protocol/query.js`.
+Dash dashboards get delta-encoded updates by default: their
+`LOConnection` (in `lo_dash_react_components`) decodes them.
+
+>>> old = {'students': [{'text': 'Hello', 'id': 1}], 'count': 1}
+>>> new = {'students': [{'text': 'Hello world', 'id': 1}], 'count': 1, 'x/y': True}
+>>> patch = diff(old, new)
+>>> patch
+[{'op': 'replace', 'path': '/students/0/text', 'value': 'Hello world'}, {'op': 'add', 'path': '/x~1y', 'value': True}]
+>>> apply_patch(old, patch) == new
+True
+'''
+
+import json
+import time
+
+
+# How often (in seconds) we resend the whole payload, even if we could
+# send a patch.
+DELTA_RESYNC_INTERVAL = 60
+
+
+def escape_pointer(key):
+    '''
+    Escape a key for use in a JSON pointer (RFC 6901).
+    '''
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def unescape_pointer(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def diff(old, new, path=''):
+    '''
+    A list of patch operations which turn `old` into `new`. Both should
+    be plain JSON (dicts, lists, strings, numbers, booleans, and
+    `None`).
+
+    Lists of the same length are compared item-by-item. Lists which
+    changed length are replaced whole: dashboards mostly have lists of
+    students, which rarely change length.
+
+    >>> diff([1, 2, 3], [1, 5, 3])
+    [{'op': 'replace', 'path': '/1', 'value': 5}]
+    >>> diff({'a': 1, 'b': 2}, {'a': 1})
+    [{'op': 'remove', 'path': '/b'}]
+    >>> diff({'a': [1]}, {'a': [1, 2]})
+    [{'op': 'replace', 'path': '/a', 'value': [1, 2]}]
+    >>> diff({'a': 1}, {'a': 1})
+    []
+    '''
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+        for key in old:
+            if key not in new:
+                patch.append({'op': 'remove', 'path': f'{path}/{escape_pointer(key)}'})
+        for key, value in new.items():
+            child_path = f'{path}/{escape_pointer(key)}'
+            if key not in old:
+                patch.append({'op': 'add', 'path': child_path, 'value': value})
+            else:
+                patch.extend(diff(old[key], value, child_path))
+        return patch
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        patch = []
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            patch.extend(diff(old_item, new_item, f'{path}/{index}'))
+        return patch
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+def apply_patch(document, patch):
+    '''
+    Apply a patch from `diff` to `document`, in place where possible.
+    Returns the new document (which is a different object if the whole
+    document was replaced).
+
+    >>> apply_patch({'a': [1, 2]}, [{'op': 'replace', 'path': '/a/1', 'value': 3}])
+    {'a': [1, 3]}
+    >>> apply_patch({'a': 1}, [{'op': 'replace', 'path': '', 'value': 5}])
+    5
+    '''
+    for operation in patch:
+        if operation['path'] == '':
+            document = operation['value']
+            continue
+        tokens = [unescape_pointer(token) for token in operation['path'].split('/')[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        last = int(tokens[-1]) if isinstance(parent, list) else tokens[-1]
+        if operation['op'] == 'remove':
+            del parent[last]
+        else:
+            parent[last] = operation['value']
+    return document
+
+
+class DeltaEncoder:
+    '''
+    Turns a series of payloads, for one websocket, into messages: the
+    first payload is sent whole, then patches, and every
+    `resync_interval` seconds, the whole payload again. `encode` returns
+    `None` when there's nothing to send.
+
+    >>> encoder = DeltaEncoder()
+    >>> encoder.encode({'a': 1})
+    {'type': 'full', 'seq': 0, 'data': {'a': 1}}
+    >>> encoder.encode({'a': 1}) is None
+    True
+    >>> encoder.encode({'a': 2})
+    {'type': 'patch', 'seq': 1, 'patch': [{'op': 'replace', 'path': '/a', 'value': 2}]}
+    >>> encoder.reset()
+    >>> encoder.encode({'a': 2})['type']
+    'full'
+    '''
+    def __init__(self, resync_interval=DELTA_RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.seq = -1
+        self.reset()
+
+    def reset(self):
+        '''
+        Send the whole payload next time (e.g. if what the client asked
+        for changed).
+        '''
+        self.last = None
+        self.last_full = None
+
+    def encode(self, payload):
+        # We keep a copy of what we sent, in plain JSON (no tuples, etc.),
+        # so we compare like with like, and so later changes to
+        # `payload` don't change our copy.
+        payload = json.loads(json.dumps(payload))
+        now = time.time()
+        if self.last_full is None or now - self.last_full > self.resync_interval:
+            self.last = payload
+            self.last_full = now
+            self.seq += 1
+            return {'type': 'full', 'seq': self.seq, 'data': payload}
+        patch = diff(self.last, payload)
+        if not patch:
+            return None
+        self.last = payload
+        self.seq += 1
+        return {'type': 'patch', 'seq': self.seq, 'patch': patch}
+
+
+def wants_delta(request):
+    '''
+    Clients opt in to delta-encoded updates with `?delta=true` on the
+    websocket URL. Older clients get the whole payload every time, as
+    before.
+    '''
+    return request.rel_url.query.get('delta', 'false').lower() in ('1', 'true', 'yes')
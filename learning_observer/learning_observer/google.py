@@ -22,16 +22,19 @@ analysis.
 '''
 
 import collections
+import copy
 import itertools
 import json
 import recordclass
 import string
 import re
+import time
 
 import aiohttp
 import aiohttp.web
 
 import learning_observer.settings as settings
+import learning_observer.http_client
 import learning_observer.log_event
 import learning_observer.util
 import learning_observer.auth
@@ -101,6 +104,9 @@ ENDPOINTS = list(map(lambda x: Endpoint(*x), [
     ("drive_revisions", "https://www.googleapis.com/drive/v3/files/{documentId}/revisions")
 ]))
 
+# Endpoint names, by URL
+ENDPOINT_NAMES = {endpoint.remote_url: endpoint.name for endpoint in ENDPOINTS}
+
 
 def extract_parameters_from_format_string(format_string):
     '''
@@ -115,6 +121,163 @@ def extract_parameters_from_format_string(format_string):
     return [f[1] for f in string.Formatter().parse(format_string) if f[1] is not None]
 
 
+# We keep Google's responses, with their `ETag` and `Last-Modified`
+# headers. For a while after we fetch something (`ttl`, in seconds),
+# we just reuse it. After that, we ask Google whether it changed
+# (a conditional request), and if it didn't, reuse it again, which
+# costs much less quota and bandwidth than fetching it again. Course
+# lists rarely change; documents change constantly, so we always check
+# those. Rosters are already cached in `rosters.py`, which decides how
+# fresh they are, so we always check those too rather than stacking a
+# second TTL on top. TTLs can be overridden, by endpoint name, under
+# `ttl` in a `google_cache` section of the settings. We keep at most
+# `max_entries` responses, and at most `max_bytes` (as Google sent
+# them) in all; documents can be large.
+DEFAULT_GOOGLE_CACHE_TTLS = {
+    'course_list': 300,
+    'course_roster': 0,
+    'course_work': 60,
+    'coursework_materials': 60,
+    'course_topics': 300,
+    'drive_about': 300,
+}
+DEFAULT_GOOGLE_CACHE_TTL = 0
+DEFAULT_GOOGLE_CACHE_MAX_ENTRIES = 1000
+DEFAULT_GOOGLE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# Responses, by user and URL, as `(user_id, url): GoogleResponse`,
+# least recently used first
+_GOOGLE_RESPONSES = collections.OrderedDict()
+# ... and their total size, in bytes
+_GOOGLE_RESPONSE_BYTES = 0
+
+GoogleResponse = collections.namedtuple('GoogleResponse', ['fetched', 'etag', 'last_modified', 'response', 'size'])
+
+
+def google_cache_settings():
+    if settings.settings is None:
+        return {}
+    return settings.settings.get('google_cache', {})
+
+
+def google_cache_ttl(target_url):
+    '''
+    How long we reuse responses from `target_url` (an endpoint URL, with
+    the parameters not yet filled in) without asking Google.
+    '''
+    name = ENDPOINT_NAMES.get(target_url)
+    ttls = dict(DEFAULT_GOOGLE_CACHE_TTLS)
+    ttls.update(google_cache_settings().get('ttl', {}))
+    return ttls.get(name, DEFAULT_GOOGLE_CACHE_TTL)
+
+
+def _drop_google_response(key):
+    global _GOOGLE_RESPONSE_BYTES
+    cached = _GOOGLE_RESPONSES.pop(key, None)
+    if cached is not None:
+        _GOOGLE_RESPONSE_BYTES -= cached.size
+
+
+def cache_google_response(key, resp, response, size, ttl):
+    '''
+    Keep a response (`size` bytes, as sent), if Google gave us a way to
+    revalidate it, or we'll reuse it for a while anyway.
+    '''
+    global _GOOGLE_RESPONSE_BYTES
+    _drop_google_response(key)
+    etag = resp.headers.get('ETag')
+    last_modified = resp.headers.get('Last-Modified')
+    if etag is None and last_modified is None and not ttl:
+        return
+    config = google_cache_settings()
+    max_entries = config.get('max_entries', DEFAULT_GOOGLE_CACHE_MAX_ENTRIES)
+    max_bytes = config.get('max_bytes', DEFAULT_GOOGLE_CACHE_MAX_BYTES)
+    if size > max_bytes:
+        return
+    _GOOGLE_RESPONSES[key] = GoogleResponse(time.time(), etag, last_modified, response, size)
+    _GOOGLE_RESPONSE_BYTES += size
+    while len(_GOOGLE_RESPONSES) > max_entries or _GOOGLE_RESPONSE_BYTES > max_bytes:
+        _drop_google_response(next(iter(_GOOGLE_RESPONSES)))
+
+
+def invalidate_google_cache(endpoint, user_id=None, **kwargs):
+    '''
+    Forget cached responses from the endpoint called `endpoint` (see
+    `ENDPOINTS`): for one user, or (by default) everyone, and for the
+    parameters given (e.g. `courseId`), or any. E.g.
+    `rosters.invalidate_roster_cache` uses this, so the next roster
+    fetch can't be answered from here.
+    '''
+    remote_url = next(e.remote_url for e in ENDPOINTS if e.name == endpoint)
+    pattern = re.compile("".join(
+        re.escape(literal) + (
+            '' if field is None
+            else re.escape(str(kwargs[field])) if kwargs.get(field) is not None
+            else '[^/?]+'
+        )
+        for literal, field, spec, conversion in string.Formatter().parse(remote_url)
+    ))
+    for key in list(_GOOGLE_RESPONSES):
+        if pattern.fullmatch(key[1]) and (user_id is None or key[0] == user_id):
+            _drop_google_response(key)
+
+
+async def fetch_google_response(client, url, headers, response_key, ttl):
+    '''
+    GET `url` from Google with `client`, using the response we cached
+    under `response_key` if it's less than `ttl` seconds old, or if
+    Google tells us it hasn't changed. Returns the response, and
+    whether it's one we hadn't seen (as opposed to one we had).
+
+    >>> import asyncio
+    >>> class Response:  # The parts of an `aiohttp` response we use
+    ...     def __init__(self, status, body):
+    ...         self.status, self.body, self.headers = status, body, {'ETag': '"v1"'}
+    ...     async def read(self):
+    ...         return self.body
+    ...     async def __aenter__(self):
+    ...         return self
+    ...     async def __aexit__(self, *args):
+    ...         pass
+    >>> class Google:
+    ...     def get(self, url, headers):
+    ...         if headers.get('If-None-Match') == '"v1"':
+    ...             return Response(304, b'')
+    ...         return Response(200, b'{"title": "Essay"}')
+    >>> async def fetch_twice():
+    ...     key = ('doctest', 'https://docs.googleapis.com/v1/documents/doctest')
+    ...     first = await fetch_google_response(Google(), key[1], {}, key, ttl=0)
+    ...     second = await fetch_google_response(Google(), key[1], {}, key, ttl=0)
+    ...     _drop_google_response(key)
+    ...     return first, second
+    >>> asyncio.run(fetch_twice())
+    (({'title': 'Essay'}, True), ({'title': 'Essay'}, False))
+    '''
+    cached = _GOOGLE_RESPONSES.get(response_key)
+    headers = dict(headers)
+    if cached is not None:
+        _GOOGLE_RESPONSES.move_to_end(response_key)
+        if time.time() - cached.fetched < ttl:
+            return cached.response, False
+        if cached.etag is not None:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified is not None:
+            headers['If-Modified-Since'] = cached.last_modified
+
+    async with client.get(url, headers=headers) as resp:
+        if resp.status == 304 and cached is not None:
+            # Not modified
+            _GOOGLE_RESPONSES[response_key] = cached._replace(fetched=time.time())
+            return cached.response, False
+        body = await resp.read()
+        response = json.loads(body)
+        if resp.status == 200:
+            cache_google_response(response_key, resp, response, len(body), ttl)
+        else:
+            _drop_google_response(response_key)
+        return response, True
+
+
 async def raw_google_ajax(runtime, target_url, **kwargs):
     '''
     Make an AJAX call to Google, managing auth + auth.
@@ -122,6 +285,9 @@ async def raw_google_ajax(runtime, target_url, **kwargs):
     * runtime is a Runtime class containing request information.
     * default_url is typically grabbed from ENDPOINTS
     * ... and we pass the named parameters
+
+    Responses are cached per user, and revalidated with conditional
+    requests (see `DEFAULT_GOOGLE_CACHE_TTLS`).
     '''
     request = runtime.get_request()
     url = target_url.format(**kwargs)
@@ -133,18 +299,28 @@ async def raw_google_ajax(runtime, target_url, **kwargs):
                 json.loads(value),
                 GOOGLE_TO_SNAKE
             )
-    async with aiohttp.ClientSession(loop=request.app.loop) as client:
-        if 'auth_headers' not in request:
-            raise aiohttp.web.HTTPUnauthorized(text="Please log in")  # TODO: Consistent way to flag this
-        async with client.get(url, headers=request["auth_headers"]) as resp:
-            response = await resp.json()
-            learning_observer.log_event.log_ajax(target_url, response, request)
-            if settings.feature_flag('use_google_ajax') is not None:
-                await cache.set(cache_key, json.dumps(response, indent=2))
-            return learning_observer.util.translate_json_keys(
-                response,
-                GOOGLE_TO_SNAKE
-            )
+    if 'auth_headers' not in request:
+        raise aiohttp.web.HTTPUnauthorized(text="Please log in")  # TODO: Consistent way to flag this
+
+    # What one user may see, another may not, so each user has their own
+    # cached responses.
+    user = request.get('user') or {}
+    response, new = await fetch_google_response(
+        learning_observer.http_client.client_session('google'),
+        url,
+        request["auth_headers"],
+        (user.get('user_id'), url),
+        google_cache_ttl(target_url)
+    )
+    # We already logged (and saved) responses we've seen before
+    if new:
+        learning_observer.log_event.log_ajax(target_url, response, request)
+        if settings.feature_flag('use_google_ajax') is not None:
+            await cache.set(cache_key, json.dumps(response, indent=2))
+    return learning_observer.util.translate_json_keys(
+        copy.deepcopy(response),
+        GOOGLE_TO_SNAKE
+    )
 
 
 def raw_access_partial(remote_url, name=None):
@@ -0,0 +1,118 @@
+'''
+Shared HTTP client sessions, for calls out to Google, LanguageTool, and
+similar.
+
+An `aiohttp.ClientSession` holds a pool of connections. Creating one
+per request means a new connection (and TLS handshake) for every call,
+so instead, we keep one session per service for the life of the
+server, and close them all on shutdown.
+
+Limits and timeouts can be set in the `http_client` section of the
+settings, for all sessions, and overridden per session under
+`sessions`:
+
+    http_client:
+        limit: 100
+        limit_per_host: 10
+        timeout: 30
+        sessions:
+            languagetool:
+                timeout: 120
+'''
+import asyncio
+
+import aiohttp
+
+import learning_observer.settings
+
+
+# Defaults. `limit` is how many connections a session keeps open at
+# once, in all; `limit_per_host` is how many to any one host.
+# `keepalive_timeout` is how long idle connections stay open. Timeouts
+# are in seconds: `timeout` for a whole request, and `connect_timeout`
+# for making a connection.
+DEFAULT_LIMIT = 100
+DEFAULT_LIMIT_PER_HOST = 10
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+DEFAULT_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# Defaults for particular sessions, which the settings override.
+# LanguageTool can take minutes on a long essay, so it keeps aiohttp's
+# old default (five minutes) for a whole request.
+DEFAULT_SESSION_SETTINGS = {
+    'languagetool': {
+        'timeout': 300
+    }
+}
+
+# Sessions, as `name: (event loop, session)`
+_SESSIONS = {}
+
+
+def session_settings(name):
+    '''
+    Settings for the session called `name`: the built-in defaults for
+    it (see `DEFAULT_SESSION_SETTINGS`), overridden by the settings for
+    all sessions, and then by those for this one.
+
+    >>> saved_settings = learning_observer.settings.settings
+    >>> learning_observer.settings.settings = {'http_client': {'limit': 50}}
+    >>> session_settings('languagetool')
+    {'timeout': 300, 'limit': 50}
+    >>> learning_observer.settings.settings = {'http_client': {'timeout': 60}}
+    >>> session_settings('languagetool')
+    {'timeout': 60}
+    >>> learning_observer.settings.settings = saved_settings
+    '''
+    config = dict(DEFAULT_SESSION_SETTINGS.get(name, {}))
+    if learning_observer.settings.settings is not None:
+        settings = dict(learning_observer.settings.settings.get('http_client', {}))
+        overrides = settings.pop('sessions', {}).get(name, {})
+        config.update(settings)
+        config.update(overrides)
+    return config
+
+
+def client_session(name='default'):
+    '''
+    The shared session called `name`, creating it if need be. Don't
+    close it, or use it as a context manager; use it as:
+
+        async with client_session('google').get(url) as resp:
+            ...
+    '''
+    loop = asyncio.get_running_loop()
+    if name in _SESSIONS:
+        session_loop, session = _SESSIONS[name]
+        # Scripts may run several event loops, one after another
+        if session_loop is loop and not session.closed:
+            return session
+    config = session_settings(name)
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=config.get('limit', DEFAULT_LIMIT),
+            limit_per_host=config.get('limit_per_host', DEFAULT_LIMIT_PER_HOST),
+            keepalive_timeout=config.get('keepalive_timeout', DEFAULT_KEEPALIVE_TIMEOUT)
+        ),
+        timeout=aiohttp.ClientTimeout(
+            total=config.get('timeout', DEFAULT_TIMEOUT),
+            connect=config.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        )
+    )
+    _SESSIONS[name] = (loop, session)
+    return session
+
+
+async def close_client_sessions(app=None):
+    '''
+    Close all of our sessions. This is an aiohttp cleanup handler: add
+    it to `app.on_cleanup`.
+    '''
+    loop = asyncio.get_running_loop()
+    sessions = list(_SESSIONS.values())
+    _SESSIONS.clear()
+    for session_loop, session in sessions:
+        # Sessions from event loops which have finished can't be closed
+        if session_loop is loop and not session.closed:
+            await session.close()
@@ -56,6 +56,25 @@ def compile_server_data(request):
     }
 
 
+def log_reducer_exception(parsed_message, exception):
+    '''
+    A reducer failed. We print the traceback, and save it with the event
+    which caused it into a critical error file for later debugging.
+    '''
+    traceback.print_exception(type(exception), exception, exception.__traceback__)
+    formatted_traceback = "".join(traceback.format_exception(
+        type(exception), exception, exception.__traceback__
+    ))
+    filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
+        ts=datetime.datetime.now().isoformat(),
+        rnd=uuid.uuid4().hex
+    ))
+    with open(filename, "w") as fp:
+        fp.write(json.dumps(parsed_message, sort_keys=True, indent=2))
+        fp.write("\nTraceback:\n")
+        fp.write(formatted_traceback)
+
+
 async def student_event_pipeline(metadata):
     '''
     Create an event pipeline, based on header metadata
@@ -90,64 +109,145 @@ async def student_event_pipeline(metadata):
 
     analytics_modules = await asyncio.gather(*[prepare_reducer(am) for am in analytics_modules])
 
-    async def pipeline(parsed_message):
+    # Most reducers only care about a few event types. We build a dispatch
+    # table from event type to the reducers which handle it, so that for
+    # each event, we skip irrelevant reducers (and their KVS reads)
+    # entirely. Reducers without an `events` filter see everything. We
+    # keep registration order within each list.
+    catch_all_modules = [am for am in analytics_modules if am.get('events') is None]
+    event_dispatch = {}
+    for event_type in set().union(*[am['events'] for am in analytics_modules if am.get('events') is not None]):
+        event_dispatch[event_type] = [
+            am for am in analytics_modules
+            if am.get('events') is None or event_type in am['events']
+        ]
+
+    def reducer_event_fields(am, parsed_message):
+        '''
+        Pull the fields a reducer's scope asks for out of the event. We
+        return `None` if the event is missing any of them, in which case
+        the reducer should skip the event.
+        '''
+        debug_log("Scope", am['scope'])
+        event_fields = {}
+        skip = False
+        for field in am['scope']:
+            if isinstance(field, learning_observer.stream_analytics.helpers.EventField):
+                debug_log("event", parsed_message)
+                debug_log("field", field)
+                client_event = parsed_message.get('client', {})
+                if field.event not in client_event:
+                    debug_log(field.event, "not found")
+                    skip = True
+                event_fields[field.event] = client_event.get(field.event)
+        if skip:
+            return None
+        debug_log("args", event_fields)
+        return event_fields
+
+    async def run_reducer(am, items):
+        '''
+        Run a list of `(event, event_fields)` pairs through one reducer.
+        Reducers built with `kvs_pipeline` take the whole list at once,
+        so each of their keys is read and written once. Anything else
+        gets the events one at a time.
+        '''
+        reducer_partial = am['reducer_partial']
+        if hasattr(reducer_partial, 'process_events'):
+            return await reducer_partial.process_events(items)
+        return [await reducer_partial(event, event_fields) for event, event_fields in items]
+
+    async def process_batch(parsed_messages):
         '''
         And this is the pipeline itself. It takes messages, processes them,
         and, optionally, will inform consumers when there is new data (disabled
         in the current code, since we use polling).
+
+        We take a list of messages (a micro-batch; often, just one). Each
+        reducer gets all of the messages it cares about in one go.
         '''
-        if type(parsed_message) is not dict:
-            raise ValueError(f"Expected a dict, got {type(parsed_message)}")
-        if 'client' not in parsed_message:
-            raise ValueError("Expected a dict with a 'client' field")
-        if 'event' not in parsed_message['client']:
-            raise ValueError("Expected a dict with a 'client' field with an 'event' field")
-
-        debug_log("Processing message {event} from {source}".format(
-            event=parsed_message["client"]["event"], source=client_source
-        ))
-
-        # Try to run a message through all event processors.
-        #
-        # To do: Finer-grained exception handling. Right now, if we break, we
-        # don't even run through the remaining processors.
-        try:
-            processed_analytics = []
-            # Go through all the analytics modules
-            for am in analytics_modules:
-                debug_log("Scope", am['scope'])
-                event_fields = {}
-                skip = False
-                for field in am['scope']:
-                    if isinstance(field, learning_observer.stream_analytics.helpers.EventField):
-                        debug_log("event", parsed_message)
-                        debug_log("field", field)
-                        client_event = parsed_message.get('client', {})
-                        if field.event not in client_event:
-                            debug_log(field.event, "not found")
-                            skip = True
-                        event_fields[field.event] = client_event.get(field.event)
-                if not skip:
-                    debug_log("args", event_fields)
-                    processed_analytics.append(await am['reducer_partial'](parsed_message, event_fields))
-        except Exception as e:
-            traceback.print_exc()
-            filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
-                ts=datetime.datetime.now().isoformat(),
-                rnd=uuid.uuid4().hex
+        for parsed_message in parsed_messages:
+            if type(parsed_message) is not dict:
+                raise ValueError(f"Expected a dict, got {type(parsed_message)}")
+            if 'client' not in parsed_message:
+                raise ValueError("Expected a dict with a 'client' field")
+            if 'event' not in parsed_message['client']:
+                raise ValueError("Expected a dict with a 'client' field with an 'event' field")
+
+            debug_log("Processing message {event} from {source}".format(
+                event=parsed_message["client"]["event"], source=client_source
             ))
-            fp = open(filename, "w")
-            fp.write(json.dumps(parsed_message, sort_keys=True, indent=2))
-            fp.write("\nTraceback:\n")
-            fp.write(traceback.format_exc())
-            fp.close()
-            if settings.RUN_MODE == settings.RUN_MODES.DEV:
-                raise
+
+        # Work out which messages go to which reducers, keeping messages
+        # in order within each reducer.
+        work = {}
+        for parsed_message in parsed_messages:
+            event_type = parsed_message['client']['event']
+            for am in event_dispatch.get(event_type, catch_all_modules):
+                event_fields = reducer_event_fields(am, parsed_message)
+                if event_fields is not None:
+                    work.setdefault(id(am), (am, []))[1].append((parsed_message, event_fields))
+
+        # Run the messages through all relevant event processors.
+        #
+        # Each reducer has its own keys, so reducers are independent of
+        # each other, and we run them concurrently. Per-event latency is
+        # then the slowest reducer, rather than the sum of all of them.
+        # Each reducer still sees events for a session in order.
+        #
+        # An exception in one reducer does not stop the others.
+        results = await asyncio.gather(
+            *[run_reducer(am, items) for am, items in work.values()],
+            return_exceptions=True
+        )
+        processed_analytics = []
+        exceptions = []
+        for (am, items), result in zip(work.values(), results):
+            if isinstance(result, learning_observer.stream_analytics.helpers.ReducerFailure):
+                # Only some keys failed. Log just their events, and keep
+                # the rest.
+                for events, exception in result.failures:
+                    log_reducer_exception(events, exception)
+                exceptions.append(result)
+                processed_analytics.extend(result.external_states)
+            elif isinstance(result, BaseException):
+                # `gather` also hands back cancellations, which aren't
+                # `Exception`s
+                log_reducer_exception([event for event, event_fields in items], result)
+                exceptions.append(result)
+            else:
+                processed_analytics.extend(result)
+        if exceptions and settings.RUN_MODE == settings.RUN_MODES.DEV:
+            raise exceptions[0]
         return processed_analytics
+
+    async def pipeline(parsed_message):
+        '''
+        Process a single message. See `process_batch`.
+        '''
+        return await process_batch([parsed_message])
+
+    async def flush():
+        '''
+        Write back any state reducers are holding in memory (see
+        `write_behind` in `kvs_pipeline`). This should be called when
+        the session ends.
+        '''
+        await asyncio.gather(*[
+            am['reducer_partial'].flush()
+            for am in analytics_modules
+            if hasattr(am['reducer_partial'], 'flush')
+        ])
+
+    setattr(pipeline, 'flush', flush)
+    setattr(pipeline, 'process_batch', process_batch)
     return pipeline
 
 COUNTER = 0
 
+# The most events we'll put into one micro-batch, by default.
+EVENT_BATCH_SIZE = 100
+
 
 async def handle_incoming_client_event(metadata):
     '''
@@ -170,9 +270,9 @@ async def handle_incoming_client_event(metadata):
     # The adapter allows us to handle old event formats
     adapter = learning_observer.adapters.adapter.EventAdapter()
 
-    async def handler(request, client_event):
+    def compile_event(request, client_event):
         '''
-        This is the handler for incoming client events.
+        Wrap a client event up with server data and metadata, and log it.
         '''
         client_event = adapter.canonicalize_event(client_event)
         debug_log("Compiling event for reducer: " + client_event["event"])
@@ -182,15 +282,34 @@ async def handle_incoming_client_event(metadata):
             "metadata": metadata
         }
 
+        # We encode the event once, and log the same line to both files.
+        encoded_event = log_event.encode_json_line(event)
         # Log to the main event log file
-        log_event.log_event(event)
+        log_event.log_event(encoded_event, preencoded=True)
         # Log the same thing to our study log file. This isn't a good final format, since we
         # mix data with auth, but we want this for now.
         log_event.log_event(
-            json.dumps(event, sort_keys=True),
+            encoded_event,
             filename, preencoded=True, timestamp=True)
-        await pipeline(event)
+        return event
 
+    async def handler(request, client_event):
+        '''
+        This is the handler for incoming client events.
+        '''
+        await pipeline(compile_event(request, client_event))
+
+    async def process_batch(request, client_events):
+        '''
+        Handle a micro-batch of incoming client events.
+        '''
+        await pipeline.process_batch([
+            compile_event(request, client_event)
+            for client_event in client_events
+        ])
+
+    setattr(handler, 'flush', pipeline.flush)
+    setattr(handler, 'process_batch', process_batch)
     return handler
 
 
@@ -280,11 +399,129 @@ def event_decoder_and_logger(
                 json_event = msg
             else:
                 json_event = json.loads(msg.data)
-            log_event.log_event(json_event, filename=filename)
+            log_event.log_event(log_event.encode_json_line(json_event), filename=filename, preencoded=True)
             yield json_event
     return decode_and_log_event
 
 
+async def batch_events(events, window, max_size, current_handler):
+    '''
+    Group `events` (an async iterator) into micro-batches. Once an event
+    arrives, we wait up to `window` seconds (or `max_size` events) for
+    more, and yield everything we got as one list.
+
+    Upstream stages (e.g. `lock_fields`) may swap the event handler
+    while earlier events are still waiting here. So we note the handler
+    (`current_handler()`) as each event comes in, never mix handlers in
+    one batch, and yield `(handler, batch)`.
+
+    We pull events from upstream in a separate task, so we're not
+    cancelling the upstream generators when the window closes.
+
+    >>> current = {'handler': 'old'}
+    >>> async def events():
+    ...     yield 1
+    ...     yield 2
+    ...     current['handler'] = 'new'  # e.g. a `lock_fields` event
+    ...     yield 3
+    >>> async def run():
+    ...     return [batch async for batch in batch_events(events(), 0.05, 10, lambda: current['handler'])]
+    >>> asyncio.run(run())
+    [('old', [1, 2]), ('new', [3])]
+    '''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put((current_handler(), event))
+        finally:
+            await queue.put(done)
+
+    pump_task = asyncio.ensure_future(pump())
+    try:
+        pending = None
+        finished = False
+        while not finished:
+            item = pending if pending is not None else await queue.get()
+            pending = None
+            if item is done:
+                break
+            handler, event = item
+            batch = [event]
+            deadline = loop.time() + window
+            while len(batch) < max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is done:
+                    finished = True
+                    break
+                if item[0] is not handler:
+                    # This one starts the next batch
+                    pending = item
+                    break
+                batch.append(item[1])
+            yield handler, batch
+        await pump_task
+    finally:
+        pump_task.cancel()
+
+
+async def flush_handler(handler):
+    '''
+    Write back any reducer state `handler` holds in memory.
+    '''
+    if hasattr(handler, 'flush'):
+        await handler.flush()
+
+
+async def reduce_batches(request, batches):
+    '''
+    Pass `(handler, batch)` micro-batches (see `batch_events`) through
+    their reducers, in order. Once a handler has been replaced, and its
+    last batch is done, we flush it. The caller flushes the last one.
+
+    >>> log = []
+    >>> def make_handler(name):
+    ...     async def handler(request, event):
+    ...         pass
+    ...     async def process_batch(request, batch):
+    ...         log.append((name, batch))
+    ...     async def flush():
+    ...         log.append((name, 'flush'))
+    ...     handler.process_batch, handler.flush = process_batch, flush
+    ...     return handler
+    >>> old, new = make_handler('old'), make_handler('new')
+    >>> async def batches():
+    ...     yield old, [1, 2]
+    ...     yield new, [3]
+    >>> async def run():
+    ...     async for batch in reduce_batches(None, batches()):
+    ...         pass
+    >>> asyncio.run(run())
+    >>> log
+    [('old', [1, 2]), ('old', 'flush'), ('new', [3])]
+    '''
+    previous = None
+    async for handler, batch in batches:
+        if previous is not None and handler is not previous:
+            await flush_handler(previous)
+        previous = handler
+        if hasattr(handler, 'process_batch'):
+            await handler.process_batch(request, batch)
+        else:
+            for event in batch:
+                await handler(request, event)
+        yield batch
+
+
 async def failing_event_handler(*args, **kwargs):
     '''
     Give a proper AIO HTTP exception if we don't find an
@@ -311,6 +548,12 @@ async def incoming_websocket_handler(request):
 
     decoder_and_logger = event_decoder_and_logger(request)
 
+    # Micro-batching. This is off unless configured. Note that with
+    # batching, the upstream stages run slightly ahead of the reducers.
+    batching = settings.settings.get('event_batching', {})
+    batch_window = batching.get('window', 0)
+    batch_size = batching.get('max_size', EVENT_BATCH_SIZE)
+
     async def process_message_from_ws():
         '''This function makes sure that the ws is an
         async generator for use in the processing pipeline
@@ -326,7 +569,12 @@ async def incoming_websocket_handler(request):
         if ws.closed:
             debug_log(f'ws connection closed for reason {ws.close_code}')
 
-    async def update_event_handler(event):
+    # Handlers we've replaced, which may still have batches to reduce.
+    # `reduce_batches` flushes these once they're done, and we flush
+    # any which are left when the socket closes.
+    replaced_handlers = []
+
+    async def update_event_handler(event=None):
         '''We need source and auth ready before we can
         set up the `event_handler` and be ready to process
         events
@@ -335,14 +583,27 @@ async def incoming_websocket_handler(request):
             return
 
         nonlocal event_handler
-        if 'source' in lock_fields:
+        if 'source' in lock_fields or event is None:
             debug_log('Updating the event_handler()')
             metadata = lock_fields.copy()
         else:
             metadata = event
         metadata['auth'] = authenticated
+        if batch_window > 0:
+            # Events for the old handler may still be queued
+            replaced_handlers.append(event_handler)
+        else:
+            await flush_handler(event_handler)
         event_handler = await handle_incoming_client_event(metadata=metadata)
 
+    async def flush_event_handler():
+        '''Write back any reducer state the current `event_handler`
+        (and any handlers it replaced) holds in memory, once the socket
+        closes.
+        '''
+        for handler in replaced_handlers + [event_handler]:
+            await flush_handler(handler)
+
     async def handle_auth_events(events):
         '''This method checks a single method for auth and
         updates our `lock_fields`. If we are unauthenticated,
@@ -428,10 +689,17 @@ async def incoming_websocket_handler(request):
         events = decode_lock_fields(events)
         events = handle_auth_events(events)
         events = filter_blacklist_events(events)
-        events = pass_through_reducers(events)
+        if batch_window > 0:
+            events = batch_events(events, batch_window, batch_size, lambda: event_handler)
+            events = reduce_batches(request, events)
+        else:
+            events = pass_through_reducers(events)
         # empty loop to start the generator pipeline
-        async for event in events:
-            pass
+        try:
+            async for event in events:
+                pass
+        finally:
+            await flush_event_handler()
         debug_log('We are done passing events through the pipeline.')
 
     # process websocket messages and begin executing events from the queue
@@ -28,6 +28,16 @@ import learning_observer.util
 OBJECT_STORE = dict()
 
 
+def _kvs_items(items):
+    '''
+    `multiset` takes either a dictionary or a list of `(key, value)`
+    pairs. This normalizes both into a list of pairs.
+    '''
+    if isinstance(items, dict):
+        return list(items.items())
+    return list(items)
+
+
 class _KVS:
     async def dump(self, filename=None):
         '''
@@ -50,9 +60,8 @@ class _KVS:
         returns:
             A JSON object containing the contents of the KVS.
         '''
-        data = {}
-        for key in await self.keys():
-            data[key] = await self[key]
+        keys = await self.keys()
+        data = dict(zip(keys, await self.multiget(keys)))
         if filename:
             with open(filename, 'w') as f:
                 json.dump(data, f, indent=4)
@@ -60,11 +69,24 @@ class _KVS:
 
     async def multiget(self, keys):
         '''
-        Multiget. It's not fast, but it means we can use appropriate
-        abstractions and make it fast later.
+        Multiget. This generic version is not fast, but it means we can
+        use appropriate abstractions. Backends which can do better (e.g.
+        redis, with `MGET`) override this.
+
+        Returns a list of values, in the same order as `keys`, with `None`
+        for missing keys.
         '''
         return [await self[key] for key in keys]
 
+    async def multiset(self, items):
+        '''
+        Multiset. `items` is either a dictionary or a list of `(key, value)`
+        pairs. As with `multiget`, this generic version just loops, and
+        backends which can batch writes override it.
+        '''
+        for key, value in _kvs_items(items):
+            await self.set(key, value)
+
     async def load(self, filename):
         '''
         Loads the contents of a JSON object into the KVS.
@@ -75,8 +97,7 @@ class _KVS:
         '''
         with open(filename) as f:
             data = json.load(f)
-        for key, value in data.items():
-            await self.set(key, value)
+        await self.multiset(data)
 
 
 class InMemoryKVS(_KVS):
@@ -108,6 +129,30 @@ class InMemoryKVS(_KVS):
         assert isinstance(key, str), "KVS keys must be strings"
         OBJECT_STORE[key] = value
 
+    async def multiget(self, keys):
+        '''
+        Syntax:
+        >> await kvs.multiget(['key1', 'key2'])
+
+        Returns a list of values, with `None` for missing keys.
+        '''
+        return [copy.deepcopy(OBJECT_STORE.get(key, None)) for key in keys]
+
+    async def multiset(self, items):
+        '''
+        Syntax:
+        >> await kvs.multiset({'key1': value1, 'key2': value2})
+
+        We validate everything before writing anything, so a bad
+        item does not leave us with a partial write.
+        '''
+        items = _kvs_items(items)
+        for key, value in items:
+            json.dumps(value)  # Fail early if we're not JSON
+            assert isinstance(key, str), "KVS keys must be strings"
+        for key, value in items:
+            OBJECT_STORE[key] = value
+
     async def keys(self):
         '''
         Returns all keys.
@@ -172,6 +217,32 @@ class _RedisKVS(_KVS):
         assert isinstance(key, str), "KVS keys must be strings"
         return await learning_observer.redis_connection.set(key, value, expiry=self.expire)
 
+    async def multiget(self, keys):
+        '''
+        Syntax:
+        >> await kvs.multiget(['key1', 'key2'])
+
+        This is a single redis `MGET`, so a whole class worth of
+        reducer state costs one round trip.
+        '''
+        await self.connect()
+        items = await learning_observer.redis_connection.mget(keys)
+        return [json.loads(item) if item is not None else None for item in items]
+
+    async def multiset(self, items):
+        '''
+        Syntax:
+        >> await kvs.multiset({'key1': value1, 'key2': value2})
+
+        The `SET` commands are pipelined, so this is a single round trip.
+        '''
+        await self.connect()
+        encoded = []
+        for key, value in _kvs_items(items):
+            assert isinstance(key, str), "KVS keys must be strings"
+            encoded.append((key, json.dumps(value)))  # Fail early if we're not JSON
+        return await learning_observer.redis_connection.mset(encoded, expiry=self.expire)
+
     async def keys(self):
         '''
         Return all the keys in the KVS.
@@ -401,6 +472,11 @@ async def test():
             print(k)
 
     assert (await mk1["hi"]) == 7
+    await mk1.multiset({"hi": 10, "bye": 11})
+    assert (await mk2.multiget(["hi", "bye", "missing"])) == [10, 11, None]
+    await ek1.multiset([("hi", 12), ("bye", 13)])
+    assert (await ek2.multiget(["hi", "bye", "missing"])) == [12, 13, None]
+    await ek1.set("hi", 9)
     print(await ek1["hi"])
     print(type(await ek1["hi"]))
     print((await ek1["hi"]) == 9)
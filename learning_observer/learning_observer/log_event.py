@@ -48,14 +48,21 @@ were, but we might not keep terabytes of data around (just enough to
 redo those analyses).
 '''
 
+import atexit
+import collections
 import datetime
 from enum import Enum
+import gzip
 import inspect
 import io
 import json
 import hashlib
 import os
 import os.path
+import shutil
+import threading
+import time
+import traceback
 
 import learning_observer.filesystem_state
 
@@ -79,7 +86,37 @@ if not os.path.exists(paths.logs("startup")):
     os.mkdir(paths.logs("startup"))
 
 mainlog = open(paths.logs("main_log.json"), "ab", 0)
-files = {}
+mainlog_opened = time.time()
+
+# Open handles for per-session log files, least recently used first.
+# Every websocket connection gets its own files, so we can't keep them
+# all open; past `MAX_OPEN_LOG_FILES`, we close the oldest. They're
+# opened in append mode, so we can reopen them if the session writes
+# again.
+files = collections.OrderedDict()
+MAX_OPEN_LOG_FILES = 128
+
+# We can rotate the main log once it's more than `MAIN_LOG_MAX_BYTES`
+# big, or `MAIN_LOG_MAX_AGE` seconds old. Old logs are renamed with a
+# timestamp, and gzipped in the background. `None` means no limit.
+# These can be set in the `logging` section of the settings.
+MAIN_LOG_MAX_BYTES = None
+MAIN_LOG_MAX_AGE = None
+
+# If rotating fails (e.g. the disk is full), we keep writing to the
+# current log, and try again after `MAIN_LOG_ROTATION_RETRY` seconds.
+MAIN_LOG_ROTATION_RETRY = 60
+next_rotation_attempt = 0
+
+# Event logs are written in the background. `log_event` just adds the
+# event to an in-memory buffer. A writer thread then writes everything
+# buffered every `LOG_FLUSH_INTERVAL` seconds (or sooner, once
+# `LOG_BUFFER_SIZE` bytes are waiting), with one write per file. This
+# is a group commit: on a crash, we lose at most `LOG_FLUSH_INTERVAL`
+# seconds of events. An interval of 0 writes each event as it comes
+# in. Both can be set in the `logging` section of the settings.
+LOG_FLUSH_INTERVAL = 0.25
+LOG_BUFFER_SIZE = 1024 * 1024
 
 
 # Do we make files for exceptions? Do we print extra stuff on the console?
@@ -148,6 +185,18 @@ def initialize_logging_framework():
     debug_log("DEBUG_LOG_LEVEL:", DEBUG_LOG_LEVEL)
     debug_log("DEBUG_DESTINATIONS:", DEBUG_LOG_DESTINATIONS)
 
+    global LOG_FLUSH_INTERVAL
+    global LOG_BUFFER_SIZE
+    global MAX_OPEN_LOG_FILES
+    global MAIN_LOG_MAX_BYTES
+    global MAIN_LOG_MAX_AGE
+    logging_settings = settings.settings.get("logging", {})
+    LOG_FLUSH_INTERVAL = logging_settings.get("flush_interval", LOG_FLUSH_INTERVAL)
+    LOG_BUFFER_SIZE = logging_settings.get("buffer_size", LOG_BUFFER_SIZE)
+    MAX_OPEN_LOG_FILES = logging_settings.get("max_open_files", MAX_OPEN_LOG_FILES)
+    MAIN_LOG_MAX_BYTES = logging_settings.get("main_log_max_bytes", MAIN_LOG_MAX_BYTES)
+    MAIN_LOG_MAX_AGE = logging_settings.get("main_log_max_age", MAIN_LOG_MAX_AGE)
+
     # We're going to save the state of the filesystem on application startup
     # This way, event logs can refer uniquely to running version
     # Do we want the full 512 bit hash? Cut it back? Use a more efficient encoding than
@@ -190,26 +239,201 @@ def encode_json_block(block):
     return json.dumps(block, sort_keys=True, indent=3)
 
 
-def log_event(event, filename=None, preencoded=False, timestamp=False):
+def log_file(filename=None):
     '''
-    This isn't done, but it's how we log events for now.
+    The file handle for a log. `None` is the main log.
+
+    This is only called by the `LogWriter`, with its write lock held.
     '''
     if filename is None:
-        log_file_fp = mainlog
-    elif filename in files:
-        log_file_fp = files[filename]
-    else:
-        log_file_fp = open(paths.logs("" + filename + ".log"), "ab", 0)
-        files[filename] = log_file_fp
+        if main_log_needs_rotation():
+            rotate_main_log()
+        return mainlog
+    if filename in files:
+        files.move_to_end(filename)
+        return files[filename]
+    files[filename] = open(paths.logs("" + filename + ".log"), "ab", 0)
+    while len(files) > MAX_OPEN_LOG_FILES:
+        oldest_filename, oldest_fp = files.popitem(last=False)
+        oldest_fp.close()
+    return files[filename]
+
+
+def main_log_needs_rotation():
+    '''
+    Is the main log too big, or too old?
+    '''
+    if time.time() < next_rotation_attempt:
+        return False
+    if MAIN_LOG_MAX_BYTES is not None and mainlog.tell() >= MAIN_LOG_MAX_BYTES:
+        return True
+    if MAIN_LOG_MAX_AGE is not None and time.time() - mainlog_opened >= MAIN_LOG_MAX_AGE:
+        return True
+    return False
+
+
+def rotate_main_log():
+    '''
+    Move the main log aside, start a new one, and compress the old one
+    in the background.
+
+    We only close the old log once the new one is open. If anything
+    fails, we keep writing to the old one, under its old name.
+    '''
+    global mainlog, mainlog_opened, next_rotation_attempt
+    main_filename = paths.logs("main_log.json")
+    rotated_filename = paths.logs("main_log.{time}.json".format(
+        time=datetime.datetime.utcnow().strftime("%Y-%m-%dT%H-%M-%S.%f")
+    ))
+    try:
+        os.rename(main_filename, rotated_filename)
+    except OSError:
+        traceback.print_exc()
+        next_rotation_attempt = time.time() + MAIN_LOG_ROTATION_RETRY
+        return
+    try:
+        new_mainlog = open(main_filename, "ab", 0)
+    except OSError:
+        traceback.print_exc()
+        next_rotation_attempt = time.time() + MAIN_LOG_ROTATION_RETRY
+        # Our handle still writes to the file; we just want its name back
+        try:
+            os.rename(rotated_filename, main_filename)
+        except OSError:
+            traceback.print_exc()
+        return
+    old_mainlog, mainlog = mainlog, new_mainlog
+    mainlog_opened = time.time()
+    old_mainlog.close()
+    threading.Thread(
+        target=compress_log,
+        args=(rotated_filename,),
+        name="log-compressor"
+    ).start()
+
+
+def compress_log(filename):
+    '''
+    gzip a log file, and remove the original. We write to a temporary
+    file first, so if we're interrupted, we still have the original.
+    '''
+    with open(filename, "rb") as source, gzip.open(filename + ".gz.tmp", "wb") as destination:
+        shutil.copyfileobj(source, destination)
+    os.rename(filename + ".gz.tmp", filename + ".gz")
+    os.unlink(filename)
 
+
+class LogWriter:
+    '''
+    Buffers log lines in memory, and writes them out in groups from a
+    background thread. See `LOG_FLUSH_INTERVAL`.
+    '''
+    def __init__(self):
+        # `buffer_lock` protects the buffers. `write_lock` makes sure
+        # only one thread writes at a time, so lines stay in order.
+        self.buffer_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.buffers = {}
+        self.buffered = 0
+        self.thread = None
+
+    def write(self, filename, data):
+        '''
+        Queue up `data` (bytes) to be written to log `filename`
+        '''
+        with self.buffer_lock:
+            self.buffers.setdefault(filename, []).append(data)
+            self.buffered += len(data)
+            full = self.buffered >= LOG_BUFFER_SIZE
+            if LOG_FLUSH_INTERVAL > 0 and (self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+                self.thread.start()
+        if LOG_FLUSH_INTERVAL <= 0:
+            self.flush()
+            return
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        '''
+        Write out everything we have buffered. This is safe to call
+        from any thread.
+
+        If a write fails, whatever we haven't written yet goes back in
+        the buffer (ahead of anything logged since), and we raise.
+        '''
+        with self.write_lock:
+            with self.buffer_lock:
+                buffers = self.buffers
+                self.buffers = {}
+                self.buffered = 0
+            pending = list(buffers.items())
+            try:
+                while pending:
+                    filename, chunks = pending[0]
+                    log_file_fp = log_file(filename)
+                    log_file_fp.write(b"".join(chunks))
+                    log_file_fp.flush()
+                    pending.pop(0)
+            except BaseException:
+                self.requeue(pending)
+                raise
+
+    def requeue(self, pending):
+        '''
+        Put `(filename, chunks)` we failed to write back at the start
+        of the buffers.
+        '''
+        with self.buffer_lock:
+            for filename, chunks in pending:
+                self.buffers[filename] = chunks + self.buffers.get(filename, [])
+                self.buffered += sum(len(chunk) for chunk in chunks)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(LOG_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            # If we can't write (e.g. the disk is full), the lines stay
+            # buffered, and we try again next time around.
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+LOG_WRITER = LogWriter()
+atexit.register(LOG_WRITER.flush)
+
+
+def flush_logs():
+    '''
+    Write out any buffered log events now. E.g. on shutdown.
+    '''
+    LOG_WRITER.flush()
+
+
+async def flush_logs_on_cleanup(app):
+    '''
+    aiohttp cleanup hook, so we don't lose buffered events on shutdown
+    '''
+    flush_logs()
+
+
+def log_event(event, filename=None, preencoded=False, timestamp=False):
+    '''
+    This isn't done, but it's how we log events for now.
+
+    If the same event goes to several logs, encode it once with
+    `encode_json_line`, and pass it in with `preencoded`.
+
+    Events are buffered; see `LogWriter`.
+    '''
     if not preencoded:
         event = encode_json_line(event)
-    log_file_fp.write(event.encode('utf-8'))
     if timestamp:
-        log_file_fp.write("\t".encode('utf-8'))
-        log_file_fp.write(datetime.datetime.utcnow().isoformat().encode('utf-8'))
-    log_file_fp.write("\n".encode('utf-8'))
-    log_file_fp.flush()
+        event = "{event}\t{timestamp}".format(event=event, timestamp=datetime.datetime.utcnow().isoformat())
+    LOG_WRITER.write(filename, (event + "\n").encode('utf-8'))
 
 
 def print_to_string(*args, **kwargs):
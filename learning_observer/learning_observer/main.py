@@ -19,6 +19,10 @@ import aiohttp.web
 import uvloop
 
 import learning_observer.settings as settings
+import learning_observer.communication_protocol.executor
+import learning_observer.http_client
+import learning_observer.log_event
+import learning_observer.pubsub.key_changes
 import learning_observer.routes as routes
 import learning_observer.prestartup
 import learning_observer.webapp_helpers
@@ -90,6 +94,15 @@ def create_app():
     learning_observer.webapp_helpers.setup_cors(app)
     learning_observer.webapp_helpers.setup_session_storage(app)
     learning_observer.webapp_helpers.setup_middlewares(app)
+
+    # Write out any buffered event logs when we shut down
+    app.on_cleanup.append(learning_observer.log_event.flush_logs_on_cleanup)
+    # Tell dashboards in other processes when reducers write to the KVS
+    app.cleanup_ctx.append(learning_observer.pubsub.key_changes.forward_key_changes)
+    # Stop the worker processes used for parallel maps in queries
+    app.on_cleanup.append(learning_observer.communication_protocol.executor.shutdown_process_pool)
+    # Close our connections to Google, LanguageTool, etc.
+    app.on_cleanup.append(learning_observer.http_client.close_client_sessions)
     return app
 
 
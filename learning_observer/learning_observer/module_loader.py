@@ -23,6 +23,7 @@ import learning_observer.settings
 
 from learning_observer.log_event import debug_log
 import learning_observer.communication_protocol.integration
+import learning_observer.communication_protocol.plan
 import learning_observer.queries
 import learning_observer.stream_analytics.helpers as helpers
 
@@ -32,6 +33,8 @@ LOADED = False
 
 COURSE_AGGREGATORS = collections.OrderedDict()
 EXECUTION_DAGS = {}
+# Compiled versions of the above (see `communication_protocol.plan`)
+EXECUTION_PLANS = {}
 REDUCERS = []
 THIRD_PARTY = {}
 STATIC_REPOS = {}
@@ -90,6 +93,14 @@ def execution_dags():
     return EXECUTION_DAGS
 
 
+def execution_plans():
+    '''
+    Return a dictionary of compiled named queries, ready to execute.
+    '''
+    load_modules()
+    return EXECUTION_PLANS
+
+
 def reducers():
     '''
     Return a list of all event processors / reducers. Note that
@@ -253,6 +264,8 @@ def load_reducers(component_name, module):
                 "function": reducer['function'],  # Primary ID
                 "scope": reducer.get('scope', DEFAULT_STUDENT_SCOPE),
                 "default": reducer.get('default', {}),
+                # Which event types the reducer handles. `None` is all of them.
+                "events": reducer.get('events', getattr(reducer['function'], 'events', None)),
                 "module": module,
                 "id": f"{module.__name__.replace('.module', '')}.{reducer['function'].__name__}"
             }
@@ -307,9 +320,11 @@ def load_execution_dags(component_name, module):
     '''
     if hasattr(module, "EXECUTION_DAG"):
         debug_log(f"Loading execution DAG from {component_name}")
+        # Compile the DAG once, here, rather than each time we run it
+        plan = learning_observer.communication_protocol.plan.ExecutionPlan(module.EXECUTION_DAG, name=component_name)
         # set up a nested module to add our queries to
         queries = learning_observer.queries.NestedQuery()
-        learning_observer.communication_protocol.integration.add_exports_to_module(module.EXECUTION_DAG, queries)
+        learning_observer.communication_protocol.integration.add_exports_to_module(plan, queries)
         # set the nested module to the `learning_observer.queries.component_name` namespace
         setattr(learning_observer.queries, component_name, queries)
 
@@ -319,6 +334,7 @@ def load_execution_dags(component_name, module):
         if component_name in EXECUTION_DAGS:
             raise KeyError(f'Execution DAG already exists for {component_name}')
         EXECUTION_DAGS[component_name] = cleaned_query
+        EXECUTION_PLANS[component_name] = plan
     else:
         debug_log(f"Component {component_name} has no execution DAG")
 
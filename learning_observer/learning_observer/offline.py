@@ -147,6 +147,8 @@ async def process_file(
         except Exception:
             print(event)
             raise
+    if hasattr(pipeline, 'flush'):
+        await pipeline.flush()
 
     return n, source, userid
 
@@ -12,30 +12,53 @@ helpful for development and demos.
 3) We're going to play with redis, which seems easier (but less scalable)
 than xmpp, but is probably right approach for pilots.
 
+On top of these, `key_changes` tells dashboards when reducers write
+to the KVS. It has its own in-process broker, and only uses the
+backends above to forward changes between processes.
+
 One project which came up which might be relevant:
 https://github.com/encode/broadcaster
 '''
 
-import sys
-
 import learning_observer.settings as settings
 from learning_observer.log_event import debug_log
 
-try:
-    PUBSUB = settings.settings['pubsub']['type']
-except KeyError:
-    print("Pub-sub configuration missing from configuration file.")
-    sys.exit(-1)
+# The pub-sub backends we support. `stub` only works within a single
+# process.
+PUBSUB_TYPES = ['stub', 'redis', 'xmpp']
+
+
+def pubsub_type():
+    '''
+    Which pub-sub backend we're configured to use. We look this up when
+    it's used, rather than on import, so modules (such as the reducers,
+    which publish key changes) can import us before settings are loaded.
+    '''
+    try:
+        pubsub = settings.settings['pubsub']['type']
+    except (KeyError, TypeError):
+        raise RuntimeError("Pub-sub configuration missing from configuration file.")
+    if pubsub not in PUBSUB_TYPES:
+        raise RuntimeError(
+            "Pubsub incorrectly configured. We support {supported}. It's set to: {pubsub}".format(
+                supported=", ".join(PUBSUB_TYPES),
+                pubsub=pubsub
+            )
+        )
+    return pubsub
 
-if PUBSUB == 'xmpp':
-    import learning_observer.pubsub.receivexmpp
-    import learning_observer.pubsub.sendxmpp
 
-    async def pubsub_send(channel=None):
-        '''
-        Connect to an XMPP server, and return an object able to send
-        events.
-        '''
+async def pubsub_send(channel=None):
+    '''
+    Return an object able to send events, for the configured backend:
+
+    * xmpp: Connect to an XMPP server
+    * stub: A simple in-memory queue
+    * redis: Connect to redis, and send over a redis queue / pubsub
+    '''
+    pubsub = pubsub_type()
+    if pubsub == 'xmpp':
+        import learning_observer.pubsub.sendxmpp
         sender = learning_observer.pubsub.sendxmpp.SendXMPP(
             settings.settings['xmpp']['source']['jid'],
             settings.settings['xmpp']['source']['password'],
@@ -44,12 +67,26 @@ if PUBSUB == 'xmpp':
         )
         sender.connect()
         return sender
+    if pubsub == 'stub':
+        import learning_observer.pubsub.pubstub
+        return learning_observer.pubsub.pubstub.SendStub(**({'channel': channel} if channel else {}))
+    import learning_observer.pubsub.redis_pubsub
+    sender = learning_observer.pubsub.redis_pubsub.RedisSend(**({'channel': channel} if channel else {}))
+    await sender.connect()
+    return sender
+
+
+async def pubsub_receive(channel=None):
+    '''
+    Return an object able to receive events, for the configured backend:
 
-    async def pubsub_receive(channel=None):
-        '''
-        Connect to an XMPP server, and return an object able to receive
-        events.
-        '''
+    * xmpp: Connect to an XMPP server
+    * stub: Await objects from a simple in-memory queue
+    * redis: Connect to redis, and receive from a redis queue / pubsub
+    '''
+    pubsub = pubsub_type()
+    if pubsub == 'xmpp':
+        import learning_observer.pubsub.receivexmpp
         receiver = learning_observer.pubsub.receivexmpp.ReceiveXMPP(
             settings.settings['xmpp']['sink']['jid'],
             settings.settings['xmpp']['sink']['password'],
@@ -57,46 +94,10 @@ if PUBSUB == 'xmpp':
         )
         receiver.connect()
         return receiver
-elif PUBSUB == 'stub':
-    import learning_observer.pubsub.pubstub
-
-    async def pubsub_send(channel=None):
-        '''
-        Return an object capable of placing objects in a simple in-memory
-        queue.
-        '''
-        sender = learning_observer.pubsub.pubstub.SendStub()
-        return sender
-
-    async def pubsub_receive(channel=None):
-        '''
-        Return an object capable of awaiting to remove objects from a
-        simple in-memory queue.
-        '''
-        receiver = learning_observer.pubsub.pubstub.ReceiveStub()
-        return receiver
-elif PUBSUB == 'redis':
+    if pubsub == 'stub':
+        import learning_observer.pubsub.pubstub
+        return learning_observer.pubsub.pubstub.ReceiveStub(**({'channel': channel} if channel else {}))
     import learning_observer.pubsub.redis_pubsub
-
-    async def pubsub_send(channel=None):
-        '''
-        Connect to redis, and return an object capable of sending messages
-        out over a redis queue / pubsub
-        '''
-        sender = learning_observer.pubsub.redis_pubsub.RedisSend()
-        await sender.connect()
-        return sender
-
-    async def pubsub_receive(channel=None):
-        '''
-        Connect to redis, and return an object capable of receiving messages
-        out over a redis queue / pubsub
-        '''
-        receiver = learning_observer.pubsub.redis_pubsub.RedisReceive()
-        await receiver.connect()
-        return receiver
-else:
-    print("Pubsub incorrectly configured")
-    print("We support stub, redis, and xmpp")
-    print("It's set to:")
-    print(PUBSUB)
+    receiver = learning_observer.pubsub.redis_pubsub.RedisReceive(**({'channel': channel} if channel else {}))
+    await receiver.connect()
+    return receiver
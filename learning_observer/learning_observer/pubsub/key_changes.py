@@ -0,0 +1,189 @@
+'''
+Notifications of KVS writes, so dashboards can update when (and only
+when) the student state they show changes, rather than re-running
+every query every few seconds.
+
+Reducers `publish()` the keys they write. A dashboard `subscribe()`s,
+tells the subscription which keys it read (`watch()`), and waits for
+changes to any of them.
+
+Within a process, this is a simple in-memory broker. Publishing is a
+dictionary lookup per key, so it costs almost nothing when nobody is
+watching. If several processes share a KVS (pub-sub type `redis` or
+`xmpp`), `forward_key_changes` also relays changes between processes
+over the configured pub-sub backend (see `learning_observer.pubsub`).
+
+>>> subscription = subscribe(['a', 'b'])
+>>> publish(['b', 'c'])
+>>> subscription.pop_changes()
+{'b'}
+>>> subscription.close()
+>>> publish(['a'])
+>>> subscription.pop_changes()
+set()
+'''
+
+import asyncio
+import collections
+import json
+import uuid
+
+import learning_observer.pubsub
+from learning_observer.log_event import debug_log
+
+
+# The pub-sub channel we forward changes between processes on
+CHANNEL = 'kvs_key_changes'
+
+# Identifies this process, so we can ignore our own forwarded changes
+ORIGIN = uuid.uuid4().hex
+
+# Subscriptions, by the key they watch
+_SUBSCRIBERS = collections.defaultdict(set)
+
+# Changes waiting to be forwarded to other processes. This stays
+# `None` unless we're forwarding.
+_OUTBOX = None
+
+
+class Subscription:
+    '''
+    A set of keys someone (typically, one dashboard connection) is
+    watching, and which of them changed since they last checked.
+    '''
+    def __init__(self):
+        self.keys = frozenset()
+        self.changed = set()
+        self.event = asyncio.Event()
+
+    def watch(self, keys):
+        '''
+        Watch `keys`, instead of whatever we watched before.
+        '''
+        keys = frozenset(keys)
+        for key in self.keys - keys:
+            _SUBSCRIBERS[key].discard(self)
+            if not _SUBSCRIBERS[key]:
+                del _SUBSCRIBERS[key]
+        for key in keys - self.keys:
+            _SUBSCRIBERS[key].add(self)
+        self.keys = keys
+
+    def notify(self, key):
+        self.changed.add(key)
+        self.event.set()
+
+    def pop_changes(self):
+        '''
+        The keys which changed since we last asked.
+        '''
+        changed = self.changed
+        self.changed = set()
+        self.event.clear()
+        return changed
+
+    async def wait(self, timeout=None):
+        '''
+        Wait (up to `timeout` seconds) for any of our keys to change, and
+        return which ones did.
+        '''
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.pop_changes()
+
+    def close(self):
+        self.watch([])
+
+
+def subscribe(keys=()):
+    subscription = Subscription()
+    subscription.watch(keys)
+    return subscription
+
+
+def notify_local(keys):
+    '''
+    Tell subscriptions in this process that `keys` changed.
+    '''
+    for key in keys:
+        for subscription in _SUBSCRIBERS.get(key, ()):
+            subscription.notify(key)
+
+
+def publish(keys):
+    '''
+    Tell everyone watching that `keys` were written.
+    '''
+    keys = list(keys)
+    notify_local(keys)
+    if _OUTBOX is not None:
+        _OUTBOX.put_nowait(keys)
+
+
+def forwarding():
+    '''
+    Are we hearing about changes made in other processes?
+    '''
+    return _OUTBOX is not None
+
+
+async def forward_key_changes(app):
+    '''
+    Relay changes between processes, over the configured pub-sub
+    backend. With the `stub` backend, there's only one process, so
+    there's nothing to do. If the backend is unreachable, we only
+    deliver changes within this process.
+
+    This is an aiohttp cleanup context: add it to `app.cleanup_ctx`.
+    '''
+    global _OUTBOX
+    try:
+        pubsub = learning_observer.pubsub.pubsub_type()
+    except RuntimeError as e:
+        debug_log("Not forwarding key changes between processes:", e)
+        pubsub = 'stub'
+    if pubsub == 'stub':
+        yield
+        return
+
+    # If we can't reach the backend, dashboards still hear about
+    # changes made in this process, and fall back to polling for the
+    # rest (see `dashboard.DashboardUpdates`).
+    try:
+        sender = await learning_observer.pubsub.pubsub_send(channel=CHANNEL)
+        receiver = await learning_observer.pubsub.pubsub_receive(channel=CHANNEL)
+    except Exception as e:
+        debug_log("Could not connect to the pub-sub backend; not forwarding key changes:", e)
+        yield
+        return
+    _OUTBOX = asyncio.Queue()
+
+    async def send_loop():
+        while True:
+            # Send whatever piled up while we were sending the last batch
+            keys = await _OUTBOX.get()
+            while not _OUTBOX.empty():
+                keys.extend(_OUTBOX.get_nowait())
+            try:
+                await sender.send_event(json.dumps({'origin': ORIGIN, 'keys': keys}))
+            except Exception as e:
+                debug_log("Could not forward key changes:", e)
+
+    async def receive_loop():
+        while True:
+            try:
+                message = json.loads(await receiver.receive())
+            except Exception as e:
+                debug_log("Could not receive key changes:", e)
+                await asyncio.sleep(1)
+                continue
+            if message.get('origin') != ORIGIN:
+                notify_local(message.get('keys', []))
+
+    tasks = [asyncio.ensure_future(send_loop()), asyncio.ensure_future(receive_loop())]
+    yield
+    _OUTBOX = None
+    for task in tasks:
+        task.cancel()
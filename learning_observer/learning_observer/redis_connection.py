@@ -47,13 +47,41 @@ async def keys():
 
 async def get(key):
     '''
-    Get a key. We should eventually do multi-gets. Returns a future.
+    Get a key. For many keys, use `mget`. Returns a future.
     '''
     return await (await connection()).get(key)
 
 
+async def mget(keys):
+    '''
+    Get a list of keys in a single round trip (redis `MGET`). Missing
+    keys come back as `None`, in the same order as `keys`.
+    '''
+    keys = list(keys)
+    if len(keys) == 0:
+        return []
+    return await (await connection()).mget(keys)
+
+
 async def set(key, value, expiry=None):
     '''
-    Set a key. We should eventually do multi-sets. Returns a future.
+    Set a key. For many keys, use `mset`. Returns a future.
     '''
     return await (await connection()).set(key, value, expiry)
+
+
+async def mset(items, expiry=None):
+    '''
+    Set a list of `(key, value)` pairs in a single round trip.
+
+    redis `MSET` does not support expiry, so we pipeline `SET` (or
+    `SET ... EX`, if `expiry` is given) commands instead. The pipeline
+    is not a transaction; we only care about saving network hops here.
+    '''
+    items = list(items)
+    if len(items) == 0:
+        return []
+    async with (await connection()).pipeline(transaction=False) as pipe:
+        for key, value in items:
+            pipe.set(key, value, expiry)
+        return await pipe.execute()
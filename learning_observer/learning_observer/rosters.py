@@ -60,8 +60,11 @@ so that class info uses the same format but that is scut work for another
 time.
 '''
 
+import asyncio
+import copy
 import json
 import os.path
+import time
 
 import aiohttp
 import aiohttp.web
@@ -70,6 +73,7 @@ import pathvalidate
 
 import learning_observer.auth as auth
 import learning_observer.google
+import learning_observer.http_client
 import learning_observer.kvs
 import learning_observer.log_event as log_event
 from learning_observer.log_event import debug_log
@@ -305,18 +309,18 @@ async def google_ajax(
     '''
     if parameters is None:  # {} should NOT be a default param. See W0102.
         parameters = {}
-    async with aiohttp.ClientSession(loop=request.app.loop) as client:
-        # We would like better error handling for what to do if auth_headers
-        # is not set. However, we haven't figured out a better thing to do.
-        # We saw this happen due to a bug, but similar bugs might come up
-        # in the future (we forgot to propagate the headers from the
-        # session).
-        async with client.get(url.format(**parameters), headers=request["auth_headers"]) as resp:
-            resp_json = await resp.json()
-            log_event.log_ajax(url, resp_json, request)
-            return clean_google_ajax_data(
-                resp_json, key, sort_key, default=default
-            )
+    client = learning_observer.http_client.client_session('google')
+    # We would like better error handling for what to do if auth_headers
+    # is not set. However, we haven't figured out a better thing to do.
+    # We saw this happen due to a bug, but similar bugs might come up
+    # in the future (we forgot to propagate the headers from the
+    # session).
+    async with client.get(url.format(**parameters), headers=request["auth_headers"]) as resp:
+        resp_json = await resp.json()
+        log_event.log_ajax(url, resp_json, request)
+        return clean_google_ajax_data(
+            resp_json, key, sort_key, default=default
+        )
 
 ajax = None
 
@@ -389,6 +393,112 @@ def init():
     return ajax
 
 
+# Rosters change rarely, but we're asked for them constantly: by every
+# dashboard connection, and by every run of every execution DAG which
+# uses `learning_observer.courseroster`. We keep each teacher's roster
+# for each course for `ttl` seconds. For `stale` seconds after that, we
+# still serve it, but fetch a fresh copy in the background, so nobody
+# waits on Google. These can be overridden in a `cache` section under
+# `roster_data` in the settings. A `ttl` of 0 turns the cache off.
+DEFAULT_ROSTER_TTL = 60
+DEFAULT_ROSTER_STALE = 600
+
+# Rosters, as `(course_id, user_id): (fetched, roster)`
+_ROSTERS = {}
+
+# Roster fetches in progress, by the same key
+_ROSTER_FETCHES = {}
+
+
+def roster_cache_settings():
+    config = settings.settings['roster_data'].get('cache', {})
+    return (
+        config.get('ttl', DEFAULT_ROSTER_TTL),
+        config.get('stale', DEFAULT_ROSTER_STALE)
+    )
+
+
+def invalidate_roster_cache(course_id=None, user_id=None):
+    '''
+    Forget cached rosters: for one course, for one teacher, for one
+    teacher's course, or (by default) all of them. The next request
+    fetches them again (from Google, rather than Google's cached
+    response; see `google.invalidate_google_cache`).
+    '''
+    for key in list(_ROSTERS):
+        if (course_id is None or key[0] == str(course_id)) and (user_id is None or key[1] == user_id):
+            del _ROSTERS[key]
+    learning_observer.google.invalidate_google_cache('course_roster', user_id=user_id, courseId=course_id)
+
+
+def _fetch_roster(key, fetch):
+    '''
+    Start fetching a roster, unless we already are. Returns the fetch.
+    '''
+    if key not in _ROSTER_FETCHES:
+        async def fetch_and_store():
+            roster = await fetch()
+            # Errors come back as a dictionary rather than a list. We
+            # don't want to hold on to those.
+            if isinstance(roster, list):
+                _ROSTERS[key] = (time.time(), roster)
+            return roster
+        task = asyncio.ensure_future(fetch_and_store())
+        _ROSTER_FETCHES[key] = task
+
+        def done(task):
+            _ROSTER_FETCHES.pop(key, None)
+            if not task.cancelled() and task.exception() is not None:
+                debug_log("Could not fetch roster", key, task.exception())
+        task.add_done_callback(done)
+    return _ROSTER_FETCHES[key]
+
+
+async def cached_roster(request, course_id, fetch, ttl=None, stale=None):
+    '''
+    The roster for `course_id`, as seen by the user making `request`,
+    from the cache if we can. `fetch()` is a coroutine function which
+    fetches it. `ttl` and `stale` default to the settings.
+
+    Once a roster is older than `ttl`, we still return it, but fetch a
+    new one for next time:
+
+    >>> fetches = []
+    >>> async def fetch():
+    ...     fetches.append('fetch')
+    ...     return [{'user_id': f'student-{len(fetches)}'}]
+    >>> async def run():
+    ...     first = await cached_roster(None, 'doctest', fetch, ttl=0.05, stale=10)
+    ...     await asyncio.sleep(0.06)
+    ...     stale = await cached_roster(None, 'doctest', fetch, ttl=0.05, stale=10)
+    ...     await asyncio.sleep(0)
+    ...     fresh = await cached_roster(None, 'doctest', fetch, ttl=0.05, stale=10)
+    ...     return first, stale, fresh
+    >>> asyncio.run(run())
+    ([{'user_id': 'student-1'}], [{'user_id': 'student-1'}], [{'user_id': 'student-2'}])
+    >>> invalidate_roster_cache('doctest')
+    '''
+    if ttl is None or stale is None:
+        default_ttl, default_stale = roster_cache_settings()
+        ttl = default_ttl if ttl is None else ttl
+        stale = default_stale if stale is None else stale
+    if not ttl:
+        return await fetch()
+    user = request.get('user') if request is not None else None
+    key = (str(course_id), user.get('user_id') if user else None)
+
+    if key in _ROSTERS:
+        fetched, roster = _ROSTERS[key]
+        age = time.time() - fetched
+        if age < ttl + stale:
+            if age >= ttl:
+                # Serve what we have, and refresh it for next time
+                _fetch_roster(key, fetch)
+            return copy.deepcopy(roster)
+    # Several dashboards opening at once share one fetch
+    return copy.deepcopy(await asyncio.shield(_fetch_roster(key, fetch)))
+
+
 async def courselist(request):
     '''
     List all of the courses a teacher manages: Helper
@@ -420,6 +530,18 @@ async def courseroster_runtime(runtime, course_id):
 async def courseroster(request, course_id):
     '''
     List all of the students in a course: Helper
+
+    Rosters are cached; see `cached_roster`.
+    '''
+    async def fetch():
+        return await fetch_courseroster(request, course_id)
+    return await cached_roster(request, course_id, fetch)
+
+
+async def fetch_courseroster(request, course_id):
+    '''
+    List all of the students in a course, from the roster source,
+    skipping the cache.
     '''
     if settings.settings['roster_data']['source'] in ["google_api"]:
         runtime = learning_observer.runtime.Runtime(request)
@@ -76,9 +76,11 @@ def init():
         context = reducer['context']
         function = reducer['function']
         scope = reducer.get('scope', helpers.Scope([helpers.KeyField.STUDENT]))
+        events = reducer.get('events', None)
         srm[context].append({
             'reducer': function,
-            'scope': scope
+            'scope': scope,
+            'events': frozenset(events) if events is not None else None
         })
 
     global REDUCER_MODULES
@@ -33,10 +33,13 @@ reducers (per-student, per-resource, etc.). For now, though, this
 works.
 '''
 
+import asyncio
 import copy
 import functools
+import time
 
 import learning_observer.kvs
+import learning_observer.pubsub.key_changes
 from learning_observer.stream_analytics.fields import KeyStateType, KeyField, EventField, Scope
 
 from learning_observer.log_event import debug_log
@@ -186,11 +189,137 @@ def make_key(func, key_dict, state_type):
     return ",".join(key_list)
 
 
+# Large reducer states (e.g. a whole essay) can be stored in parts: a
+# main value, plus one key for each large field. The main value has a
+# `_parts` field mapping each of those fields to the key it lives
+# under. Readers who don't need the large fields don't fetch them, and
+# writers only rewrite the parts which changed. See `parts` in
+# `kvs_pipeline`.
+PARTS_FIELD = '_parts'
+
+
+def make_part_key(key, field):
+    '''
+    The key we store one field of a multi-part state under.
+
+    >>> make_part_key('Internal,writing_observer.reconstruct,STUDENT:bob', 'text')
+    'Internal,writing_observer.reconstruct,STUDENT:bob,Part:text'
+    '''
+    return "{key},Part:{field}".format(key=key, field=field)
+
+
+def split_state(key, state, parts, shared=None):
+    '''
+    Split `state` (stored under `key`) into a main value, and a
+    dictionary of part keys to values, for each field in `parts`.
+
+    If `shared` (a dictionary of fields to part keys) tells us a field
+    is already stored elsewhere, we point to it rather than storing
+    another copy.
+
+    >>> split_state('k', {'text': 'Hi', 'position': 2}, ['text'])
+    ({'position': 2, '_parts': {'text': 'k,Part:text'}}, {'k,Part:text': 'Hi'})
+    '''
+    if not parts or not isinstance(state, dict):
+        return state, {}
+    main = dict(state)
+    main[PARTS_FIELD] = {}
+    part_values = {}
+    for field in parts:
+        if field not in main:
+            continue
+        value = main.pop(field)
+        if shared is not None and field in shared:
+            main[PARTS_FIELD][field] = shared[field]
+        else:
+            part_key = make_part_key(key, field)
+            main[PARTS_FIELD][field] = part_key
+            part_values[part_key] = value
+    return main, part_values
+
+
+async def assemble_states(kvs, states, fields=None):
+    '''
+    Fill in the parts of multi-part states we've read from the KVS,
+    in-place. States which aren't multi-part are left alone. If
+    `fields` is given, we only fetch those fields; the rest are
+    left out.
+
+    This is a single `multiget`, however many states we're given.
+    '''
+    part_keys = {}  # Used as an ordered set
+    for state in states:
+        if isinstance(state, dict) and PARTS_FIELD in state:
+            for field, part_key in state[PARTS_FIELD].items():
+                if fields is None or field in fields:
+                    part_keys[part_key] = True
+    part_keys = list(part_keys)
+    part_values = dict(zip(part_keys, await kvs.multiget(part_keys))) if part_keys else {}
+    for state in states:
+        if isinstance(state, dict) and PARTS_FIELD in state:
+            for field, part_key in state.pop(PARTS_FIELD).items():
+                if part_key in part_values:
+                    state[field] = part_values[part_key]
+    return states
+
+
+class ReducerFailure(Exception):
+    '''
+    A reducer failed on some of the keys in a batch of events. The other
+    keys were still reduced and written.
+
+    * `failures` is a list of `(events, exception)`, one for each key
+      which failed, with the events which reduce into that key
+    * `external_states` are the external states of the keys which
+      didn't fail
+
+    >>> saved_kvs, learning_observer.kvs.KVS = learning_observer.kvs.KVS, learning_observer.kvs.InMemoryKVS
+    >>> @kvs_pipeline(scope=Scope([KeyField.STUDENT, EventField('doc')]), batch=True,
+    ...               module_override='doctest', qualname_override='length')
+    ... async def length(events, state):
+    ...     if any(event['text'] is None for event in events):
+    ...         raise ValueError("No text")
+    ...     return False, sum(len(event['text']) for event in events)
+    >>> async def run():
+    ...     pipeline = await length({'auth': {'safe_user_id': 'bob'}})
+    ...     try:
+    ...         await pipeline.process_events([
+    ...             ({'text': 'Hello'}, {'doc': 'a'}),
+    ...             ({'text': None}, {'doc': 'b'}),
+    ...             ({'text': '!'}, {'doc': 'a'})
+    ...         ])
+    ...     except ReducerFailure as e:
+    ...         print(e.failures, e.external_states)
+    ...     return await learning_observer.kvs.KVS()['External,doctest.length,EventField.doc:a,STUDENT:bob']
+    >>> asyncio.run(run())
+    [([{'text': None}], ValueError('No text'))] [6]
+    6
+    >>> learning_observer.kvs.KVS = saved_kvs
+    '''
+    def __init__(self, failures, external_states):
+        super().__init__(f"Reducer failed on {len(failures)} key(s): {failures[0][1]!r}")
+        self.failures = failures
+        self.external_states = external_states
+
+
+# Defaults for write-behind reducers (see `kvs_pipeline`). We flush
+# internal state at least this often (in seconds)...
+WRITE_BEHIND_FLUSH_INTERVAL = 1.0
+# ... or after this many events, whichever comes first.
+WRITE_BEHIND_FLUSH_EVENTS = 25
+
+
 def kvs_pipeline(
         null_state=None,
         scope=None,
         module_override=None,
-        qualname_override=None
+        qualname_override=None,
+        write_behind=False,
+        flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+        flush_events=WRITE_BEHIND_FLUSH_EVENTS,
+        events=None,
+        batch=False,
+        parts=None
 ):
     '''
     Closures, anyone?
@@ -204,6 +333,65 @@ def kvs_pipeline(
       happened. This can be important for the aggregator. We're documenting the
       code before we've written it, so please make sure this works before using.
     * `scope` tells us the scope we reduce over. See `fields.Scope`
+    * `write_behind` keeps internal state in memory for the lifetime of
+      the pipeline (typically, one websocket session), rather than reading
+      and writing the KVS on every event. Dirty internal state is written
+      back every `flush_interval` seconds or `flush_events` events,
+      whichever comes first, and when the pipeline is flushed on close.
+      External state is still written on every event, so dashboards see
+      updates promptly.
+    * `events` is an optional list of the event types (`client.event`) the
+      reducer cares about. The event pipeline uses this to avoid calling
+      the reducer -- and reading its state from the KVS -- for any other
+      events. `None` means all events.
+    * `batch` marks the reducer as batch-aware: rather than a single event,
+      it takes the list of events (in order) which reduce into one key,
+      and returns the state after all of them. Reducers which aren't
+      batch-aware still work with batched ingestion; we just fold the
+      events through them one at a time.
+    * `parts` is an optional list of (large) fields of the state to store
+      under their own keys (see `split_state`). Unchanged parts aren't
+      rewritten, and if the external state shares a part with the
+      internal state, it's stored once.
+
+    Write-behind relies on the session owning its keys. If a student is
+    e.g. editing the same document from two computers at once, the two
+    sessions will overwrite each other's internal state. This is the same
+    concurrency story as described in `process_event`, but the window is
+    a flush interval rather than a round trip.
+
+    If a flush fails, nothing is lost: the state stays dirty, and the
+    next flush writes it. For example, with a KVS which is down for a
+    bit:
+
+    >>> class FlakyKVS(learning_observer.kvs.InMemoryKVS):
+    ...     down = True
+    ...     async def multiset(self, items):
+    ...         if FlakyKVS.down:
+    ...             raise ConnectionError("KVS is down")
+    ...         return await super().multiset(items)
+    >>> saved_kvs, learning_observer.kvs.KVS = learning_observer.kvs.KVS, FlakyKVS
+    >>> @kvs_pipeline(scope=Scope([KeyField.STUDENT]), write_behind=True, flush_interval=0.01,
+    ...               module_override='doctest', qualname_override='count')
+    ... async def count(event, state):
+    ...     return {'n': (state or {}).get('n', 0) + 1}, False
+    >>> async def run():
+    ...     pipeline = await count({'auth': {'safe_user_id': 'bob'}})
+    ...     await pipeline({})
+    ...     try:
+    ...         await pipeline.flush()
+    ...     except ConnectionError as e:
+    ...         print("Flush failed:", e)
+    ...     # Timed flushes keep retrying, every `flush_interval`
+    ...     await pipeline({})
+    ...     await asyncio.sleep(0.05)
+    ...     FlakyKVS.down = False
+    ...     await asyncio.sleep(0.05)
+    ...     return await FlakyKVS()['Internal,doctest.count,STUDENT:bob']
+    >>> asyncio.run(run())
+    Flush failed: KVS is down
+    ...{'n': 2}
+    >>> learning_observer.kvs.KVS = saved_kvs
     '''
     if scope is None:
         debug_log("TODO: explicitly specify a scope")
@@ -235,6 +423,7 @@ def kvs_pipeline(
             setattr(func, '__qualname__', qualname_override)
         if module_override is not None:
             setattr(func, '__module__', module_override)
+        event_filter = frozenset(events) if events is not None else None
 
         @functools.wraps(func)
         async def wrapper_closure(metadata):
@@ -248,19 +437,219 @@ def kvs_pipeline(
             '''
             taskkvs = learning_observer.kvs.KVS()
 
-            async def process_event(event, event_fields={}):
+            # Write-behind state. `cache` holds the internal state for every
+            # key this pipeline has touched, and `dirty` the subset which has
+            # not yet made it to the KVS. `dirty` counts changes to each key,
+            # so a flush can tell if a key changed again while it was being
+            # written.
+            cache = {}
+            dirty = {}
+            # For multi-part state: the last value of each part we read
+            # or wrote, so we can skip writing parts which didn't change.
+            known_parts = {}
+            flush_state = {
+                'events': 0,
+                'handle': None,
+                'task': None
+            }
+
+            def mark_dirty(key):
+                dirty[key] = dirty.get(key, 0) + 1
+
+            async def flush():
+                '''
+                Write any dirty internal state back to the KVS. This is
+                a no-op if we're not in write-behind mode.
+
+                We copy state before writing, since reducers are allowed
+                to mutate their internal state in-place. Keys stay dirty
+                until the write succeeds, so if it fails, the next flush
+                tries again. Keys which change again while we're writing
+                stay dirty too.
+                '''
+                if flush_state['handle'] is not None:
+                    flush_state['handle'].cancel()
+                    flush_state['handle'] = None
+                flush_state['events'] = 0
+                if not dirty:
+                    return
+                written = dict(dirty)
+                updates = []
+                for key in written:
+                    updates.extend(state_updates(key, copy.deepcopy(cache[key]))[0])
+                await taskkvs.multiset(updates)
+                for key, changes in written.items():
+                    if dirty.get(key) == changes:
+                        del dirty[key]
+                learning_observer.pubsub.key_changes.publish(key for key, value in updates)
+
+            def flush_done(task):
+                '''
+                Nobody awaits a timed flush, so we check how it went here.
+                If it failed, the keys are still dirty; we log the error
+                and try again after another `flush_interval`.
+                '''
+                if flush_state['task'] is task:
+                    flush_state['task'] = None
+                if task.cancelled():
+                    return
+                error = task.exception()
+                if error is not None:
+                    debug_log(f"Write-behind flush failed: {error!r}")
+                    if dirty:
+                        schedule_flush()
+
+            def start_flush():
+                task = asyncio.ensure_future(flush())
+                flush_state['task'] = task
+                task.add_done_callback(flush_done)
+
+            def state_updates(key, state, shared=None):
+                '''
+                The writes needed to store `state` under `key`. Without
+                `parts`, that's just `(key, state)`. Otherwise, it's the
+                main value, plus any parts which changed. We also return
+                where each part lives.
+                '''
+                main, part_values = split_state(key, state, parts, shared)
+                updates = [(key, main)]
+                for part_key, value in part_values.items():
+                    # If keys expire, we can't skip rewriting a part, or
+                    # it might expire out from under the main value.
+                    unchanged = part_key in known_parts and known_parts[part_key] == value
+                    if unchanged and getattr(taskkvs, 'expire', None) is None:
+                        continue
+                    known_parts[part_key] = copy.deepcopy(value)
+                    updates.append((part_key, value))
+                if isinstance(main, dict):
+                    return updates, main.get(PARTS_FIELD)
+                return updates, None
+
+            def schedule_flush():
+                '''
+                Make sure dirty state gets written within `flush_interval`,
+                even if no more events arrive.
+                '''
+                if flush_state['handle'] is None:
+                    flush_state['handle'] = asyncio.get_running_loop().call_later(
+                        flush_interval,
+                        start_flush
+                    )
+
+            async def read_internal_state(internal_key):
                 '''
-                This is the function which processes events. It calls the event
-                processor, passes in the event(s) and state. It takes
+                Grab internal state from the cache, if we have it, and from
+                the KVS otherwise.
+                '''
+                if write_behind and internal_key in cache:
+                    return cache[internal_key]
+                internal_state = await taskkvs[internal_key]
+                if parts and isinstance(internal_state, dict) and PARTS_FIELD in internal_state:
+                    part_keys = internal_state[PARTS_FIELD]
+                    await assemble_states(taskkvs, [internal_state])
+                    for field, part_key in part_keys.items():
+                        if field in internal_state:
+                            known_parts[part_key] = copy.deepcopy(internal_state[field])
+                if internal_state is None:
+                    internal_state = copy.deepcopy(null_state)
+                    if write_behind:
+                        mark_dirty(internal_key)
+                    else:
+                        await taskkvs.set(internal_key, internal_state)
+                if write_behind:
+                    cache[internal_key] = internal_state
+                return internal_state
+
+            def make_keys(event_fields):
+                '''
+                Figure out which internal and external keys an event
+                reduces into, based on the scope and the auth metadata.
+                '''
+                keydict = {}
+                # Step 1: Handle auth metadata.
+                if KeyField.STUDENT in scope:
+                    if metadata is not None and 'auth' in metadata:
+                        safe_user_id = metadata['auth']['safe_user_id']
+                    else:
+                        # In general, this path should NOT be followed. If we
+                        # want guest accounts, each user ought to have a unique
+                        # identifier or cookie assigned on first access.
+                        safe_user_id = '[guest]'
+                    keydict[KeyField.STUDENT] = safe_user_id
+
+                # Step 2: Handle all other metadata.
+                for field in scope:
+                    # We don't want to override auth fields
+                    if field in keydict:
+                        pass
+                    elif isinstance(field, EventField):
+                        keydict[field] = event_fields.get(field.event, None)
+                    else:
+                        raise Exception("Unknown field", field)
+
+                internal_key = make_key(
+                    func,
+                    keydict,
+                    KeyStateType.INTERNAL
+                )
+                external_key = make_key(
+                    func,
+                    keydict,
+                    KeyStateType.EXTERNAL
+                )
+                return internal_key, external_key
+
+            async def reduce_events(internal_key, events):
+                '''
+                Run a list of events, all of which reduce into the same
+                key, through the reducer, starting from a single read of
+                the internal state.
+
+                Batch-aware reducers get the whole list at once. Otherwise,
+                we fold the events through the reducer one at a time, in
+                memory. Either way, we return the final internal state (or
+                `False` if nothing changed) and the final external state
+                (or `False` if there is nothing to write).
+                '''
+                internal_state = await read_internal_state(internal_key)
+                if batch:
+                    return await func(events, internal_state)
+
+                changed = False
+                external_state = False
+                for event in events:
+                    new_internal_state, new_external_state = await func(
+                        event, internal_state
+                    )
+                    if new_internal_state is not False:
+                        internal_state = new_internal_state
+                        changed = True
+                    if new_external_state is not False:
+                        external_state = new_external_state
+                return (internal_state if changed else False), external_state
+
+            async def process_events(events):
+                '''
+                This is the function which processes events. It takes a
+                list of `(event, event_fields)` pairs, groups them by the
+                key they reduce into, and calls the event processor once
+                per key, passing in the event(s) and state. It takes
                 the internal state and the external state from the
                 event processor. The internal state goes into the KVS
                 for use in the next call, while the external state
                 returns to the dashboard.
 
+                Each key is read once and written once per call, however
+                many events it covers, so handing us a batch of events
+                saves a pile of KVS round trips. Events for a key are
+                reduced in the order given.
+
                 The external state should include everything needed
                 for the dashboard visualization and exclude anything
                 large or private. The internal state needs everything
                 needed to continue reducing the events.
+
+                Returns the list of external states, one per key.
                 '''
                 # TODO: Think through concurrency.
                 #
@@ -295,56 +684,90 @@ def kvs_pipeline(
                 #   enough and probably the right long-term solution
                 # * We could have modules explicitly indicate where they need
                 #   thread safety and transactions. That'd be easy enough.
-                keydict = {}
-                # Step 1: Handle auth metadata.
-                if KeyField.STUDENT in scope:
-                    if metadata is not None and 'auth' in metadata:
-                        safe_user_id = metadata['auth']['safe_user_id']
-                    else:
-                        # In general, this path should NOT be followed. If we
-                        # want guest accounts, each user ought to have a unique
-                        # identifier or cookie assigned on first access.
-                        safe_user_id = '[guest]'
-                    keydict[KeyField.STUDENT] = safe_user_id
-
-                # Step 2: Handle all other metadata.
-                for field in scope:
-                    # We don't want to override auth fields
-                    if field in keydict:
-                        pass
-                    elif isinstance(field, EventField):
-                        keydict[field] = event_fields.get(field.event, None)
-                    else:
-                        raise Exception("Unknown field", field)
-
-                internal_key = make_key(
-                    func,
-                    keydict,
-                    KeyStateType.INTERNAL
-                )
-                external_key = make_key(
-                    func,
-                    keydict,
-                    KeyStateType.EXTERNAL
-                )
-
-                internal_state = await taskkvs[internal_key]
-                if internal_state is None:
-                    internal_state = copy.deepcopy(null_state)
-                    await taskkvs.set(internal_key, internal_state)
-
-                internal_state, external_state = await func(
-                    event, internal_state
-                )
+                #
+                # The event pipeline should not send us events we did not ask
+                # for, but other callers (e.g. offline processing) might.
+                groups = {}
+                for event, event_fields in events:
+                    if event_filter is not None and event.get('client', {}).get('event') not in event_filter:
+                        continue
+                    internal_key, external_key = make_keys(event_fields)
+                    if internal_key not in groups:
+                        groups[internal_key] = (external_key, [])
+                    groups[internal_key][1].append(event)
+                if not groups:
+                    return []
+
+                # If the reducer fails on one key, the other keys still
+                # get written.
+                results = await asyncio.gather(*[
+                    reduce_events(internal_key, key_events)
+                    for internal_key, (external_key, key_events) in groups.items()
+                ], return_exceptions=True)
 
                 # We would like to give reducers the option to /not/ write
-                # on all events
-                if internal_state is not False:
-                    await taskkvs.set(internal_key, internal_state)
-                if external_state is not False:
-                    await taskkvs.set(external_key, external_state)
-                return external_state
+                # on all events. Whatever we do write goes out in a single
+                # `multiset`, so this is one round trip to the KVS.
+                updates = []
+                external_states = []
+                failures = []
+                for (internal_key, (external_key, key_events)), result in zip(groups.items(), results):
+                    if isinstance(result, BaseException):
+                        failures.append((key_events, result))
+                        continue
+                    internal_state, external_state = result
+                    internal_parts = None
+                    if internal_state is not False:
+                        if write_behind:
+                            cache[internal_key] = internal_state
+                            mark_dirty(internal_key)
+                        else:
+                            internal_updates, internal_parts = state_updates(internal_key, internal_state)
+                            updates.extend(internal_updates)
+                    if external_state is not False:
+                        # Reducers often return the same values as both
+                        # internal and external state. Those parts only
+                        # need storing once.
+                        shared = None
+                        if internal_parts and isinstance(external_state, dict):
+                            shared = {
+                                field: part_key for field, part_key in internal_parts.items()
+                                if external_state.get(field) is internal_state.get(field)
+                            }
+                        updates.extend(state_updates(external_key, external_state, shared)[0])
+                    external_states.append(external_state)
+                if updates:
+                    await taskkvs.multiset(updates)
+                    # Let dashboards watching these keys know
+                    learning_observer.pubsub.key_changes.publish(key for key, value in updates)
+
+                if write_behind:
+                    flush_state['events'] += sum(len(key_events) for external_key, key_events in groups.values())
+                    if flush_state['events'] >= flush_events:
+                        await flush()
+                    elif dirty:
+                        schedule_flush()
+                if failures:
+                    raise ReducerFailure(failures, external_states) from failures[0][1]
+                return external_states
+
+            async def process_event(event, event_fields={}):
+                '''
+                Process a single event. See `process_events`. Returns the
+                external state, or `False` for events we filtered out.
+                '''
+                external_states = await process_events([(event, event_fields)])
+                if not external_states:
+                    return False
+                return external_states[0]
+            # Callers should `await process_event.flush()` when they are
+            # done with the pipeline (e.g. on socket close).
+            setattr(process_event, 'flush', flush)
+            setattr(process_event, 'process_events', process_events)
             return process_event
+        # This lets the module loader pick up the event filter without
+        # it needing to be repeated in `REDUCERS`.
+        setattr(wrapper_closure, 'events', event_filter)
         return wrapper_closure
     return decorator
 
@@ -0,0 +1,155 @@
+'''
+Benchmark Google Docs document reconstruction
+
+Usage:
+    benchmark_reconstruct.py [--essays=n] [--jump-rate=p] [--save-size=n] [--seed=n]
+
+Options:
+    --essays=n       How many sample essays to glue into one long essay [default: 20]
+    --jump-rate=p    Chance, per keystroke, of moving to a random point in the document [default: 0.01]
+    --save-size=n    Commands per save, when replaying save by save [default: 10]
+    --seed=n         Random seed [default: 0]
+
+Overview:
+    Builds a synthetic `document_history` changelog, as if a student
+    typed out a long essay, with backspaces and the occasional edit
+    somewhere earlier in the document. We replay it through
+    `writing_observer.reconstruct_doc.command_list`, and through a
+    reference implementation which keeps the document as a plain
+    string (as `reconstruct_doc` used to), check they agree, and
+    compare timings.
+
+    We replay it twice: all at once (as for a `document_history`
+    event), and in saves of a few commands, going through JSON in
+    between (as the `reconstruct` reducer does for `google_docs_save`
+    events).
+
+    `google_text` only switches to a rope for long documents (see
+    `reconstruct_doc.ROPE_MIN_LENGTH`), so below about 40k characters,
+    both should take about the same time.
+'''
+
+import random
+import time
+
+import docopt
+
+import writing_observer.reconstruct_doc
+import writing_observer.sample_essays
+
+
+def make_changelog(text, jump_rate):
+    '''
+    Type out `text`, one character at a time, as a list of Google Docs
+    commands. Now and then, we make a typo and backspace over it, or
+    jump somewhere else in the document to add or delete a bit.
+    '''
+    commands = []
+    length = 0
+    cursor = 1
+    for character in text:
+        if random.random() < jump_rate and length > 0:
+            position = random.randint(1, length)
+            if random.random() < 0.5:
+                commands.append({'ty': 'is', 'ibi': position, 's': 'very '})
+                length += 5
+            else:
+                end = min(length, position + random.randint(0, 10))
+                commands.append({'ty': 'ds', 'si': position, 'ei': end})
+                length -= end - position + 1
+                if cursor > length + 1:
+                    cursor = length + 1
+        if random.random() < 0.03:
+            commands.append({'ty': 'is', 'ibi': cursor, 's': 'x'})
+            commands.append({'ty': 'ds', 'si': cursor, 'ei': cursor})
+        commands.append({'ty': 'is', 'ibi': cursor, 's': character})
+        cursor += 1
+        length += 1
+    return commands
+
+
+def string_command_list(text, commands):
+    '''
+    The reference implementation: rebuild the string on every command.
+    We keep the same cursor / length metadata `google_text` does, so
+    the comparison is fair.
+    '''
+    cursor = []
+    length = []
+    for command in commands:
+        if command['ty'] == 'is':
+            ibi = command['ibi']
+            text = "{start}{insert}{end}".format(
+                start=text[0:ibi - 1],
+                insert=command['s'],
+                end=text[ibi - 1:]
+            )
+            position = ibi + len(command['s'])
+        elif command['ty'] == 'ds':
+            text = "{start}{end}".format(
+                start=text[0:command['si'] - 1],
+                end=text[command['ei']:]
+            )
+            position = command['si']
+        length.append(len(text))
+        cursor.append(position)
+    return text
+
+
+def replay_saves(commands, save_size):
+    '''
+    Replay `commands` a few at a time, serializing the document between
+    saves, the way the `reconstruct` reducer does.
+    '''
+    state = None
+    for start in range(0, len(commands), save_size):
+        doc = writing_observer.reconstruct_doc.google_text.from_json(state)
+        doc = writing_observer.reconstruct_doc.command_list(doc, commands[start:start + save_size])
+        state = doc.json
+    return state['text']
+
+
+if __name__ == '__main__':
+    ARGS = docopt.docopt(__doc__)
+    random.seed(int(ARGS['--seed']))
+    essays = writing_observer.sample_essays.ARGUMENTATIVE_ESSAYS + writing_observer.sample_essays.SHORT_STORIES
+    essay = "\n\n".join(random.choice(essays) for i in range(int(ARGS['--essays'])))
+    changelog = make_changelog(essay, float(ARGS['--jump-rate']))
+    print("Replaying {commands} commands, for {characters} characters".format(
+        commands=len(changelog),
+        characters=len(essay)
+    ))
+
+    start = time.time()
+    reference = string_command_list("", changelog)
+    string_time = time.time() - start
+    print("String:\t{t:.3f} seconds".format(t=string_time))
+
+    start = time.time()
+    doc = writing_observer.reconstruct_doc.command_list(
+        writing_observer.reconstruct_doc.google_text(), changelog
+    )
+    rope_time = time.time() - start
+    print("google_text:\t{t:.3f} seconds".format(t=rope_time))
+
+    if str(doc) != reference:
+        raise Exception("Reconstructed documents don't match!")
+    print("Speedup:\t{s:.1f}x".format(s=string_time / rope_time))
+
+    # Save by save, with and without ropes
+    save_size = int(ARGS['--save-size'])
+    rope_min_length = writing_observer.reconstruct_doc.ROPE_MIN_LENGTH
+    writing_observer.reconstruct_doc.ROPE_MIN_LENGTH = float('inf')
+    start = time.time()
+    replay_saves(changelog, save_size)
+    string_saves_time = time.time() - start
+    writing_observer.reconstruct_doc.ROPE_MIN_LENGTH = rope_min_length
+    print("Saves, string:\t{t:.3f} seconds".format(t=string_saves_time))
+
+    start = time.time()
+    saved = replay_saves(changelog, save_size)
+    saves_time = time.time() - start
+    print("Saves, google_text:\t{t:.3f} seconds".format(t=saves_time))
+    if saved != reference:
+        raise Exception("Reconstructed documents don't match!")
+    print("Speedup:\t{s:.1f}x".format(s=string_saves_time / saves_time))
@@ -3,11 +3,8 @@ A thin, async wrapper to languagetool
 '''
 
 import asyncio
-import inspect
 
-import aiohttp
-
-session = None
+import learning_observer.http_client
 
 
 async def check(language, text):
@@ -18,22 +15,17 @@ async def check(language, text):
     check
     '''
 
-    global session
-    if session is None:
-        session = aiohttp.ClientSession()
-    if inspect.iscoroutinefunction(session):
-        session = await session
+    session = learning_observer.http_client.client_session('languagetool')
 
     query = {
         'language': language,
         'text': text
     }
-    resp = await session.post(
+    async with session.post(
         'http://localhost:8081/v2/check',
         data=query
-    )
-
-    return await resp.json()
+    ) as resp:
+        return await resp.json()
 
 
 async def main():
@@ -44,7 +36,7 @@ async def main():
     print(en['matches'])
     pl = await check('pl', 'Sprawdzamy awarje, ale nie ma...')
     print(en['matches'])
-    await session.close()
+    await learning_observer.http_client.close_client_sessions()
 
 
 if __name__ == '__main__':
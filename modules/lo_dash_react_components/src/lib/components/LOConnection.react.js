@@ -1,6 +1,63 @@
 import {Component} from 'react';
 import PropTypes from 'prop-types';
 
+/*
+ * Delta-encoded updates (see `learning_observer/delta.py`). This is
+ * the same as `DeltaDecoder` in `communication_protocol/query.js`.
+ */
+function unescapePointer(token) {
+    return token.replace(/~1/g, '/').replace(/~0/g, '~');
+}
+
+function applyPatch(document, patch) {
+    for (const operation of patch) {
+        if (operation.path === '') {
+            document = operation.value;
+            continue;
+        }
+        const tokens = operation.path.split('/').slice(1).map(unescapePointer);
+        let parent = document;
+        for (const token of tokens.slice(0, -1)) {
+            parent = Array.isArray(parent) ? parent[parseInt(token)] : parent[token];
+        }
+        const last = Array.isArray(parent) ? parseInt(tokens[tokens.length - 1]) : tokens[tokens.length - 1];
+        if (operation.op === 'remove') {
+            if (Array.isArray(parent)) {
+                parent.splice(last, 1);
+            } else {
+                delete parent[last];
+            }
+        } else {
+            parent[last] = operation.value;
+        }
+    }
+    return document;
+}
+
+class DeltaDecoder {
+    constructor() {
+        this.data = null;
+        this.seq = null;
+    }
+
+    // Returns the current payload, or `null` if we missed a message
+    decode(message) {
+        if (message.type === 'full') {
+            this.data = message.data;
+            this.seq = message.seq;
+            return this.data;
+        }
+        if (this.seq === null || message.seq !== this.seq + 1) {
+            this.data = null;
+            this.seq = null;
+            return null;
+        }
+        this.data = applyPatch(this.data, message.patch);
+        this.seq = message.seq;
+        return this.data;
+    }
+}
+
 /**
  * A simple web socket interface to the Learning Observer
  *
@@ -37,6 +94,13 @@ export default class LOConnection extends Component {
         // Determine url
         const protocol = {"http:": "ws:", "https:": "wss:"}[window.location.protocol];
         url = url ? url : `${protocol}//${window.location.hostname}:${window.location.port}/wsapi/communication_protocol`;
+        // Ask for patches rather than the whole payload each time. We
+        // decode them here, so `message.data` is always the whole thing.
+        const {delta} = this.props;
+        if (delta) {
+            url = `${url}${url.includes('?') ? '&' : '?'}delta=true`;
+        }
+        this.decoder = new DeltaDecoder();
         this.client = new WebSocket(url);
         // Listen for events.
         this.client.onopen = (e) => {
@@ -53,10 +117,23 @@ export default class LOConnection extends Component {
             })
         }
         this.client.onmessage = (e) => {
+            let data = e.data;
+            if (delta) {
+                const decoded = this.decoder.decode(JSON.parse(e.data));
+                if (decoded === null) {
+                    // We missed an update. Asking again gets us the
+                    // whole payload.
+                    if (this.lastSent) {
+                        this.client.send(this.lastSent);
+                    }
+                    return;
+                }
+                data = JSON.stringify(decoded);
+            }
             // TODO: Add more properties here?
             this.props.setProps({
                 message: {
-                    data: e.data,
+                    data: data,
                     isTrusted: e.isTrusted,
                     origin: e.origin,
                     timeStamp: e.timeStamp
@@ -94,6 +171,7 @@ export default class LOConnection extends Component {
         if (send && send !== prevProps.send) {
             if (this.props.state.readyState === WebSocket.OPEN) {
                 this.client.send(send)
+                this.lastSent = send;
             }
         }
         // Close and re-open the websocket with new data
@@ -115,7 +193,8 @@ export default class LOConnection extends Component {
 }
 
 LOConnection.defaultProps = {
-    state: {readyState: WebSocket.CONNECTING}
+    state: {readyState: WebSocket.CONNECTING},
+    delta: true
 }
 
 LOConnection.propTypes = {
@@ -150,6 +229,13 @@ LOConnection.propTypes = {
      */
     data_scope: PropTypes.object,
 
+    /**
+     * Ask the server for delta-encoded updates. These are decoded
+     * before `message` is set, so this only changes what goes over
+     * the network.
+     */
+    delta: PropTypes.bool,
+
     /**
      * The ID used to identify this component in Dash callbacks.
      */
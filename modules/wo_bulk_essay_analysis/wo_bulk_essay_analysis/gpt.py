@@ -61,7 +61,9 @@ async def process_student_essay(text, prompt, system_prompt, tags):
     executor = ThreadPoolExecutor()
     copy_tags = tags.copy()
 
-    @learning_observer.cache.async_memoization()
+    # The same prompt gets (about) the same feedback, so we can keep it
+    # for a while
+    @learning_observer.cache.async_memoization(ttl=24 * 60 * 60)
     async def gpt(gpt_prompt):
         loop = asyncio.get_event_loop()
         partial = functools.partial(gpt_responder.chat_completion, prompt=gpt_prompt, system_prompt=system_prompt)
@@ -10,12 +10,22 @@ import time
 import learning_observer.cache
 import learning_observer.communication_protocol.integration
 import learning_observer.kvs
+import learning_observer.pubsub.key_changes
 import learning_observer.settings
 from learning_observer.stream_analytics.fields import KeyField, KeyStateType, EventField
 import learning_observer.stream_analytics.helpers
 # import traceback
 import learning_observer.util
 
+import writing_observer.reconstruct_doc
+
+# How many points of Deane graph data we send to the dashboard, per student
+DEANE_GRAPH_POINTS = 64
+
+# How often (in seconds) we re-fetch a student's document from Google
+# to correct the reconstructed text
+GOOGLE_DOC_REFRESH_INTERVAL = 5 * 60
+
 
 def excerpt_active_text(
     text, cursor_position,
@@ -55,6 +65,27 @@ def excerpt_active_text(
     return clipped_text
 
 
+def downsample_edit_metadata(edit_metadata, points=DEANE_GRAPH_POINTS):
+    '''
+    Decode stored edit metadata (see `reconstruct_doc`), and thin it out
+    to at most `points` evenly-spaced samples, which is plenty to draw
+    a Deane graph.
+
+    >>> downsample_edit_metadata({'cursor': [1, 2, 3, 4, 5], 'length': [1, 2, 3, 4, 5]}, points=2)
+    {'cursor': [2, 5], 'length': [2, 5], 'stride': 3}
+    '''
+    decoded = writing_observer.reconstruct_doc.decode_edit_metadata(edit_metadata)
+    cursor = decoded.get('cursor', [])
+    length = decoded.get('length', [])
+    step = max(1, -(-len(cursor) // points))
+    start = (len(cursor) - 1) % step
+    return {
+        'cursor': cursor[start::step],
+        'length': length[start::step],
+        'stride': decoded['stride'] * step
+    }
+
+
 def sanitize_and_shrink_per_student_data(student_data):
     '''
     This function is run over the data for **each student**, one-by-one.
@@ -79,12 +110,15 @@ def sanitize_and_shrink_per_student_data(student_data):
     # code needs to move out of here. Shoo, shoo.
     student_data['writing_observer_compiled'] = {
         "text": excerpt_active_text(text, cursor_position),
-        "character_count": character_count
+        "character_count": character_count,
+        "edit_metadata": downsample_edit_metadata(
+            student_data['writing_observer.writing_analysis.reconstruct'].get('edit_metadata')
+        )
     }
     # Remove things which are too big to send back. Note: Not benchmarked, so perhaps not too big
     del student_data['writing_observer.writing_analysis.reconstruct']['text']
-    # We should downsample, rather than removing
-    del student_data['writing_observer.writing_analysis.reconstruct']['edit_metadata']
+    # We send the downsampled version, above, instead.
+    student_data['writing_observer.writing_analysis.reconstruct'].pop('edit_metadata', None)
     return student_data
 
 
@@ -170,7 +204,11 @@ async def get_latest_student_documents(student_data):
             KeyStateType.INTERNAL
         ) for s in active_students])
 
-    kvs_data = await kvs.multiget(keys=document_keys)
+    # We don't fetch edit metadata. It'd just get thrown away by
+    # `remove_extra_data`.
+    kvs_data = await learning_observer.stream_analytics.helpers.assemble_states(
+        kvs, await kvs.multiget(keys=document_keys), fields=['text']
+    )
 
     # Return blank entries if no data, rather than None. This makes it possible
     # to use item.get with defaults sanely.  For the sake of later alignment
@@ -247,7 +285,7 @@ async def update_reconstruct_reducer_with_google_api(runtime, doc_ids):
     every time we call this method.
     """
 
-    @learning_observer.cache.async_memoization()
+    @learning_observer.cache.async_memoization(ttl=GOOGLE_DOC_REFRESH_INTERVAL)
     async def fetch_doc_from_google(student, doc_id):
         """
         This method performs the fetching of current document text and the
@@ -269,6 +307,8 @@ async def update_reconstruct_reducer_with_google_api(runtime, doc_ids):
             KeyStateType.INTERNAL
         )
         await kvs.set(key, text)
+        # Dashboards showing this document should update
+        learning_observer.pubsub.key_changes.publish([key])
         return text
 
     if learning_observer.settings.module_setting('writing_observer', 'use_google_documents', False):
@@ -296,7 +336,7 @@ async def update_reconstruct_data_with_google_api(runtime, student_data):
     :param student_data: A list of students
     :return: A list of writing data, one for each student
     """
-    @learning_observer.cache.async_memoization()
+    @learning_observer.cache.async_memoization(ttl=GOOGLE_DOC_REFRESH_INTERVAL)
     async def fetch_doc_from_google(student):
         """
         This function retrieves a single document text from Google based on the document ID.
@@ -320,6 +360,8 @@ async def update_reconstruct_data_with_google_api(runtime, student_data):
             KeyStateType.INTERNAL
         )
         await kvs.set(key, text)
+        # Dashboards showing this document should update
+        learning_observer.pubsub.key_changes.publish([key])
         return text
 
     # For each student, retrieve the document text from Google and store it in a list
@@ -69,7 +69,8 @@ async def process_texts(texts):
 
     initialize_client()
 
-    @learning_observer.cache.async_memoization()
+    # LanguageTool gives the same results for the same text
+    @learning_observer.cache.async_memoization(ttl=24 * 60 * 60)
     async def process_text(text):
         return await client.summarizeText(text)
 
@@ -7,7 +7,117 @@ new.
 See: `http://features.jsomers.net/how-i-reverse-engineered-google-docs/`
 '''
 
+import array
+import base64
+import itertools
 import json
+import sys
+
+import writing_observer.rope
+
+# Edit metadata (the cursor position and document length after each
+# edit; what we need for Deane graphs) would otherwise grow by one
+# entry per keystroke, forever. We keep at most `max_samples` samples.
+# Past that, with `downsample` retention, we drop every other sample
+# and only record every `stride`th edit from then on. With `ring`
+# retention, we keep just the most recent samples.
+#
+# In JSON, the arrays are delta-encoded. With `packed`, the deltas
+# are also packed as 32-bit integers and base64-encoded, which is
+# smaller still, but no longer human-readable.
+EDIT_METADATA_OPTIONS = {
+    'max_samples': 4096,
+    'retention': 'downsample',
+    'packed': False
+}
+
+# Ropes (see `rope.py`) only pay off for long documents with many
+# edits. Each edit to a plain string copies the whole document, but
+# that copy is fast C code: measured per keystroke, the rope only wins
+# somewhere between 32k and 64k characters. Building a rope from a
+# string costs about as much as 60 edits to it. So we start every
+# document as a plain string, and switch to a rope once it's at least
+# `ROPE_MIN_LENGTH` characters, and we've made `ROPE_MIN_EDITS` edits
+# to it at that length. In practice, that means replaying the history
+# of a long document, not applying a handful of edits from one save.
+ROPE_MIN_LENGTH = 40000
+ROPE_MIN_EDITS = 64
+
+
+def _pack(values):
+    '''
+    Base64-encode a list of integers, as little-endian 32-bit ints.
+    '''
+    packed = array.array('i', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode('ascii')
+
+
+def _unpack(encoded):
+    '''
+    The inverse of `_pack`
+    '''
+    packed = array.array('i')
+    packed.frombytes(base64.b64decode(encoded))
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tolist()
+
+
+def encode_edit_metadata(edit_metadata, packed=False):
+    '''
+    Compact edit metadata for storage. We delta-encode the cursor and
+    length arrays (both change slowly from one edit to the next, so
+    this mostly gives us small numbers), and optionally pack them.
+
+    >>> encode_edit_metadata({'cursor': [5, 6, 7], 'length': [4, 5, 6]})
+    {'encoding': 'delta', 'stride': 1, 'pending': 0, 'cursor': [5, 1, 1], 'length': [4, 1, 1]}
+    >>> decode_edit_metadata(encode_edit_metadata({'cursor': [5, 6, 7], 'length': [4, 5, 6]}, packed=True))
+    {'cursor': [5, 6, 7], 'length': [4, 5, 6], 'stride': 1, 'pending': 0}
+    '''
+    encoded = {
+        'encoding': 'delta-base64' if packed else 'delta',
+        'stride': edit_metadata.get('stride', 1),
+        'pending': edit_metadata.get('pending', 0)
+    }
+    for field in ['cursor', 'length']:
+        values = edit_metadata.get(field, [])
+        deltas = values[:1] + [current - previous for previous, current in zip(values, values[1:])]
+        encoded[field] = _pack(deltas) if packed else deltas
+    return encoded
+
+
+def decode_edit_metadata(edit_metadata):
+    '''
+    Turn stored edit metadata back into plain cursor and length arrays.
+    This understands all the formats we've stored: the compact ones
+    from `encode_edit_metadata`, and plain arrays from before we had
+    those.
+
+    `stride` tells us how many edits there are between samples.
+
+    >>> decode_edit_metadata({'cursor': [2], 'length': [1]})
+    {'cursor': [2], 'length': [1], 'stride': 1, 'pending': 0}
+    '''
+    if edit_metadata is None:
+        edit_metadata = {}
+    encoding = edit_metadata.get('encoding', None)
+    decoded = {}
+    for field in ['cursor', 'length']:
+        if field not in edit_metadata:
+            continue
+        values = edit_metadata[field]
+        if encoding == 'delta-base64':
+            values = _unpack(values)
+        if encoding in ['delta', 'delta-base64']:
+            values = list(itertools.accumulate(values))
+        else:
+            values = list(values)
+        decoded[field] = values
+    decoded['stride'] = edit_metadata.get('stride', 1)
+    decoded['pending'] = edit_metadata.get('pending', 0)
+    return decoded
 
 
 class google_text(object):
@@ -15,15 +125,24 @@ class google_text(object):
     We encapsulate a string object to support a Google Doc snapshot at a
     point in time. Right now, this adds cursor position. In the future,
     we might annotate formatting and similar properties.
+
+    The text is a plain string, or, once it's long and we're making
+    a lot of edits, a `Rope`, so that replaying long edit histories
+    doesn't copy the whole document on every keystroke (see
+    `ROPE_MIN_LENGTH`). Either way, it is serialized as a plain string.
+
+    `edit_options` overrides `EDIT_METADATA_OPTIONS`.
     '''
-    def __new__(cls):
+    def __new__(cls, edit_options=None):
         '''
         Constructor. We create a blank document to be populated.
         '''
         new_object = object.__new__(cls)
         new_object._text = ""
+        new_object._string_edits = 0
         new_object._position = 0
         new_object._edit_metadata = {}
+        new_object._edit_options = dict(EDIT_METADATA_OPTIONS, **(edit_options or {}))
         new_object.fix_validity()
         return new_object
 
@@ -70,20 +189,25 @@ class google_text(object):
             print("Mismatching lengths. This should never happen!")
             self._edit_metadata["cursor"] += [0] * -length_difference
             errors_found.append("Mismatching lengths")
+
+        # Downsampling state. Older documents don't have this, which is
+        # fine; they were never downsampled.
+        self._edit_metadata.setdefault("stride", 1)
+        self._edit_metadata.setdefault("pending", 0)
         return errors_found
 
-    def from_json(json_rep):
+    def from_json(json_rep, edit_options=None):
         '''
         Class method to deserialize from JSON
 
         For null objects, it will create a new Google Doc.
         '''
-        new_object = google_text.__new__(google_text)
+        new_object = google_text.__new__(google_text, edit_options)
         if json_rep is None:
             json_rep = {}
         new_object._text = json_rep.get('text', '')
         new_object._position = json_rep.get('position', 0)
-        new_object._edit_metadata = json_rep.get('edit_metadata', {})
+        new_object._edit_metadata = decode_edit_metadata(json_rep.get('edit_metadata', {}))
         new_object.fix_validity()
         return new_object
 
@@ -94,6 +218,39 @@ class google_text(object):
         the cursor should always update too.
         '''
         self._text = text
+        self._string_edits = 0
+
+    def _edited_string(self):
+        '''
+        Note an edit to the text as a plain string, and switch to a rope
+        if it's time to (see `ROPE_MIN_LENGTH`).
+        '''
+        if len(self._text) < ROPE_MIN_LENGTH:
+            return
+        self._string_edits += 1
+        if self._string_edits >= ROPE_MIN_EDITS:
+            self._text = writing_observer.rope.Rope(self._text)
+
+    def insert_text(self, index, text):
+        '''
+        Insert `text` at (0-based) `index`.
+        '''
+        if isinstance(self._text, str):
+            self._text = self._text[:index] + text + self._text[index:]
+            self._edited_string()
+        else:
+            self._text.insert(index, text)
+
+    def delete_text(self, start, end):
+        '''
+        Delete the text from (0-based) `start` to `end`. As with
+        slicing, this leaves `text[:start] + text[end:]`.
+        '''
+        if isinstance(self._text, str):
+            self._text = self._text[:start] + self._text[end:]
+            self._edited_string()
+        else:
+            self._text.delete(start, end)
 
     def len(self):
         '''
@@ -115,16 +272,42 @@ class google_text(object):
 
         Side effect: Update Deane arrays.
         '''
-        self._edit_metadata['length'].append(len(self._text))
-        self._edit_metadata['cursor'].append(p)
+        self._record_edit(p)
         self._position = p
 
+    def _record_edit(self, cursor):
+        '''
+        Add a sample to the Deane arrays, subject to the retention
+        policy in `EDIT_METADATA_OPTIONS`.
+        '''
+        metadata = self._edit_metadata
+        metadata['pending'] += 1
+        if metadata['pending'] < metadata['stride']:
+            return
+        metadata['pending'] = 0
+        metadata['length'].append(len(self._text))
+        metadata['cursor'].append(cursor)
+
+        max_samples = self._edit_options['max_samples']
+        if max_samples is None or len(metadata['cursor']) <= max_samples:
+            return
+        if self._edit_options['retention'] == 'ring':
+            del metadata['cursor'][:-max_samples]
+            del metadata['length'][:-max_samples]
+        else:
+            # Keep every other sample, making sure we keep the latest
+            # one, so samples stay evenly spaced.
+            start = (len(metadata['cursor']) - 1) % 2
+            metadata['cursor'] = metadata['cursor'][start::2]
+            metadata['length'] = metadata['length'][start::2]
+            metadata['stride'] *= 2
+
     @property
     def edit_metadata(self):
         '''
         Return edit metadata. For now, this is length / cursor position
         arrays, but perhaps we should rename this as we expect more
-        analytics.
+        analytics. This is the decoded form; see `decode_edit_metadata`.
         '''
         return self._edit_metadata
 
@@ -132,7 +315,7 @@ class google_text(object):
         '''
         This returns __just__ the text of the document (no metadata)
         '''
-        return self._text
+        return str(self._text)
 
     @property
     def json(self):
@@ -140,9 +323,12 @@ class google_text(object):
         This serializes to JSON.
         '''
         return {
-            'text': self._text,
+            'text': str(self._text),
             'position': self._position,
-            'edit_metadata': self._edit_metadata
+            'edit_metadata': encode_edit_metadata(
+                self._edit_metadata,
+                packed=self._edit_options['packed']
+            )
         }
 
 
@@ -179,11 +365,7 @@ def insert(doc, ty, ibi, s):
     * `ibi` is where the insert happens
     * `s` is the string to insert
     '''
-    doc.update("{start}{insert}{end}".format(
-        start=doc._text[0:ibi - 1],
-        insert=s,
-        end=doc._text[ibi - 1:]
-    ))
+    doc.insert_text(ibi - 1, s)
 
     doc.position = ibi + len(s)
 
@@ -197,10 +379,7 @@ def delete(doc, ty, si, ei):
     * `si` is the index of the start of deletion
     * `ei` is the end
     '''
-    doc.update("{start}{end}".format(
-        start=doc._text[0:si - 1],
-        end=doc._text[ei:]
-    ))
+    doc.delete_text(si - 1, ei)
 
     doc.position = si
 
@@ -0,0 +1,228 @@
+'''
+A rope: a string which supports cheap inserts and deletes in the
+middle.
+
+Python strings are immutable, so editing one character in the middle
+of an essay copies the whole essay. When we replay a document's
+history, that's one copy per keystroke, which is quadratic in the
+length of the document. For a long essay, with tens of thousands of
+edits, this gets slow.
+
+We store the text as a sequence of pieces, held in a treap (a binary
+search tree, balanced by random priorities) keyed on position. Each
+node knows how many characters are in its subtree, so finding,
+splitting, and joining at a position are all O(log n). Typing tends
+to happen in runs, so, where we can, we add text to an existing piece
+rather than making a new one.
+
+>>> r = Rope("Hello world")
+>>> r.insert(5, ",")
+>>> r.delete(0, 1)
+>>> r.insert(0, "J")
+>>> str(r), len(r)
+('Jello, world', 12)
+>>> r.substring(7, 12)
+'world'
+'''
+
+import random
+
+
+# Largest piece we'll grow by typing into it, and the size we chop
+# large strings into. Bigger pieces mean fewer nodes, but more
+# copying per edit.
+MAX_PIECE = 512
+
+
+class _Node(object):
+    '''
+    A node in the treap. Each node has a piece of text; the text of the
+    subtree is the text of the left subtree, then the piece, then the
+    text of the right subtree.
+    '''
+    __slots__ = ('piece', 'priority', 'left', 'right', 'size')
+
+    def __init__(self, piece):
+        self.piece = piece
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = len(piece)
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _update(node):
+    '''
+    Recompute the size of a node after its children changed.
+    '''
+    node.size = _size(node.left) + len(node.piece) + _size(node.right)
+    return node
+
+
+def _merge(left, right):
+    '''
+    Join two treaps, with all of `left` before all of `right`.
+    '''
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+def _split(node, index):
+    '''
+    Split a treap into the first `index` characters, and the rest. If
+    `index` falls inside a piece, we split the piece in two.
+    '''
+    if node is None:
+        return None, None
+    left_size = _size(node.left)
+    piece_end = left_size + len(node.piece)
+    if index <= left_size:
+        left, node.left = _split(node.left, index)
+        return left, _update(node)
+    if index >= piece_end:
+        node.right, right = _split(node.right, index - piece_end)
+        return _update(node), right
+    offset = index - left_size
+    tail = _Node(node.piece[offset:])
+    node.piece = node.piece[:offset]
+    right = _merge(tail, node.right)
+    node.right = None
+    return _update(node), right
+
+
+def _insert_in_place(node, index, text):
+    '''
+    Try to add `text` at `index` to an existing piece, without changing
+    the shape of the tree. Returns `False` if there is no piece with
+    room at that position.
+    '''
+    path = []
+    while node is not None:
+        left_size = _size(node.left)
+        piece_end = left_size + len(node.piece)
+        if index < left_size:
+            path.append(node)
+            node = node.left
+        elif index > piece_end:
+            path.append(node)
+            index -= piece_end
+            node = node.right
+        else:
+            break
+    if node is None or len(node.piece) + len(text) > MAX_PIECE:
+        return False
+    offset = index - left_size
+    node.piece = node.piece[:offset] + text + node.piece[offset:]
+    node.size += len(text)
+    for parent in path:
+        parent.size += len(text)
+    return True
+
+
+def _to_string(root):
+    '''
+    The text of a treap, from an in-order walk.
+    '''
+    pieces = []
+    stack = []
+    node = root
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            pieces.append(node.piece)
+            node = node.right
+    return "".join(pieces)
+
+
+def _from_string(text):
+    '''
+    Build a treap from a string, in pieces of at most `MAX_PIECE`.
+    '''
+    root = None
+    for start in range(0, len(text), MAX_PIECE):
+        root = _merge(root, _Node(text[start:start + MAX_PIECE]))
+    return root
+
+
+class Rope(object):
+    '''
+    A mutable string with O(log n) insert and delete. Indexes are
+    0-based, and slice-like: they are clamped to the string, and
+    negative indexes count from the end.
+    '''
+    def __init__(self, text=""):
+        self._root = _from_string(text)
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __str__(self):
+        '''
+        The whole string. This walks the tree, so it's O(n).
+        '''
+        return _to_string(self._root)
+
+    def _clamp(self, index):
+        '''
+        Treat `index` the way a Python slice would.
+        '''
+        length = len(self)
+        if index < 0:
+            index = max(0, length + index)
+        return min(index, length)
+
+    def substring(self, start, end):
+        '''
+        Equivalent to `str(rope)[start:end]`, without building the
+        whole string.
+        '''
+        start = self._clamp(start)
+        end = self._clamp(end)
+        if end <= start:
+            return ""
+        left, rest = _split(self._root, start)
+        middle, right = _split(rest, end - start)
+        text = _to_string(middle)
+        self._root = _merge(_merge(left, middle), right)
+        return text
+
+    def insert(self, index, text):
+        '''
+        Insert `text` so it starts at `index`.
+        '''
+        if not text:
+            return
+        index = self._clamp(index)
+        if _insert_in_place(self._root, index, text):
+            return
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, _from_string(text)), right)
+
+    def delete(self, start, end):
+        '''
+        Remove the characters from `start` up to (but not including)
+        `end`. Like everything else, this follows slicing: the result
+        is `text[:start] + text[end:]`. Note that if `end` is before
+        `start`, that repeats the text between them.
+        '''
+        start = self._clamp(start)
+        end = self._clamp(end)
+        if end < start:
+            self.insert(start, self.substring(end, start))
+            return
+        left, rest = _split(self._root, start)
+        middle, right = _split(rest, end - start)
+        self._root = _merge(left, right)
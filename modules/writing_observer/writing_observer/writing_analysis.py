@@ -65,7 +65,10 @@ def determine_activity_status(last_ts):
     return {'status': status}
 
 
-@kvs_pipeline(scope=gdoc_scope)
+# Time-on-task and event counts update on every keystroke, and no one
+# else writes their internal state, so we keep it in memory for the
+# session and write it back periodically.
+@kvs_pipeline(scope=gdoc_scope, write_behind=True)
 async def time_on_task(event, internal_state):
     '''
     This adds up time intervals between successive timestamps. If the interval
@@ -93,7 +96,9 @@ async def time_on_task(event, internal_state):
     return internal_state, internal_state
 
 
-@kvs_pipeline(scope=gdoc_scope)
+# The text and edit metadata are big, and most readers only need one
+# of them, so we store them under keys of their own.
+@kvs_pipeline(scope=gdoc_scope, events=['google_docs_save', 'document_history'], parts=['text', 'edit_metadata'])
 async def reconstruct(event, internal_state):
     '''
     This is a thin layer to route events to `reconstruct_doc` which compiles
@@ -104,8 +109,15 @@ async def reconstruct(event, internal_state):
     if event['client']['event'] not in ["google_docs_save", "document_history"]:
         return False, False
 
+    # How much edit metadata to keep, and how to store it. See
+    # `reconstruct_doc.EDIT_METADATA_OPTIONS`.
+    edit_options = learning_observer.settings.module_setting(
+        "writing_observer",
+        "edit_metadata",
+        None
+    )
     internal_state = writing_observer.reconstruct_doc.google_text.from_json(
-        json_rep=internal_state)
+        json_rep=internal_state, edit_options=edit_options)
     if event['client']['event'] == "google_docs_save":
         bundles = event['client']['bundles']
         for bundle in bundles:
@@ -117,7 +129,7 @@ async def reconstruct(event, internal_state):
             i[0] for i in event['client']['history']['changelog']
         ]
         internal_state = writing_observer.reconstruct_doc.command_list(
-            writing_observer.reconstruct_doc.google_text(), change_list
+            writing_observer.reconstruct_doc.google_text(edit_options), change_list
         )
     state = internal_state.json
     if learning_observer.settings.module_setting(
@@ -128,7 +140,7 @@ async def reconstruct(event, internal_state):
     return state, state
 
 
-@kvs_pipeline(scope=gdoc_scope, null_state={"count": 0})
+@kvs_pipeline(scope=gdoc_scope, null_state={"count": 0}, write_behind=True)
 async def event_count(event, internal_state):
     '''
     An example of a per-document pipeline
@@ -144,7 +156,7 @@ async def event_count(event, internal_state):
     return state, state
 
 
-@kvs_pipeline(scope=student_scope, null_state={'tags': {}})
+@kvs_pipeline(scope=student_scope, null_state={'tags': {}}, events=['document_history'])
 async def document_tagging(event, internal_state):
     '''
     We would like to be able to group documents together to better work with